@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""Benchmark downloads, WGS expansion and validation against a local mock Entrez server.
+
+Every scenario runs in a fresh Python process, so its peak memory use can be
+measured on its own. The --validation-jobs worker processes are measured
+separately, reporting the peak memory use of the largest worker. Results can
+be saved with --json and compared against a previous run with --baseline, to
+check performance changes.
+
+Run from the repository root with `python benchmarks/downloads.py`.
+"""
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter, SUPPRESS
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_entrez import (
+    add_server_arguments,
+    MockEntrez,
+    settings_from_args,
+)
+
+# name: (description, Config settings, IDs to download)
+SCENARIOS = {
+    'fasta': ("Batched FASTA download", dict(format='fasta'), 'records'),
+    'genbank': ("Batched GenBank download", dict(format='genbank'), 'records'),
+    'gff3': ("GFF3 download, one request per ID", dict(format='gff3'), 'records'),
+    'single': ("download_to_file of a single GenBank record", dict(format='genbank'), 'single'),
+    'wgs': ("Recursive WGS expansion", dict(format='genbank', recursive=True), 'wgs'),
+    'validate-loads': ("GenBank download with --extended-validation loads",
+                       dict(format='genbank', extended_validation='loads'), 'records'),
+    'validate-all': ("GenBank download with --extended-validation all",
+                     dict(format='genbank', extended_validation='all'), 'records'),
+    'validate-correct': ("GenBank download with --extended-validation correct",
+                         dict(format='genbank', extended_validation='correct'), 'records'),
+}
+
+
+def main():
+    parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter, epilog="scenarios:\n" + "\n".join(
+        "  {:<18}{}".format(name, SCENARIOS[name][0]) for name in sorted(SCENARIOS)))
+    parser.add_argument('scenarios', nargs='*', metavar='scenario', help="Scenarios to run. Default: all")
+    parser.add_argument('--records', type=int, default=200,
+                        help="Number of records to download per scenario. Default: %(default)s")
+    parser.add_argument('--batch-size', type=int, default=20, help="IDs per request. Default: %(default)s")
+    parser.add_argument('--wgs-batch-size', type=int, default=10,
+                        help="WGS parts per request. Default: %(default)s")
+    parser.add_argument('--jobs', type=int, default=1, help="Parallel downloads. Default: %(default)s")
+    parser.add_argument('--validation-jobs', type=int, default=1,
+                        help="Processes to validate in. Default: %(default)s")
+    parser.add_argument('--rate', type=float, default=1000,
+                        help="Client side request rate limit per second. Default: %(default)s")
+    parser.add_argument('--json', dest='json_file', help="Save the results to a JSON file.")
+    parser.add_argument('--baseline', help="Compare the results to those saved by an earlier run with --json.")
+    # used to run a single scenario in a child process
+    parser.add_argument('--run-scenario', help=SUPPRESS)
+    parser.add_argument('--entrez-url', help=SUPPRESS)
+    parser.add_argument('--sviewer-url', help=SUPPRESS)
+    add_server_arguments(parser)
+    opts = parser.parse_args()
+    for name in opts.scenarios:
+        if name not in SCENARIOS:
+            parser.error("Unknown scenario {}".format(name))
+
+    if opts.run_scenario:
+        print(json.dumps(run_scenario(opts)))
+        return
+
+    results = {}
+    with MockEntrez(settings_from_args(opts)) as mock:
+        for name in opts.scenarios or sorted(SCENARIOS):
+            mock.reset()
+            results[name] = run_child(name, mock, opts)
+            results[name]['server_requests'] = mock.requests
+            results[name]['server_bytes'] = mock.bytes
+
+    baseline = {}
+    if opts.baseline:
+        with open(opts.baseline, 'r') as handle:
+            baseline = json.load(handle)
+
+    print_results(results, baseline)
+    if opts.json_file:
+        with open(opts.json_file, 'w') as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
+
+
+def run_child(name, mock, opts):
+    """Run a scenario in a fresh Python process and get its results."""
+    args = [sys.executable, os.path.abspath(__file__), '--run-scenario', name,
+            '--entrez-url', mock.entrez_url, '--sviewer-url', mock.sviewer_url]
+    for option in ('records', 'batch_size', 'wgs_batch_size', 'jobs', 'validation_jobs', 'rate'):
+        args.extend(['--{}'.format(option.replace('_', '-')), str(getattr(opts, option))])
+    output = subprocess.run(args, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run_scenario(opts):
+    """Run a single scenario in this process, returning its measurements."""
+    from ncbi_acc_download.core import Config, download_ids, download_to_file
+    from ncbi_acc_download.ratelimit import RateLimiter
+
+    _, settings, ids = SCENARIOS[opts.run_scenario]
+    config = Config(entrez_url=opts.entrez_url, sviewer_url=opts.sviewer_url, batch_size=opts.batch_size,
+                    wgs_batch_size=opts.wgs_batch_size, jobs=opts.jobs, validation_jobs=opts.validation_jobs,
+                    retry_backoff=0.01, **settings)
+    config.limiter = RateLimiter(opts.rate)
+
+    workdir = tempfile.mkdtemp(prefix='ncbi-acc-download-benchmark-')
+    out = os.path.join(workdir, 'out')
+    start = time.perf_counter()
+    try:
+        if ids == 'single':
+            download_to_file('NC_000001', config, filename=out)
+        elif ids == 'wgs':
+            download_to_file('NZ_BENC01000000', config, filename=out)
+        else:
+            download_ids(['SYN{:06d}'.format(i) for i in range(opts.records)], config, out=out)
+        seconds = time.perf_counter() - start
+    finally:
+        if config.validation_executor is not None:
+            config.validation_executor.shutdown()
+        if config.wgs_executor is not None:
+            config.wgs_executor.shutdown()
+        size = sum(os.path.getsize(os.path.join(workdir, name)) for name in os.listdir(workdir))
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+
+    requests = config.metrics.totals('request')
+    retries = config.metrics.totals('retry')
+    return dict(seconds=seconds, output_bytes=size, throughput=requests['bytes'] / seconds / 1024 / 1024,
+                requests=requests['count'], retries=retries['count'], peak_rss_mib=_peak_rss_mib(resource.RUSAGE_SELF),
+                # the largest of the --validation-jobs worker processes, they aren't part of RUSAGE_SELF
+                worker_rss_mib=_peak_rss_mib(resource.RUSAGE_CHILDREN),
+                validation_seconds=config.metrics.totals('validation')['seconds'])
+
+
+def _peak_rss_mib(who):
+    """Get the peak memory use of this process or the largest of its finished child processes in MiB."""
+    # ru_maxrss is in KiB on Linux, but in bytes on macOS
+    peak_rss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss //= 1024
+    return peak_rss / 1024
+
+
+def print_results(results, baseline):
+    """Print the results as a table, with the change to the baseline if there is one."""
+    columns = (('seconds', "time (s)", "{:9.2f}"), ('throughput', "MiB/s", "{:9.1f}"),
+               ('peak_rss_mib', "RSS (MiB)", "{:9.1f}"), ('worker_rss_mib', "workers", "{:9.1f}"),
+               ('requests', "requests", "{:9d}"),
+               ('retries', "retries", "{:9d}"))
+    print("{:<18}".format("scenario") + "".join("{:>10}".format(title) for _, title, _ in columns) +
+          ("  vs baseline" if baseline else ""))
+    for name, result in results.items():
+        line = "{:<18}".format(name) + "".join(" " + fmt.format(result[key]) for key, _, fmt in columns)
+        if name in baseline:
+            line += "  {:+7.1%} time {:+7.1%} RSS".format(
+                result['seconds'] / baseline[name]['seconds'] - 1,
+                result['peak_rss_mib'] / baseline[name]['peak_rss_mib'] - 1)
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""Compare error pattern scanning throughput of the old per-pattern loop and find_error_pattern.
+
+Run from the repository root with `python benchmarks/error_patterns.py`.
+"""
+
+from argparse import ArgumentParser
+import timeit
+
+from ncbi_acc_download.download import ERROR_PATTERNS, find_error_pattern
+
+SEQUENCE_LINES = u'       61 ctcgcggctg tgtggtgtgc aatatattgc atgtcgctgg cccccgtctc ccgtccggcg\n'
+FEATURE_LINES = (
+    u'     CDS             complement(1234..2345)\n'
+    u'                     /locus_tag="FAKE_00001"\n'
+    u'                     /product="hypothetical protein"\n'
+    u'                     /translation="MAGICSEQWENCEISNOTREALLYAPROTEINSEQWENCE"\n'
+)
+PAYLOADS = {
+    'sequence': SEQUENCE_LINES,
+    'features': FEATURE_LINES,
+    'mixed': SEQUENCE_LINES * 4 + FEATURE_LINES,
+}
+
+
+def scan_per_pattern(chunks):
+    """The scan write_stream used to do, checking every pattern against every chunk."""
+    for chunk in chunks:
+        for pattern in ERROR_PATTERNS:
+            if pattern in chunk:
+                return pattern
+    return None
+
+
+def scan_current(chunks):
+    """The scan iter_stream does now."""
+    previous = u''
+    for chunk in chunks:
+        pattern = find_error_pattern(chunk, previous)
+        if pattern is not None:
+            return pattern
+        previous = chunk
+    return None
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--payload', choices=sorted(PAYLOADS), default='mixed',
+                        help="Kind of GenBank content to scan. Default: %(default)s")
+    parser.add_argument('--size', type=int, default=64, help="Payload size in MiB. Default: %(default)s")
+    parser.add_argument('--chunk-size', type=int, default=4096, help="Chunk size in bytes. Default: %(default)s")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of runs, best one counts. Default: %(default)s")
+    opts = parser.parse_args()
+
+    unit = PAYLOADS[opts.payload]
+    payload = unit * (opts.size * 1024 * 1024 // len(unit))
+    chunks = [payload[i:i + opts.chunk_size] for i in range(0, len(payload), opts.chunk_size)]
+    size_mib = len(payload) / 1024 / 1024
+
+    results = {}
+    for name, func in (('per-pattern', scan_per_pattern), ('current', scan_current)):
+        assert func(chunks) is None
+        best = min(timeit.repeat(lambda: func(chunks), number=1, repeat=opts.repeat))
+        results[name] = best
+        print("{:<12} {:8.3f} s {:10.1f} MiB/s".format(name, best, size_mib / best))
+
+    print("speedup      {:8.2f}x".format(results['per-pattern'] / results['current']))
+
+
+if __name__ == "__main__":
+    main()
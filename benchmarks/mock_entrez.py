@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+"""Local stand-in for the Entrez efetch and sviewer endpoints, serving synthetic records.
+
+Records are generated from the requested IDs, so any ID can be downloaded:
+IDs ending in 000000 like NZ_BENC01000000 are WGS master records without a
+sequence, listing --wgs-parts contigs that can be downloaded in turn.
+Responses can be slowed down, sent in small chunks, answered with
+429 Too Many Requests or cut off by one of the error messages NCBI sends.
+
+Run from the repository root with `python benchmarks/mock_entrez.py` to
+serve requests until interrupted, or use MockEntrez from other benchmarks.
+"""
+
+from argparse import ArgumentParser
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from ncbi_acc_download.download import TRANSIENT_PATTERNS
+
+EFETCH_PATH = '/entrez/eutils/efetch.fcgi'
+SVIEWER_PATH = '/sviewer/viewer.cgi'
+
+WGS_MASTER_RE = re.compile(r'^(?:[A-Z]{2}_)?([A-Z]{4,6}\d{2})(0{6,})$')
+BASES = 'acgt'
+# Genes every GENE_SPACING bases, GENE_LENGTH bases long
+GENE_SPACING = 1000
+GENE_LENGTH = 600
+
+
+class ServerSettings(object):
+    """How the mock server shapes its responses."""
+
+    __slots__ = (
+        'chunk_delay',
+        'chunk_size',
+        'error_rate',
+        'latency',
+        'random',
+        'rate_429',
+        'record_size',
+        'wgs_parts',
+    )
+
+    def __init__(self, record_size=100000, latency=0.0, chunk_size=65536, chunk_delay=0.0,
+                 rate_429=0.0, error_rate=0.0, wgs_parts=50, seed=42):
+        self.record_size = record_size
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.rate_429 = rate_429
+        self.error_rate = error_rate
+        self.wgs_parts = wgs_parts
+        self.random = random.Random(seed)
+
+
+class MockEntrez(object):
+    """A mock Entrez server running in a background thread."""
+
+    def __init__(self, settings=None, port=0):
+        self.settings = settings or ServerSettings()
+        self.requests = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), EntrezHandler)
+        self.server.daemon_threads = True
+        self.server.mock = self
+        self.thread = None
+
+    @property
+    def base_url(self):
+        """Get the URL the server is running on."""
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    @property
+    def entrez_url(self):
+        return self.base_url + EFETCH_PATH
+
+    @property
+    def sviewer_url(self):
+        return self.base_url + SVIEWER_PATH
+
+    def reset(self):
+        """Reset the request and byte counters."""
+        with self.lock:
+            self.requests = 0
+            self.bytes = 0
+
+    def count(self, size=0, requests=0):
+        with self.lock:
+            self.requests += requests
+            self.bytes += size
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+        return False
+
+
+class EntrezHandler(BaseHTTPRequestHandler):
+    """Answer efetch and sviewer requests with synthetic records."""
+
+    protocol_version = 'HTTP/1.1'
+    # headers and chunks are written separately, don't let small writes wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        mock = self.server.mock
+        settings = mock.settings
+        mock.count(requests=1)
+        url = urlsplit(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path not in (EFETCH_PATH, SVIEWER_PATH) or 'id' not in params:
+            self.send_error(404)
+            return
+
+        if settings.latency:
+            time.sleep(settings.latency)
+
+        with mock.lock:
+            too_many = settings.random.random() < settings.rate_429
+            error = settings.random.random() < settings.error_rate
+        if too_many:
+            body = b'Too many requests'
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        ids = params['id'].split(',')
+        if params.get('report') == 'gff3':
+            body = ''.join(gff3_record(dl_id, settings.record_size) for dl_id in ids)
+        elif params.get('rettype') == 'gbwithparts':
+            body = ''.join(genbank_record(dl_id, settings) for dl_id in ids)
+        else:
+            body = ''.join(fasta_record(dl_id, settings.record_size) for dl_id in ids)
+        body = body.encode('ascii')
+        if error:
+            # NCBI sends error messages in the middle of otherwise fine responses
+            pattern = sorted(TRANSIENT_PATTERNS)[0]
+            body = body[:len(body) // 2] + pattern.encode('ascii') + b'\n'
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for start in range(0, len(body), settings.chunk_size):
+            chunk = body[start:start + settings.chunk_size]
+            self.wfile.write("{:x}\r\n".format(len(chunk)).encode('ascii') + chunk + b'\r\n')
+            if settings.chunk_delay:
+                self.wfile.flush()
+                time.sleep(settings.chunk_delay)
+        self.wfile.write(b'0\r\n\r\n')
+        mock.count(size=len(body))
+
+
+def fasta_record(dl_id, length):
+    """Generate a FASTA record."""
+    return ">{}.1 Synthetic sequence {}\n".format(dl_id, dl_id) + _fasta_body(length)
+
+
+def genbank_record(dl_id, settings):
+    """Generate a GenBank record, or a WGS master record listing its contigs."""
+    master = WGS_MASTER_RE.match(dl_id)
+    if master:
+        prefix = master.group(1)
+        width = len(master.group(2))
+        first = "{}{:0{}d}".format(prefix, 1, width)
+        last = "{}{:0{}d}".format(prefix, settings.wgs_parts, width)
+        return _genbank_header(dl_id, settings.wgs_parts, 'CON') + \
+            "WGS         {}-{}\n".format(first, last) + "//\n"
+
+    return _genbank_header(dl_id, settings.record_size, 'BCT') + _genbank_body(settings.record_size)
+
+
+# All records of a length share their sequence and features, so generating responses doesn't slow down the server
+@lru_cache(maxsize=4)
+def _sequence(length):
+    """Get a pseudo-random sequence."""
+    rng = random.Random(length)
+    block = ''.join(rng.choice(BASES) for _ in range(min(length, 4096)))
+    return (block * (length // len(block) + 1))[:length]
+
+
+@lru_cache(maxsize=4)
+def _fasta_body(length):
+    seq = _sequence(length).upper()
+    return "".join(seq[i:i + 70] + "\n" for i in range(0, length, 70))
+
+
+@lru_cache(maxsize=4)
+def _genbank_body(length):
+    lines = ["FEATURES             Location/Qualifiers"]
+    lines.append("     source          1..{}".format(length))
+    lines.append('                     /organism="Synthetic organism"')
+    for number, start in enumerate(range(1, length - GENE_LENGTH, GENE_SPACING), 1):
+        end = start + GENE_LENGTH - 1
+        location = "{}..{}".format(start, end) if number % 2 else "complement({}..{})".format(start, end)
+        lines.append("     gene            {}".format(location))
+        lines.append('                     /locus_tag="SYN_{:05d}"'.format(number))
+        lines.append("     CDS             {}".format(location))
+        lines.append('                     /locus_tag="SYN_{:05d}"'.format(number))
+        lines.append('                     /product="hypothetical protein"')
+    lines.append("ORIGIN")
+    seq = _sequence(length)
+    for start in range(0, length, 60):
+        line = seq[start:start + 60]
+        blocks = " ".join(line[i:i + 10] for i in range(0, len(line), 10))
+        lines.append("{:>9} {}".format(start + 1, blocks))
+    lines.append("//")
+    return "\n".join(lines) + "\n"
+
+
+def _genbank_header(dl_id, length, division):
+    name = dl_id.split('.')[0]
+    return ("LOCUS       {:<16}{:>12} bp    DNA     linear   {} 01-JAN-2020\n"
+            "DEFINITION  Synthetic sequence {}.\n"
+            "ACCESSION   {}\n"
+            "VERSION     {}.1\n"
+            "KEYWORDS    .\n"
+            "SOURCE      Synthetic organism\n"
+            "  ORGANISM  Synthetic organism\n"
+            "            Bacteria.\n").format(name, length, division, dl_id, name, name)
+
+
+def gff3_record(dl_id, length):
+    """Generate a GFF3 file."""
+    lines = ["##gff-version 3", "##sequence-region {}.1 1 {}".format(dl_id, length)]
+    for number, start in enumerate(range(1, length - GENE_LENGTH, GENE_SPACING), 1):
+        strand = '+' if number % 2 else '-'
+        lines.append("{}.1\tSynthetic\tgene\t{}\t{}\t.\t{}\t.\tID=gene-SYN_{:05d}".format(
+            dl_id, start, start + GENE_LENGTH - 1, strand, number))
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--port', type=int, default=8000, help="Port to listen on. Default: %(default)s")
+    add_server_arguments(parser)
+    opts = parser.parse_args()
+
+    with MockEntrez(settings_from_args(opts), opts.port) as mock:
+        print("Serving efetch at {} and sviewer at {}".format(mock.entrez_url, mock.sviewer_url))
+        try:
+            mock.thread.join()
+        except KeyboardInterrupt:
+            pass
+
+
+def add_server_arguments(parser):
+    """Add the options shaping the responses to an argument parser."""
+    parser.add_argument('--record-size', type=int, default=100000,
+                        help="Sequence length of every record in bases. Default: %(default)s")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds to wait before answering a request. Default: %(default)s")
+    parser.add_argument('--server-chunk-size', type=int, default=65536,
+                        help="Bytes per chunk of the response bodies. Default: %(default)s")
+    parser.add_argument('--chunk-delay', type=float, default=0.0,
+                        help="Seconds to wait after each chunk of a response. Default: %(default)s")
+    parser.add_argument('--rate-429', type=float, default=0.0,
+                        help="Fraction of requests answered with 429 Too Many Requests. Default: %(default)s")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of responses cut off by an NCBI error message. Default: %(default)s")
+    parser.add_argument('--wgs-parts', type=int, default=50,
+                        help="Number of contigs of every WGS master record. Default: %(default)s")
+
+
+def settings_from_args(opts):
+    """Create the server settings from parsed options."""
+    return ServerSettings(record_size=opts.record_size, latency=opts.latency, chunk_size=opts.server_chunk_size,
+                          chunk_delay=opts.chunk_delay, rate_429=opts.rate_429, error_rate=opts.error_rate,
+                          wgs_parts=opts.wgs_parts)
+
+
+if __name__ == "__main__":
+    main()
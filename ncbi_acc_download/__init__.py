@@ -1 +1,3 @@
 __version__ = '0.2.9'
+
+from ncbi_acc_download.downloader import Downloader  # noqa: E402,F401
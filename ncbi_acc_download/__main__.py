@@ -2,74 +2,183 @@
 """Get sequences from NCBI by GenBank/RefSeq ID."""
 
 from argparse import ArgumentParser, SUPPRESS
+from itertools import chain
 import sys
 
-from .core import download_to_file, generate_url, Config, HAVE_BIOPYTHON
+from .accessions import iter_unique, read_accessions
+from .core import (
+    Config,
+    download_ids,
+    download_regions,
+    download_split_records,
+    generate_url,
+    HAVE_BIOPYTHON,
+    iter_batches,
+    region_slack,
+    request_batch_size,
+)
 from .errors import (
     DownloadError,
     InvalidIdError,
 )
+from .regions import merge_regions, read_regions
 
 
 def main():
     """Command line handling."""
     parser = ArgumentParser()
 
-    parser.add_argument('ids', nargs='+', metavar='NCBI-accession')
+    parser.add_argument('ids', nargs='*', metavar='NCBI-accession')
+    parser.add_argument('-i', '--input', default=SUPPRESS,
+                        help="Read accessions from a file, one per line or comma-separated. Use - to read from stdin.")
     parser.add_argument('-m', '--molecule', default="nucleotide", choices=["nucleotide", "protein"],
                         help="Molecule type to download. Default: %(default)s")
     parser.add_argument('--api-key', default=SUPPRESS,
                         help="Specify USER NCBI API key. More info at https://www.ncbi.nlm.nih.gov/books/NBK25497/")
+    validation_levels = ('none', 'loads', 'correct')
     if HAVE_BIOPYTHON:
-        parser.add_argument('-e', '--extended-validation', action="store", default='none',
-                            choices=('none', 'loads', 'all', 'correct'),
-                            help="Perform extended validation. Possible options are 'none' to skip validation, "
-                                 "'loads' to check if the sequence file loads in Biopython, "
-                                 "or 'all' to run all checks. Default: %(default)s")
+        validation_levels += ('all',)
+    parser.add_argument('-e', '--extended-validation', action="store", default='none',
+                        choices=validation_levels,
+                        help="Perform extended validation. Possible options are 'none' to skip validation, "
+                             "'loads' to check the structure and sequence characters of the records, "
+                             "'all' to also check the records load in Biopython, or 'correct' to remove "
+                             "features extending beyond the downloaded --range. Default: %(default)s")
+    parser.add_argument('--validation-jobs', type=int, default=SUPPRESS,
+                        help="Number of processes to run extended validation in. Default: 1")
     parser.add_argument('-F', '--format', action="store", default='genbank',
                         choices=('fasta', 'genbank', 'featuretable', 'gff3'),
                         help="File format to download nucleotide sequences in. Default: %(default)s")
     parser.add_argument('-o', '--out', default=SUPPRESS,
                         help="Single filename to use for the combined output.")
+    parser.add_argument('-z', '--compress', default=SUPPRESS, choices=('gzip', 'bgzip', 'zstd'),
+                        help="Compress output files while downloading. bgzip output can be indexed with "
+                             "samtools faidx, zstd requires the zstandard package.")
     parser.add_argument('-p', '--prefix', default=SUPPRESS,
                         help="Filename prefix to use for output files instead of using the NCBI ID.")
+    parser.add_argument('--split', default=SUPPRESS, metavar='DIR',
+                        help="Write every record to its own file in DIR, named after its accession. Records are "
+                             "split off while downloading, so this works well with large --batch-size values.")
+    parser.add_argument('--shard-depth', type=int, default=0,
+                        help="With --split, spread the files over this many levels of subdirectories with 256 "
+                             "subdirectories each, for when there are millions of them. Default: %(default)s")
     parser.add_argument('-g', '--range', default=SUPPRESS,
                         help="region to subset accession. only for single accession")
-    if HAVE_BIOPYTHON:
-        parser.add_argument('-r', '--recursive', action="store_true", default=False,
-                            help="Recursively get all entries of a WGS entry.")
+    parser.add_argument('--regions', default=SUPPRESS,
+                        help="Download the regions listed in a BED or tab-separated file with accession, start and "
+                             "end columns. Starts are 0-based and ends exclusive, like in BED files.")
+    parser.add_argument('--region-slack', type=int, default=SUPPRESS,
+                        help="Download FASTA regions of the same accession less than this many bases apart with "
+                             "a single request and cut them apart locally. GenBank regions are always downloaded "
+                             "one by one. Default: 10000")
+    parser.add_argument('-r', '--recursive', action="store_true", default=False,
+                        help="Recursively get all entries of a WGS entry.")
+    parser.add_argument('-b', '--batch-size', type=int, default=1,
+                        help="Number of IDs to fetch with a single request. Default: %(default)s")
+    parser.add_argument('--wgs-batch-size', type=int, default=SUPPRESS,
+                        help="Number of WGS parts to fetch with a single request when using --recursive. "
+                             "Default: 10")
+    parser.add_argument('--no-dedupe', dest='dedupe', action="store_false", default=True,
+                        help="Download IDs as given, instead of downloading IDs requested more than once, also in "
+                             "different case or with surrounding whitespace, only once.")
+    parser.add_argument('--history', action="store_true", default=False,
+                        help="Upload the IDs to the Entrez history server and download the records from there, "
+                             "--batch-size records per request. Much faster for long lists of IDs.")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of downloads to run in parallel. Requests stay within the NCBI rate limit "
+                             "of 3 requests per second, or 10 per second with --api-key. Default: %(default)s")
+    parser.add_argument('--pool-size', type=int, default=SUPPRESS,
+                        help="Number of HTTP connections to keep open to NCBI. Default: same as --jobs, twice that "
+                             "with --recursive")
+    parser.add_argument('--cache-dir', default=SUPPRESS,
+                        help="Directory to cache downloaded records in, so repeated downloads skip the network.")
+    parser.add_argument('--cache-ttl', type=int, default=SUPPRESS,
+                        help="Maximum age of cached records in seconds. Default: no limit")
+    parser.add_argument('--cache-max-size', type=int, default=SUPPRESS,
+                        help="Maximum size of the cache in MiB, least recently used records are removed first. "
+                             "Default: no limit")
+    parser.add_argument('--offline', action="store_true", default=False,
+                        help="Only use records from the cache, don't access the network.")
+    parser.add_argument('--refresh', action="store_true", default=False,
+                        help="Download all records again, replacing their cache entries.")
+    parser.add_argument('--retries', type=int, default=3,
+                        help="Number of times to retry downloads failing because of network or server problems. "
+                             "Default: %(default)s")
+    parser.add_argument('--retry-backoff', type=float, default=1.0,
+                        help="Initial wait in seconds before retrying, doubled for every further retry. "
+                             "Default: %(default)s")
+    parser.add_argument('--retry-max-backoff', type=float, default=60.0,
+                        help="Maximum wait in seconds between retries. Default: %(default)s")
+    parser.add_argument('--resume', action="store_true", default=False,
+                        help="Resume an interrupted run, only downloading what is still missing.")
+    parser.add_argument('--chunk-size', type=int, default=SUPPRESS,
+                        help="Number of bytes to read from the network at once. Default: 1048576")
+    parser.add_argument('--stats', dest='stats_file', default=SUPPRESS,
+                        help="Write timings and sizes of all requests, retries, validation and WGS expansion "
+                             "to a JSON lines file.")
+    parser.add_argument('--summary', action="store_true", default=False,
+                        help="Print a summary of the download timings and sizes at the end of the run.")
     parser.add_argument('--url', action="store_true", default=False,
                         help="Instead of downloading the sequences, just print the URLs to stdout.")
     parser.add_argument('-v', '--verbose', action="store_true", default=False,
                         help="Print a progress indicator.")
 
     opts = parser.parse_args()
+    if 'regions' in opts:
+        if opts.ids or 'input' in opts or 'range' in opts:
+            parser.error("--regions can't be combined with accessions, --input or --range")
+    elif not opts.ids and 'input' not in opts:
+        parser.error("Specify at least one accession, or use --input or --regions")
+    if 'split' in opts:
+        if 'out' in opts or 'prefix' in opts or 'regions' in opts:
+            parser.error("--split can't be combined with --out, --prefix or --regions")
+        if opts.format == 'gff3':
+            parser.error("--split can't split GFF3 files into records")
+    if opts.url and opts.history:
+        parser.error("--url can't be combined with --history")
 
+    if 'cache_max_size' in opts:
+        opts.cache_max_size *= 1024 * 1024
     config = Config.from_args(opts)
-    if len(opts.ids) > 1 and config.range != "none":
+    if (len(opts.ids) > 1 or 'input' in opts) and config.range != "none":
         raise ValueError("Ambiguous range for multiple ids")
 
-    # TODO: Change this to download multiple records at once?
-    for i, dl_id in enumerate(opts.ids):
-        filename = None
-        append = False
-        if 'prefix' in opts:
-            filename = "{fn}_{i}".format(fn=opts.prefix, i=i)
-        elif 'out' in opts:
-            filename = opts.out
-            append = (i > 0)
+    input_handle = None
+    dl_ids = opts.ids
+    if 'input' in opts:
+        input_handle = sys.stdin if opts.input == '-' else open(opts.input, 'r')
+        dl_ids = chain(opts.ids, read_accessions(input_handle))
+    elif 'regions' in opts:
+        input_handle = sys.stdin if opts.regions == '-' else open(opts.regions, 'r')
 
-        try:
-            if opts.url:
-                print(generate_url(dl_id, config))
-            else:
-                download_to_file(dl_id, config, filename, append)
-        except InvalidIdError as err:
-            print("NCBI Entrez returned error code {e.status_code}, are ID(s) {e.ids} valid?".format(e=err))
-            sys.exit(1)
-        except DownloadError as err:
-            print(err, file=sys.stderr)
-            sys.exit(1)
+    try:
+        if 'regions' in opts and opts.url:
+            for group in merge_regions(read_regions(input_handle), region_slack(config)):
+                print(generate_url(group.accession, config, (group.start + 1, group.end)))
+        elif 'regions' in opts:
+            download_regions(read_regions(input_handle), config, prefix=getattr(opts, 'prefix', None),
+                             out=getattr(opts, 'out', None))
+        elif opts.url:
+            if config.dedupe:
+                dl_ids = iter_unique(dl_ids)
+            for _, batch in iter_batches(dl_ids, request_batch_size(config)):
+                print(generate_url(",".join(batch), config))
+        elif 'split' in opts:
+            download_split_records(dl_ids, config, opts.split, opts.shard_depth)
+        else:
+            download_ids(dl_ids, config, prefix=getattr(opts, 'prefix', None), out=getattr(opts, 'out', None))
+    except InvalidIdError as err:
+        print("NCBI Entrez returned error code {e.status_code}, are ID(s) {e.ids} valid?".format(e=err))
+        sys.exit(1)
+    except DownloadError as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if input_handle is not None and input_handle is not sys.stdin:
+            input_handle.close()
+        config.metrics.close()
+        if opts.summary:
+            print(config.metrics.summary(), file=sys.stderr, end='')
 
 
 if __name__ == "__main__":
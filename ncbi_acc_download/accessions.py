@@ -0,0 +1,76 @@
+# Copyright 2017,2018 Kai Blin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Read and normalise lists of accessions."""
+
+# RefSeq accession prefixes by database, see https://www.ncbi.nlm.nih.gov/books/NBK21091/
+NUCLEOTIDE_PREFIXES = frozenset(('AC_', 'NC_', 'NG_', 'NM_', 'NR_', 'NT_', 'NW_', 'NZ_', 'XM_', 'XR_'))
+PROTEIN_PREFIXES = frozenset(('AP_', 'NP_', 'WP_', 'XP_', 'YP_'))
+
+
+def read_accessions(handle):
+    """Lazily read accessions from a file handle.
+
+    Accessions can be given one per line or comma-separated, empty lines and
+    lines starting with # are ignored.
+    """
+    # types: file -> iterator of strings
+    for line in handle:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        for accession in line.split(','):
+            accession = accession.strip()
+            if accession:
+                yield accession
+
+
+def normalize_accession(accession):
+    """Get the canonical form of an accession, without surrounding whitespace and in upper case."""
+    # types: string -> string
+    return accession.strip().upper()
+
+
+def iter_deduplicated(dl_ids):
+    """Lazily normalise IDs, yielding (index, requested ID, normalised ID, first request) tuples.
+
+    IDs differing only in case or surrounding whitespace are the same. IDs
+    without a version are kept apart from IDs with one, as they get the
+    current version of a record, which might not be the one asked for.
+    """
+    # types: iterable of strings -> iterator of (int, string, string, bool)
+    seen = set()
+    for index, requested in enumerate(dl_ids):
+        dl_id = normalize_accession(requested)
+        first = dl_id not in seen
+        seen.add(dl_id)
+        yield index, requested, dl_id, first
+
+
+def iter_unique(dl_ids):
+    """Lazily drop duplicate IDs, yielding the normalised form of every ID the first time it is requested."""
+    # types: iterable of strings -> iterator of strings
+    for _, _, dl_id, first in iter_deduplicated(dl_ids):
+        if first:
+            yield dl_id
+
+
+def guess_molecule(accession):
+    """Guess if a RefSeq accession belongs to the nucleotide or protein database, or None if it can't be told."""
+    # types: string -> string
+    prefix = normalize_accession(accession)[:3]
+    if prefix in PROTEIN_PREFIXES:
+        return 'protein'
+    if prefix in NUCLEOTIDE_PREFIXES:
+        return 'nucleotide'
+    return None
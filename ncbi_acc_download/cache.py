@@ -0,0 +1,279 @@
+# Copyright 2017,2018 Kai Blin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""On-disk cache of downloaded Entrez responses."""
+
+import codecs
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Parameters that don't change the content of the response
+IGNORED_PARAMS = {'tool', 'api_key'}
+# Entries start with a line of metadata like the encoding of the body, entries without it are broken
+ENTRY_HEADER = b'#ncbi-acc-download cache entry '
+# Once the cache grows too large, shrink it to this fraction of max_size, so it isn't scanned on every download
+EVICT_TARGET = 0.9
+
+
+class ResponseCache(object):
+    """Gzip-compressed response bodies, stored by a hash of the request.
+
+    The modification time of a cache entry is the time it was stored and is
+    used for the TTL, the access time is updated on every hit and used to
+    evict the least recently used entries once the cache grows too large.
+    """
+
+    __slots__ = (
+        'directory',
+        'max_size',
+        'refresh',
+        'ttl',
+        '_lock',
+        '_size',
+    )
+
+    def __init__(self, directory, ttl=None, max_size=None, refresh=False):
+        """Set up a cache in directory, creating it if needed."""
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        # total size of all entries, only scanned once it is needed
+        self._size = None
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(url, params):
+        """Get the cache key for a request."""
+        # types: string, dict -> string
+        normalised = sorted((key, str(value)) for key, value in params.items() if key not in IGNORED_PARAMS)
+        content = json.dumps([url, normalised])
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        """Get the file name of a cache entry."""
+        # types: string -> string
+        return os.path.join(self.directory, key[:2], "{}.gz".format(key))
+
+    def get(self, url, params):
+        """Get a cached response for the request, or None if there is no usable entry."""
+        # types: string, dict -> CachedResponse
+        if self.refresh:
+            return None
+
+        path = self.path(self.key(url, params))
+        try:
+            stored = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+
+        now = time.time()
+        if self.ttl is not None and now - stored > self.ttl:
+            return None
+
+        encoding = _read_header(path)
+        if encoding is False:
+            return None
+
+        os.utime(path, (now, stored))
+        return CachedResponse(path, url, encoding)
+
+    def wrap(self, response, url, params):
+        """Wrap a network response so its body gets stored once it was read completely."""
+        # types: requests.Response, string, dict -> CachingResponse
+        return CachingResponse(response, self, self.path(self.key(url, params)))
+
+    def entries(self):
+        """Get (path, size, last access) tuples for all cache entries."""
+        # types: -> list of (string, int, float)
+        entries = []
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith('.gz'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_atime))
+        return entries
+
+    def added(self, size):
+        """Account for an entry growing the cache by size bytes, evicting entries if it got too large.
+
+        The cache directory is only scanned for the first entry and when the
+        cache needs to shrink, not for every entry.
+        """
+        # types: int -> None
+        if self.max_size is None:
+            return
+        with self._lock:
+            if self._size is None:
+                # the scan includes the new entry already
+                self._size = sum(entry_size for _, entry_size, _ in self.entries())
+            else:
+                self._size += size
+            if self._size > self.max_size:
+                self._size = self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits into max_size, with some room to spare.
+
+        Returns the size of the remaining entries.
+        """
+        # types: -> int
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        if self.max_size is None:
+            return total
+
+        target = self.max_size * EVICT_TARGET
+        for path, size, _ in sorted(entries, key=lambda entry: entry[2]):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+
+class CachedResponse(object):
+    """A response read back from the cache instead of the network."""
+
+    __slots__ = (
+        'encoding',
+        'path',
+        'url',
+    )
+
+    status_code = 200
+
+    def __init__(self, path, url, encoding=None):
+        self.path = path
+        self.url = "{} (cached)".format(url)
+        self.encoding = encoding
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        """Iterate over the cached body, like requests.Response.iter_content."""
+        with gzip.open(self.path, 'rb') as fh:
+            # skip the header line
+            fh.readline()
+
+            def chunks():
+                while True:
+                    chunk = fh.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+
+            if decode_unicode:
+                for chunk in _decode(chunks(), self.encoding):
+                    yield chunk
+            else:
+                for chunk in chunks():
+                    yield chunk
+
+
+class CachingResponse(object):
+    """A network response that copies its body into the cache while being read."""
+
+    def __init__(self, response, cache, path):
+        self._response = response
+        self._cache = cache
+        self._path = path
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        """Iterate over the response body, storing it in the cache once it was read completely.
+
+        The raw bytes of the body are stored together with the encoding requests
+        decodes them with, so cache hits give the same bytes or text as the
+        network did. Aborted downloads, including those stopped because of an
+        error pattern in the body, never end up in the cache.
+        """
+        directory = os.path.dirname(self._path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        os.close(fd)
+        encoding = self._response.encoding
+        complete = False
+        try:
+            with gzip.open(tmp_path, 'wb') as fh:
+                fh.write(ENTRY_HEADER + json.dumps(dict(encoding=encoding)).encode('utf-8') + b'\n')
+
+                def chunks():
+                    for chunk in self._response.iter_content(chunk_size):
+                        fh.write(chunk)
+                        yield chunk
+
+                if decode_unicode:
+                    for chunk in _decode(chunks(), encoding):
+                        yield chunk
+                else:
+                    for chunk in chunks():
+                        yield chunk
+            size = os.path.getsize(tmp_path)
+            try:
+                size -= os.path.getsize(self._path)
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, self._path)
+            complete = True
+        finally:
+            if not complete:
+                os.remove(tmp_path)
+
+        self._cache.added(size)
+
+
+def _read_header(path):
+    """Read the encoding from the header of a cache entry, or False if the entry is broken."""
+    # types: string -> string
+    try:
+        with gzip.open(path, 'rb') as fh:
+            first = fh.readline()
+        if not first.startswith(ENTRY_HEADER):
+            return False
+        return json.loads(first[len(ENTRY_HEADER):].decode('utf-8'))['encoding']
+    except (OSError, EOFError, ValueError, KeyError, TypeError):
+        return False
+
+
+def _decode(chunks, encoding):
+    """Decode chunks of bytes like requests does for iter_content(decode_unicode=True)."""
+    # types: iterable of bytes, string -> iterator of strings
+    if encoding is None:
+        # requests passes the bytes on if it doesn't know the encoding
+        for chunk in chunks:
+            yield chunk
+        return
+
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
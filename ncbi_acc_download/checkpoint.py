@@ -0,0 +1,139 @@
+# Copyright 2017,2018 Kai Blin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Checkpoint downloads so interrupted runs can be resumed."""
+
+import json
+import os
+
+from ncbi_acc_download.compress import open_compressed
+
+
+class Journal(object):
+    """Write an output file via a part file, journaling the finished pieces.
+
+    The data goes to <filename>.part, which only gets renamed to the final name
+    once everything was written. Every finished piece (a top-level ID or a
+    batch of WGS contigs) is recorded in <filename>.journal together with the
+    size of the part file at that point. When resuming, the part file is cut
+    back to the last recorded size and finished pieces are skipped.
+    """
+
+    __slots__ = (
+        'binary',
+        'compress',
+        'filename',
+        'handle',
+        'journal_name',
+        'part_name',
+        'resume',
+        '_done',
+        '_journal',
+    )
+
+    def __init__(self, filename, resume=False, binary=False, compress=None):
+        self.filename = filename
+        self.binary = binary
+        self.compress = compress
+        self.part_name = "{}.part".format(filename)
+        self.journal_name = "{}.journal".format(filename)
+        self.resume = resume
+        self.handle = None
+        self._done = set()
+        self._journal = None
+
+    @property
+    def direct(self):
+        """Check if the output is a device like /dev/stdout that has to be written directly."""
+        return os.path.exists(self.filename) and not os.path.isfile(self.filename)
+
+    @property
+    def finished(self):
+        """Check if a previous run already completed the output file."""
+        return (self.resume and os.path.isfile(self.filename) and
+                not os.path.exists(self.journal_name))
+
+    def __enter__(self):
+        if self.direct:
+            self.handle = self._open(self.filename, 'w')
+            return self
+
+        offset = None
+        if self.resume and os.path.exists(self.journal_name) and os.path.exists(self.part_name):
+            offset = self._load()
+
+        if offset is None:
+            self.handle = self._open(self.part_name, 'w')
+            self._journal = open(self.journal_name, 'w')
+        else:
+            os.truncate(self.part_name, offset)
+            self.handle = self._open(self.part_name, 'a')
+            self._journal = open(self.journal_name, 'a')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.handle.close()
+        if self._journal is None:
+            return False
+
+        self._journal.close()
+        if exc_type is None:
+            os.replace(self.part_name, self.filename)
+            os.remove(self.journal_name)
+        return False
+
+    def _open(self, filename, mode):
+        """Open the output in the right mode, compressing it if needed."""
+        if self.compress is not None:
+            return open_compressed(filename, mode, self.compress, self.binary)
+        if self.binary:
+            mode += 'b'
+        return open(filename, mode)
+
+    def _load(self):
+        """Read the finished pieces from the journal, returning the size of the valid part file."""
+        # types: -> int
+        offset = 0
+        with open(self.journal_name, 'r') as handle:
+            for line in handle:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # interrupted while writing the last entry
+                    break
+                self._done.add(entry['key'])
+                offset = entry['offset']
+        return offset
+
+    def is_done(self, key):
+        """Check if a piece was finished by a previous run."""
+        # types: string -> bool
+        return key in self._done
+
+    def mark_done(self, key):
+        """Record a piece as finished, after all its data was written."""
+        # types: string -> None
+        self._done.add(key)
+        if self._journal is None:
+            return
+        self.handle.flush()
+        if self.compress is None:
+            offset = self.handle.tell()
+        else:
+            # Finish the compressed member, so the part file can be cut back to this point
+            writer = self.handle if self.binary else self.handle.buffer
+            writer.end_member()
+            offset = writer.raw.tell()
+        entry = dict(key=key, offset=offset)
+        self._journal.write(json.dumps(entry) + '\n')
+        self._journal.flush()
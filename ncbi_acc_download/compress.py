@@ -0,0 +1,216 @@
+# Copyright 2017,2018 Kai Blin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compress output files while they are being written."""
+
+import io
+import struct
+import zlib
+
+# zstd support is optional
+try:
+    import zstandard
+    HAVE_ZSTD = True
+except ImportError:  # pragma: no cover
+    HAVE_ZSTD = False
+
+
+COMPRESSION_METHODS = ('gzip', 'bgzip', 'zstd')
+
+FILE_ENDINGS = {
+    'gzip': '.gz',
+    'bgzip': '.gz',
+    'zstd': '.zst',
+}
+
+# Largest amount of uncompressed data in a BGZF block, same as samtools/htslib uses
+BGZF_BLOCK_SIZE = 0xff00
+# Empty block marking the end of a BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+# gzip header with the BGZF extra subfield, the total block size minus one follows it
+BGZF_HEADER = bytes.fromhex('1f8b08040000000000ff060042430200')
+
+
+class GzipCompressor(object):
+    """Compress data into a series of gzip members."""
+
+    def __init__(self, level=6):
+        self._level = level
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def end_member(self):
+        """Finish the current gzip member, returning the remaining compressed data."""
+        data = self._compressor.flush()
+        self._compressor = zlib.compressobj(self._level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return data
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BgzfCompressor(object):
+    """Compress data into BGZF blocks, the blocked gzip variant samtools and tabix can index."""
+
+    def __init__(self, level=6):
+        self._level = level
+        self._buffer = bytearray()
+
+    def _block(self, data):
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        cdata = compressor.compress(data) + compressor.flush()
+        block_size = len(BGZF_HEADER) + 2 + len(cdata) + 8
+        return b''.join((
+            BGZF_HEADER,
+            struct.pack('<H', block_size - 1),
+            cdata,
+            struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)),
+        ))
+
+    def compress(self, data):
+        self._buffer.extend(data)
+        blocks = []
+        while len(self._buffer) >= BGZF_BLOCK_SIZE:
+            blocks.append(self._block(bytes(self._buffer[:BGZF_BLOCK_SIZE])))
+            del self._buffer[:BGZF_BLOCK_SIZE]
+        return b''.join(blocks)
+
+    def end_member(self):
+        """Write out the remaining data as a block, returning the compressed data."""
+        if not self._buffer:
+            return b''
+        block = self._block(bytes(self._buffer))
+        self._buffer = bytearray()
+        return block
+
+    def finish(self):
+        return self.end_member() + BGZF_EOF
+
+
+class ZstdCompressor(object):
+    """Compress data into a series of zstd frames."""
+
+    def __init__(self, level=3):
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._stream = self._compressor.compressobj()
+
+    def compress(self, data):
+        return self._stream.compress(data)
+
+    def end_member(self):
+        """Finish the current zstd frame, returning the remaining compressed data."""
+        data = self._stream.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+        self._stream = self._compressor.compressobj()
+        return data
+
+    def finish(self):
+        return self._stream.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+COMPRESSORS = {
+    'gzip': GzipCompressor,
+    'bgzip': BgzfCompressor,
+    'zstd': ZstdCompressor,
+}
+
+
+class CompressedWriter(io.BufferedIOBase):
+    """Write-only file object compressing everything written to it into another file.
+
+    Calling end_member() finishes the current gzip member, BGZF block or zstd
+    frame, so the underlying file is a complete compressed file up to that
+    point and can be cut back there and appended to later.
+
+    Asking for the position does the same, so fetch_and_write can seek back
+    to it and truncate the output to retry a failed download. Only the last
+    position told can be seeked back to. Positions count uncompressed data.
+    """
+
+    def __init__(self, raw, method):
+        """Compress into the binary file object raw using method."""
+        if method not in COMPRESSORS:
+            raise ValueError("Invalid compression method {}".format(method))
+        if method == 'zstd' and not HAVE_ZSTD:
+            raise ValueError("Asked for zstd compression, but zstandard not available")
+        self.raw = raw
+        self.method = method
+        self._compressor = COMPRESSORS[method]()
+        # (uncompressed, compressed) position of the last member boundary told
+        self._mark = None
+        self._position = 0
+        self._written = 0
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return self.raw.seekable()
+
+    def tell(self):
+        """Get the amount of data written, finishing the current member so the output can be cut back here."""
+        self.end_member()
+        self._mark = (self._written, self.raw.tell())
+        return self._written
+
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence != io.SEEK_SET or self._mark is None or position != self._mark[0]:
+            raise io.UnsupportedOperation("Can only seek back to the last position told")
+        self._position = position
+        return position
+
+    def truncate(self, size=None):
+        """Throw away everything written after the last position told."""
+        if size is None:
+            size = self._position
+        if self._mark is None or size != self._mark[0]:
+            raise io.UnsupportedOperation("Can only truncate at the last position told")
+        self.raw.seek(self._mark[1])
+        self.raw.truncate()
+        self._compressor = COMPRESSORS[self.method]()
+        self._position = self._written = size
+        return size
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed file")
+        self.raw.write(self._compressor.compress(bytes(data)))
+        self._written += len(data)
+        self._position = self._written
+        return len(data)
+
+    def end_member(self):
+        """Finish the current compressed member and flush it to the underlying file."""
+        self.raw.write(self._compressor.end_member())
+        self.raw.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.raw.write(self._compressor.finish())
+        finally:
+            super().close()
+            self.raw.close()
+
+
+def open_compressed(filename, mode, method, binary):
+    """Open a file for writing, compressing everything written to it with method.
+
+    Returns a binary file object if binary is set, or a UTF-8 text file object otherwise.
+    """
+    writer = CompressedWriter(open(filename, mode + 'b'), method)
+    if binary:
+        return writer
+    return io.TextIOWrapper(writer, encoding='utf-8')
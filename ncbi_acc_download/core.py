@@ -13,28 +13,90 @@
 # limitations under the License.
 """Core functions of the ncbi-by-accession downloader."""
 from __future__ import print_function
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
 import functools
 from io import StringIO
+from itertools import islice
+import multiprocessing
+import os
+import shutil
 import sys
+import tempfile
 import time
 from urllib.parse import urlencode
 
+from ncbi_acc_download.accessions import (
+    guess_molecule,
+    iter_deduplicated,
+    iter_unique,
+)
+from ncbi_acc_download.cache import ResponseCache
+from ncbi_acc_download.checkpoint import Journal
+from ncbi_acc_download.compress import (
+    COMPRESSION_METHODS,
+    FILE_ENDINGS,
+    HAVE_ZSTD,
+    open_compressed,
+)
 from ncbi_acc_download.download import (
     build_params,
-    get_stream,
+    CHUNK_SIZE,
+    create_session,
+    fetch_and_write,
+    get_stream,  # noqa: F401 -- still imported from here by existing callers and tests
     get_url_by_format,
+    iter_stream,
+    ordered_map,
     write_stream,
 )
 from ncbi_acc_download.errors import (
-    TooManyRequests,
+    DownloadError,
     ValidationError,
 )
+from ncbi_acc_download.history import (
+    EPOST_URL,
+    HISTORY_POST_SIZE,
+    iter_history_batches,
+)
+from ncbi_acc_download.metrics import (
+    Metrics,
+    StatsFile,
+)
+from ncbi_acc_download.ratelimit import RateLimiter
+from ncbi_acc_download.records import (
+    iter_lines,
+    iter_records,
+    SPLITTABLE_FORMATS,
+    strip_version,
+)
+from ncbi_acc_download.regions import (
+    cut_region,
+    merge_regions,
+    MERGE_FORMATS,
+    REGION_FORMATS,
+    REGION_SLACK,
+)
+from ncbi_acc_download.retry import RetryPolicy
+from ncbi_acc_download.split import (
+    MAX_SHARD_DEPTH,
+    record_path,
+    RecordFiles,
+    RecordSplitter,
+)
 from ncbi_acc_download.validate import (
+    BIOPYTHON_LEVELS,
     HAVE_BIOPYTHON,
+    iter_validated,
     run_extended_validation,
     VALIDATION_LEVELS,
 )
-from ncbi_acc_download.wgs import download_wgs_parts
+from ncbi_acc_download.wgs import (
+    STEP_SIZE,
+    write_wgs_parts,
+)
 
 ENTREZ_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi'
 SVIEWER_URL = 'https://eutils.ncbi.nlm.nih.gov/sviewer/viewer.cgi'
@@ -46,20 +108,44 @@ class Config(object):
     __slots__ = (
         'range',
         'api_key',
+        'batch_size',
+        'cache',
+        'chunk_size',
+        'compress',
+        'dedupe',
         'emit',
         'entrez_url',
+        'epost_url',
         '_extended_validation',
         'format',
+        'history',
+        'jobs',
         'keep_filename',
+        'limiter',
+        'metrics',
         'molecule',
+        'offline',
         'recursive',
+        'region_slack',
+        'resume',
+        'retry',
+        'session',
         'sviewer_url',
+        'validation_executor',
+        'validation_jobs',
         'verbose',
+        'wgs_batch_size',
+        'wgs_executor',
     )
 
     def __init__(self, *, extended_validation="none", molecule="nucleotide", out=None,
                  recursive=False, api_key="none", entrez_url=ENTREZ_URL, sviewer_url=SVIEWER_URL,
-                 format="genbank", verbose=False, **kwargs):
+                 format="genbank", verbose=False, batch_size=1, jobs=1, pool_size=None,
+                 cache_dir=None, cache_ttl=None, cache_max_size=None, refresh=False, offline=False,
+                 resume=False, retries=3, retry_backoff=1.0, retry_max_backoff=60.0,
+                 chunk_size=CHUNK_SIZE, compress=None, history=False, epost_url=EPOST_URL,
+                 wgs_batch_size=STEP_SIZE, validation_jobs=1, region_slack=REGION_SLACK, metrics=None,
+                 stats_file=None, dedupe=False, **kwargs):
         """Initialise the config from scratch."""
         self.extended_validation = extended_validation
         self.molecule = molecule
@@ -68,13 +154,88 @@ class Config(object):
         self.api_key = api_key
         self.range = kwargs.get('range', 'none')
 
+        if batch_size < 1:
+            raise ValueError("Batch size needs to be at least 1")
+        self.batch_size = batch_size
+        if jobs < 1:
+            raise ValueError("Number of jobs needs to be at least 1")
+        self.jobs = jobs
+        if wgs_batch_size < 1:
+            raise ValueError("WGS batch size needs to be at least 1")
+        self.wgs_batch_size = wgs_batch_size
+        if region_slack < 0:
+            raise ValueError("Region slack can't be negative")
+        self.region_slack = region_slack
+        self.dedupe = dedupe
+        # shared by all download threads, so the whole run stays within NCBI's request rate
+        self.limiter = RateLimiter.for_api_key(api_key)
+        # reuse connections across all requests of a run instead of a new TLS handshake for each
+        if pool_size is None:
+            # the parts of WGS records are downloaded next to the records they belong to
+            pool_size = 2 * jobs if recursive and jobs > 1 else jobs
+        if pool_size < 1:
+            raise ValueError("Connection pool size needs to be at least 1")
+        self.session = create_session(pool_size)
+        # All WGS records of a run share the threads downloading their parts, instead of a pool for each record.
+        # Threads are only started once something gets submitted.
+        self.wgs_executor = None
+        if jobs > 1:
+            self.wgs_executor = ThreadPoolExecutor(max_workers=jobs)
+
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = ResponseCache(cache_dir, ttl=cache_ttl, max_size=cache_max_size, refresh=refresh)
+        elif offline:
+            raise ValueError("Running offline requires a cache directory")
+        self.offline = offline
+        self.resume = resume
+        self.retry = RetryPolicy(retries, retry_backoff, retry_max_backoff)
+        if chunk_size < 1:
+            raise ValueError("Chunk size needs to be at least 1")
+        self.chunk_size = chunk_size
+
+        if compress is not None and compress not in COMPRESSION_METHODS:
+            raise ValueError("Invalid compression method {}".format(compress))
+        if compress == 'zstd' and not HAVE_ZSTD:
+            raise ValueError("Asked for zstd compression, but zstandard not available")
+        self.compress = compress
+
+        if validation_jobs < 1:
+            raise ValueError("Number of validation jobs needs to be at least 1")
+        self.validation_jobs = validation_jobs
+        # Parsing records is CPU bound, so validate them in separate processes rather than threads.
+        # Worker processes are only started once something gets validated.
+        self.validation_executor = None
+        if validation_jobs > 1:
+            # don't fork a process running download threads
+            self.validation_executor = ProcessPoolExecutor(
+                max_workers=validation_jobs, mp_context=multiprocessing.get_context('spawn'))
+
         self.entrez_url = entrez_url
         self.sviewer_url = sviewer_url
+        self.epost_url = epost_url
 
         if self.molecule == 'nucleotide':
             self.format = format
         else:
             self.format = 'fasta'
+
+        if history:
+            if self.format == 'gff3':
+                raise ValueError("GFF3 downloads can't use the Entrez history server")
+            if offline:
+                raise ValueError("Using the Entrez history server requires network access")
+            if batch_size > HISTORY_POST_SIZE:
+                raise ValueError("Batch size can't be larger than {} with the Entrez history server".format(
+                    HISTORY_POST_SIZE))
+        self.history = history
+
+        # timings and sizes of all requests, validation and WGS expansion of the run
+        if metrics is None:
+            metrics = Metrics()
+        if stats_file is not None:
+            metrics.add_listener(StatsFile(stats_file))
+        self.metrics = metrics
         self.verbose = verbose
 
         def noop(arg):
@@ -92,7 +253,7 @@ class Config(object):
 
     @extended_validation.setter
     def extended_validation(self, value):
-        if value != 'none' and not HAVE_BIOPYTHON:
+        if value in BIOPYTHON_LEVELS and not HAVE_BIOPYTHON:
             raise ValueError("Asked for extended validation, but Biopython not available")
         if value not in VALIDATION_LEVELS:
             raise ValueError("Invalid validation level {}".format(value))
@@ -105,38 +266,543 @@ class Config(object):
         return config
 
 
+def iter_batches(dl_ids, batch_size):
+    """Lazily group IDs into batches, yielding (index of the first ID, list of IDs) tuples."""
+    # types: iterable of strings, int -> iterator of (int, list of strings)
+    iterator = iter(dl_ids)
+    start = 0
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield start, batch
+        start += len(batch)
+
+
+def request_batch_size(config):
+    """Get the number of IDs to fetch with a single request.
+
+    Downloads in formats that can't be split into records, like GFF3, are
+    fetched one ID per request.
+    """
+    # types: Config -> int
+    if config.format not in SPLITTABLE_FORMATS:
+        return 1
+    return config.batch_size
+
+
+def region_slack(config):
+    """Get the slack to merge regions with, or None if every region needs a request of its own.
+
+    Only regions of FASTA records can be cut out locally, other formats are
+    fetched one region per request.
+    """
+    # types: Config -> int
+    if config.format not in MERGE_FORMATS:
+        return None
+    return config.region_slack
+
+
+def download_ids(dl_ids, config, prefix=None, out=None):
+    """Download IDs in batches, running up to config.jobs downloads at once.
+
+    IDs can come from any iterable and are only read when the downloads
+    before them have been started, so long lists can be streamed in. With
+    config.history, the IDs are uploaded to the Entrez history server and
+    fetched from there in pages of config.batch_size records.
+    """
+    # types: iterable of strings, Config, string, string -> None
+    combined = prefix is None and out is not None
+    duplicates = None
+    if config.dedupe and combined:
+        dl_ids = _check_molecules(iter_unique(dl_ids), config)
+    elif config.dedupe:
+        duplicates = _Duplicates(config, prefix)
+        dl_ids = duplicates.unique(dl_ids)
+
+    def tasks():
+        if config.history:
+            batches = iter_history_batches(dl_ids, config)
+        else:
+            batches = ((range(start, start + len(batch)), batch, None)
+                       for start, batch in iter_batches(dl_ids, request_batch_size(config)))
+        for indices, batch, history in batches:
+            filenames = None
+            if duplicates is not None:
+                filenames = [duplicates.filename(dl_id) for dl_id in batch]
+            elif prefix is not None:
+                filenames = ["{fn}_{i}".format(fn=prefix, i=i) for i in indices]
+            yield indices[0], batch, filenames, history
+
+    if combined:
+        _download_combined(tasks(), config, out)
+        return
+
+    if config.jobs == 1:
+        for _, batch, filenames, history in tasks():
+            download_batch_to_files(batch, config, filenames, history)
+            if duplicates is not None:
+                duplicates.finished(batch)
+        return
+
+    with ThreadPoolExecutor(max_workers=config.jobs) as executor:
+        calls = ((batch, (batch, config, filenames, history)) for _, batch, filenames, history in tasks())
+        for batch, future in ordered_map(executor, download_batch_to_files, calls, 2 * config.jobs):
+            future.result()
+            if duplicates is not None:
+                duplicates.finished(batch)
+
+
+class _Duplicates(object):
+    """Keep track of IDs requested more than once, so they are downloaded once and copied to every requested name.
+
+    Duplicates are found while the IDs are read, so the list is still streamed
+    in. Copies are made once the download of the first request is finished.
+    """
+
+    __slots__ = (
+        'config',
+        'done',
+        'prefix',
+        'requests',
+    )
+
+    def __init__(self, config, prefix=None):
+        self.config = config
+        self.prefix = prefix
+        # normalised ID: [(index, requested ID), ...] with the first request first
+        self.requests = {}
+        # normalised IDs whose downloads are finished
+        self.done = set()
+
+    def unique(self, dl_ids):
+        """Lazily yield the normalised IDs requested for the first time."""
+        # types: iterable of strings -> iterator of strings
+        for index, requested, dl_id, first in iter_deduplicated(dl_ids):
+            if first:
+                self.requests[dl_id] = [(index, requested)]
+                _check_molecule(dl_id, self.config)
+                yield dl_id
+            elif dl_id in self.done:
+                self._copy(dl_id, index, requested)
+            else:
+                self.requests[dl_id].append((index, requested))
+
+    def filename(self, dl_id):
+        """Get the file name, without file ending, to download a normalised ID to."""
+        # types: string -> string
+        return _requested_filename(*self.requests[dl_id][0], prefix=self.prefix)
+
+    def finished(self, batch):
+        """Copy the files of a finished batch to the names of all other requests for them so far."""
+        # types: list of strings -> None
+        for dl_id in batch:
+            self.done.add(dl_id)
+            first, others = self.requests[dl_id][0], self.requests[dl_id][1:]
+            # only the first request is needed from now on
+            self.requests[dl_id] = [first]
+            for index, requested in others:
+                self._copy(dl_id, index, requested)
+
+    def _copy(self, dl_id, index, requested):
+        """Copy the file downloaded for a normalised ID to the name of another request for it."""
+        # types: string, int, string -> None
+        source = _output_filename(dl_id, self.config, self.filename(dl_id))
+        target = _output_filename(dl_id, self.config, _requested_filename(index, requested, prefix=self.prefix))
+        if target != source and os.path.exists(source):
+            shutil.copyfile(source, target)
+
+
+def _check_molecules(dl_ids, config):
+    """Lazily pass on IDs, warning about those that look like they belong to a different database."""
+    # types: iterable of strings, Config -> iterator of strings
+    for dl_id in dl_ids:
+        _check_molecule(dl_id, config)
+        yield dl_id
+
+
+def _check_molecule(dl_id, config):
+    """Warn if an ID looks like it belongs to a different database."""
+    # types: string, Config -> None
+    molecule = guess_molecule(dl_id)
+    if molecule is not None and molecule != config.molecule:
+        print("Warning: {} looks like a {} accession, but downloading from the {} database".format(
+            dl_id, molecule, config.molecule), file=sys.stderr)
+
+
+def _requested_filename(index, dl_id, prefix=None):
+    """Get the file name, without file ending, for the ID requested at index."""
+    # types: int, string, string -> string
+    if prefix is not None:
+        return "{fn}_{i}".format(fn=prefix, i=index)
+    return _safe_id(dl_id)
+
+
+def _download_combined(tasks, config, out):
+    """Download all batches into a single output file, keeping the order of the IDs."""
+    # types: iterable of (int, list of strings, list of strings, HistoryPage), Config, string -> None
+    binary = _writes_raw(config)
+    journal = Journal(out, resume=config.resume, binary=binary, compress=config.compress)
+    if journal.finished:
+        config.emit("Skipping {}, already downloaded\n".format(out))
+        return
+
+    with journal:
+        if config.jobs == 1:
+            for start, batch, _, history in tasks:
+                key = "{} {}".format(start, ",".join(batch))
+                if journal.is_done(key):
+                    continue
+                download_to_handle(",".join(batch), config, journal.handle, journal, scope=key + ' ', history=history)
+                journal.mark_done(key)
+            return
+
+        # Download batches to separate uncompressed part files in parallel, then copy them over in order.
+        part_dir = None
+        if journal.direct:
+            part_dir = tempfile.mkdtemp(prefix='ncbi-acc-download-')
+
+        def calls():
+            for start, batch, _, history in tasks:
+                key = "{} {}".format(start, ",".join(batch))
+                if journal.is_done(key):
+                    continue
+                if part_dir is None:
+                    part_name = "{}.{}.batch".format(journal.part_name, start)
+                else:
+                    part_name = os.path.join(part_dir, "{}.batch".format(start))
+                yield (key, part_name), (",".join(batch), config, part_name, None, history)
+
+        try:
+            with ThreadPoolExecutor(max_workers=config.jobs) as executor:
+                for (key, part_name), future in ordered_map(executor, _download_journaled, calls(), 2 * config.jobs):
+                    future.result()
+                    with open(part_name, 'rb' if binary else 'r') as part:
+                        shutil.copyfileobj(part, journal.handle)
+                    os.remove(part_name)
+                    journal.mark_done(key)
+        finally:
+            if part_dir is not None:
+                shutil.rmtree(part_dir, ignore_errors=True)
+
+
+def download_regions(regions, config, prefix=None, out=None):
+    """Download regions of accessions, merging regions close to each other into a single request.
+
+    FASTA regions on the same accession less than config.region_slack bases
+    apart are downloaded as one range and cut apart locally, see
+    region_slack(). Each region is written to its own file, unless all of
+    them go to out.
+    """
+    # types: iterable of Region, Config, string, string -> None
+    if config.format not in REGION_FORMATS:
+        raise ValueError("Can't download regions in {} format".format(config.format))
+    if config.range != 'none' or config.recursive or config.history:
+        raise ValueError("Regions can't be combined with a range, recursive or history server downloads")
+
+    groups = merge_regions(regions, region_slack(config))
+
+    if prefix is None and out is not None:
+        journal = Journal(out, resume=config.resume, compress=config.compress)
+        if journal.finished:
+            config.emit("Skipping {}, already downloaded\n".format(out))
+            return
+        with journal:
+            pending = [group for group in groups if not journal.is_done(str(group))]
+            for group, pieces in _download_region_groups(pending, config):
+                journal.handle.writelines(text for _, text in pieces)
+                journal.mark_done(str(group))
+        return
+
+    journals = {}
+    for group in groups:
+        for index, region in group.regions:
+            filename = str(region).replace(':', '_') if prefix is None else "{}_{}".format(prefix, index)
+            outfile_name = _generate_filename(build_params(region.accession, config), filename, config.compress)
+            journals[index] = Journal(outfile_name, resume=config.resume, compress=config.compress)
+
+    pending = []
+    for group in groups:
+        if all(journals[index].finished for index, _ in group.regions):
+            config.emit("Skipping {}, already downloaded\n".format(group))
+            continue
+        pending.append(group)
+
+    for _, pieces in _download_region_groups(pending, config):
+        for index, text in pieces:
+            with journals[index] as journal:
+                journal.handle.write(text)
+
+
+def _download_region_groups(groups, config):
+    """Download RegionGroups, running up to config.jobs downloads at once.
+
+    Yields (RegionGroup, list of (region index, record text)) tuples in the order of the groups.
+    """
+    # types: list of RegionGroup, Config -> iterator of (RegionGroup, list of (int, string))
+    if config.jobs == 1:
+        for group in groups:
+            yield group, _download_region_group(group, config)
+        return
+
+    with ThreadPoolExecutor(max_workers=config.jobs) as executor:
+        calls = ((group, (group, config)) for group in groups)
+        for group, future in ordered_map(executor, _download_region_group, calls, 2 * config.jobs):
+            yield group, future.result()
+
+
+def _download_region_group(group, config):
+    """Download the range covered by a RegionGroup and cut out all its regions."""
+    # types: RegionGroup, Config -> list of (int, string)
+    url = get_url_by_format(config)
+    params = build_params(group.accession, config, seq_range=(group.start + 1, group.end))
+
+    handle = StringIO()
+    fetch_and_write(url, params, handle, str(group), config, _validate_and_write)
+    record = next(iter_records(handle.getvalue().splitlines(True), config.format), None)
+    if record is None:
+        raise DownloadError("No record downloaded for {}".format(group))
+    return [(index, cut_region(record, group, region, config.format)) for index, region in group.regions]
+
+
+def download_split_records(dl_ids, config, directory, shard_depth=0):
+    """Download IDs in batches, writing every record to its own file in directory, named after its accession.
+
+    Records are split off the responses while downloading. With a shard_depth,
+    the files are spread over subdirectories, see split.record_path(). With
+    config.resume, IDs with a version whose file already exists are skipped.
+    """
+    # types: iterable of strings, Config, string, int -> None
+    if config.format not in SPLITTABLE_FORMATS:
+        raise ValueError("Can't split records in {} format".format(config.format))
+    if not 0 <= shard_depth <= MAX_SHARD_DEPTH:
+        raise ValueError("Shard depth needs to be between 0 and {}".format(MAX_SHARD_DEPTH))
+
+    if config.dedupe:
+        dl_ids = _check_molecules(iter_unique(dl_ids), config)
+    if config.resume:
+        dl_ids = _skip_existing_records(dl_ids, config, directory, shard_depth)
+
+    if config.history:
+        batches = ((batch, history) for _, batch, history in iter_history_batches(dl_ids, config))
+    else:
+        batches = ((batch, None) for _, batch in iter_batches(dl_ids, config.batch_size))
+
+    if config.jobs == 1:
+        for batch, history in batches:
+            _download_split_batch(batch, config, directory, shard_depth, history)
+        return
+
+    with ThreadPoolExecutor(max_workers=config.jobs) as executor:
+        calls = ((None, (batch, config, directory, shard_depth, history)) for batch, history in batches)
+        for _, future in ordered_map(executor, _download_split_batch, calls, 2 * config.jobs):
+            future.result()
+
+
+def _download_split_batch(dl_ids, config, directory, shard_depth, history=None):
+    """Download a batch of IDs, writing every record to its own file."""
+    # types: list of strings, Config, string, int, HistoryPage -> None
+    dl_id = ",".join(dl_ids)
+    files = RecordFiles(directory, _file_ending(build_params(dl_id, config), config.compress), shard_depth,
+                        config.compress)
+    with RecordSplitter(config.format, files) as splitter:
+        download_to_handle(dl_id, config, splitter, history=history)
+
+
+def _skip_existing_records(dl_ids, config, directory, shard_depth):
+    """Lazily filter out IDs whose record was already downloaded.
+
+    Files are named after the accession and version of their records, so only
+    IDs with a version can be found.
+    """
+    # types: iterable of strings, Config, string, int -> iterator of strings
+    file_ending = _file_ending(build_params('', config), config.compress)
+    for dl_id in dl_ids:
+        filename = record_path(directory, dl_id.strip().upper(), file_ending, shard_depth)
+        if os.path.isfile(filename):
+            config.emit("Skipping {}, already downloaded\n".format(filename))
+            continue
+        yield dl_id
+
+
 def download_to_file(dl_id, config, filename=None, append=False):
     """Download a single ID from NCBI and store it to a file."""
     # types: string, Config, string, bool -> None
-    mode = 'a' if append else 'w'
+    outfile_name = _output_filename(dl_id, config, filename)
+
+    if append:
+        binary = _writes_raw(config)
+        if config.compress is not None:
+            fh = open_compressed(outfile_name, 'a', config.compress, binary)
+        else:
+            fh = open(outfile_name, 'ab' if binary else 'a')
+        with fh:
+            download_to_handle(dl_id, config, fh)
+        return
+
+    _download_journaled(dl_id, config, outfile_name, config.compress)
+
+
+def _download_journaled(dl_id, config, filename, compress, history=None):
+    """Download an ID into a file via a journaled part file."""
+    # types: string, Config, string, string, HistoryPage -> None
+    journal = Journal(filename, resume=config.resume, binary=_writes_raw(config), compress=compress)
+    if journal.finished:
+        config.emit("Skipping {}, already downloaded\n".format(filename))
+        return
+
+    with journal:
+        download_to_handle(dl_id, config, journal.handle, journal, history=history)
+
+
+def _writes_raw(config):
+    """Check if downloads can be written to the output as raw bytes, without looking at the content."""
+    # types: Config -> bool
+    return config.extended_validation == 'none' and not config.recursive
+
+
+def download_to_handle(dl_id, config, handle, journal=None, scope='', history=None):
+    """Download an ID from NCBI and write it to an open file handle.
 
+    dl_id can also be several comma-separated IDs, or describe the records of
+    a HistoryPage. With a journal, WGS parts already written by an earlier run
+    are skipped, see wgs.write_wgs_parts().
+    """
+    # types: string, Config, file, Journal, string, HistoryPage -> None
     url = get_url_by_format(config)
-    params = build_params(dl_id, config)
+    params = build_params(dl_id, config, history)
 
-    try:
-        r = get_stream(url, params)
-        config.emit("Downloading {}\n".format(r.url))
-    except TooManyRequests as err:
-        config.emit("Server requested us to slow down, waiting {} seconds.".format(err.retry_after))
-        time.sleep(int(err.retry_after))
-        r = get_stream(url, params)
-        config.emit("Downloading {}\n".format(r.url))
+    def write(request, handle, dl_id, config):
+        _validate_and_write(request, handle, dl_id, config, journal, scope)
 
-    if config.keep_filename:
-        outfile_name = filename
-    else:
-        outfile_name = _generate_filename(params, filename)
+    # Failed WGS parts are retried on their own, so don't start over the whole record for them
+    fetch_and_write(url, params, handle, dl_id, config, write, retry_body=not config.recursive)
+
+
+def download_batch_to_files(dl_ids, config, filenames=None, history=None):
+    """Download multiple IDs in a single request and split the records into one file per ID.
+
+    If a HistoryPage is given, the records are fetched from the Entrez history server.
+    """
+    # types: list of strings, Config, list of strings, HistoryPage -> None
+    if filenames is None:
+        filenames = [None] * len(dl_ids)
+
+    # WGS expansion and GFF3 output don't map records back to IDs, so fetch these one by one
+    if len(dl_ids) < 2 or config.recursive or config.format not in SPLITTABLE_FORMATS:
+        for dl_id, filename in zip(dl_ids, filenames):
+            download_to_file(dl_id, config, filename)
+        return
+
+    outfile_names = [_output_filename(single_id, config, filename) for single_id, filename in zip(dl_ids, filenames)]
+    journals = [Journal(outfile_name, resume=config.resume, compress=config.compress)
+                for outfile_name in outfile_names]
+    if all(journal.finished for journal in journals):
+        config.emit("Skipping {}, already downloaded\n".format(", ".join(outfile_names)))
+        return
+
+    dl_id = ",".join(dl_ids)
+    url = get_url_by_format(config)
+    params = build_params(dl_id, config, history)
 
-    with open(outfile_name, mode) as fh:
-        _validate_and_write(r, fh, dl_id, config)
+    # split the records off while downloading, instead of holding the whole response in memory
+    outputs = _BatchOutputs(dl_ids, journals)
+    with RecordSplitter(config.format, outputs) as splitter:
+        fetch_and_write(url, params, splitter, dl_id, config, _validate_and_write)
+    outputs.close()
 
+    # NCBI leaves out withdrawn or unknown IDs instead of failing the whole request
+    missing = outputs.missing()
+    if missing:
+        raise DownloadError("NCBI Entrez returned no record for id(s) {}".format(",".join(missing)))
 
-def generate_url(dl_id, config):
+
+class _BatchOutputs(object):
+    """RecordSplitter sink writing the records of a batch to the journaled output files of their IDs."""
+
+    __slots__ = (
+        'dl_ids',
+        'journals',
+        '_match',
+        '_matched',
+        '_open',
+    )
+
+    def __init__(self, dl_ids, journals):
+        self.dl_ids = dl_ids
+        self.journals = journals
+        self._match = _record_matcher(dl_ids)
+        self._matched = set()
+        self._open = []
+
+    def start(self, accession):
+        index = self._match(accession)
+        self._matched.add(index)
+        journal = self.journals[index]
+        if journal not in self._open:
+            journal.__enter__()
+            self._open.append(journal)
+        return journal.handle
+
+    def finish(self):
+        pass
+
+    def discard(self):
+        # closing the journals as failed keeps their part files, opening them again starts those over
+        self._close(DownloadError)
+        self._match = _record_matcher(self.dl_ids)
+        self._matched = set()
+
+    def close(self):
+        """Move all output files to their final names."""
+        self._close(None)
+
+    def missing(self):
+        """Get the IDs no record was written for."""
+        # types: -> list of strings
+        return [dl_id for index, dl_id in enumerate(self.dl_ids) if index not in self._matched]
+
+    def _close(self, exc_type):
+        journals, self._open = self._open, []
+        for journal in journals:
+            journal.__exit__(exc_type, None, None)
+
+
+def _record_matcher(dl_ids):
+    """Create a function matching the accessions of records to the index of the IDs they were requested by.
+
+    Records are matched by accession first, anything that can't be matched
+    (e.g. IDs given as GI numbers) goes to the first ID without a record yet.
+    """
+    # types: list of strings -> callable
+    id_map = {}
+    for index, dl_id in enumerate(dl_ids):
+        id_map.setdefault(dl_id.strip().upper(), index)
+        id_map.setdefault(strip_version(dl_id.strip()), index)
+
+    seen = set()
+    last = [0]
+
+    def match(accession):
+        # types: string -> int
+        index = None
+        if accession:
+            index = id_map.get(accession.upper(), id_map.get(strip_version(accession)))
+        if index is None:
+            index = next((i for i in range(len(dl_ids)) if i not in seen), last[0])
+        seen.add(index)
+        last[0] = index
+        return index
+
+    return match
+
+
+def generate_url(dl_id, config, seq_range=None):
     """Generate the Entrez URL to download a file using a separate tool"""
-    # types: string, Config -> string
+    # types: string, Config, (int, int) -> string
 
     url = get_url_by_format(config)
-    params = build_params(dl_id, config)
+    params = build_params(dl_id, config, seq_range=seq_range)
 
     # remove the tool field, some other tool will do the download
     del params['tool']
@@ -144,16 +810,23 @@ def generate_url(dl_id, config):
     return "?".join([url, encoded_params])
 
 
-def _generate_filename(params, filename):
-    safe_ids = params['id'][:20].replace(' ', '_')
-    file_ending = '.fa'
+def _output_filename(dl_id, config, filename=None):
+    """Get the name of the file an ID is downloaded to."""
+    # types: string, Config, string -> string
+    if config.keep_filename:
+        return filename
+    return _generate_filename(build_params(dl_id, config), filename, config.compress)
 
-    if params.get('rettype') == 'gbwithparts':
-        file_ending = '.gbk'
-    elif params.get('rettype') == 'ft':
-        file_ending = '.ft'
-    elif params.get('report') == 'gff3':
-        file_ending = '.gff'
+
+def _safe_id(dl_id):
+    """Turn an ID into something usable as a file name."""
+    # types: string -> string
+    return dl_id[:20].replace(' ', '_')
+
+
+def _generate_filename(params, filename, compress=None):
+    safe_ids = _safe_id(params['id'])
+    file_ending = _file_ending(params, compress)
 
     if filename:
         outfile_name = "{filename}{ending}".format(filename=filename, ending=file_ending)
@@ -163,21 +836,50 @@ def _generate_filename(params, filename):
     return outfile_name
 
 
-def _validate_and_write(request, orig_handle, dl_id, config):
-    if config.extended_validation != 'none' or config.recursive:
-        handle = StringIO()
-    else:
-        handle = orig_handle
+def _file_ending(params, compress=None):
+    """Get the file ending for downloads with these request parameters."""
+    # types: dict, string -> string
+    file_ending = '.fa'
+    if params.get('rettype') == 'gbwithparts':
+        file_ending = '.gbk'
+    elif params.get('rettype') == 'ft':
+        file_ending = '.ft'
+    elif params.get('report') == 'gff3':
+        file_ending = '.gff'
 
+    if compress is not None:
+        file_ending += FILE_ENDINGS[compress]
+    return file_ending
+
+
+def _validate_and_write(request, orig_handle, dl_id, config, journal=None, scope=''):
+    if config.extended_validation == 'none' and not config.recursive:
+        write_stream(request, orig_handle, dl_id, config)
+        return
+
+    if config.extended_validation == 'none' or config.format in SPLITTABLE_FORMATS:
+        # Validate and expand records one at a time as they arrive, instead of buffering the whole download
+        lines = iter_lines(iter_stream(request, dl_id, config))
+        if config.recursive and config.format == 'genbank':
+            # validates the records after replacing WGS records by their parts, not the WGS records themselves
+            count = write_wgs_parts(lines, orig_handle, config, journal, scope)
+            if not count and config.extended_validation != 'none':
+                raise ValidationError("Sequence(s) downloaded for {} failed to load: no seq".format(dl_id))
+            return
+        if config.extended_validation != 'none':
+            records = iter_validated(iter_records(lines, config.format), config.format,
+                                     config.extended_validation, dl_id, config.validation_executor,
+                                     2 * config.validation_jobs, config.metrics)
+            lines = (line for record in records for line in record.splitlines(True))
+        orig_handle.writelines(lines)
+        return
+
+    handle = StringIO()
     write_stream(request, handle, dl_id, config)
-
-    if config.recursive:
-        downloaded = download_wgs_parts(handle, config)
-        handle = downloaded
-
-    if config.extended_validation != 'none':
-        if not run_extended_validation(handle, config.format, config.extended_validation):
-            raise ValidationError("Sequence(s) downloaded for {} failed to load.".format(dl_id))
-
-    if config.extended_validation != 'none' or config.recursive:
-        orig_handle.write(handle.getvalue())
+    start = time.perf_counter()
+    valid = run_extended_validation(handle, config.format, config.extended_validation)
+    config.metrics.record('validation', id=dl_id, level=config.extended_validation, records=1,
+                          failures=0 if valid else 1, seconds=time.perf_counter() - start)
+    if not valid:
+        raise ValidationError("Sequence(s) downloaded for {} failed to load.".format(dl_id))
+    orig_handle.write(handle.getvalue())
@@ -15,15 +15,24 @@
 
 from __future__ import print_function
 
-from collections import OrderedDict
+from collections import (
+    deque,
+    OrderedDict,
+)
+from datetime import timedelta
 from http.client import IncompleteRead
+from io import TextIOBase
+import re
 import requests
+from requests.adapters import HTTPAdapter
 import sys
+import time
 
 from ncbi_acc_download.errors import (
     BadPatternError,
     DownloadError,
     InvalidIdError,
+    NetworkError,
     TooManyRequests,
 )
 
@@ -41,6 +50,45 @@ ERROR_PATTERNS = (
     u'Failed to understand id',
 )
 
+ERROR_PATTERN_RE = re.compile(u'|'.join(re.escape(pattern) for pattern in ERROR_PATTERNS))
+ERROR_PATTERN_BYTES_RE = re.compile(ERROR_PATTERN_RE.pattern.encode('ascii'))
+# Patterns can span chunk boundaries, so keep enough of the previous chunk around to find them
+ERROR_PATTERN_OVERLAP = max(len(pattern) for pattern in ERROR_PATTERNS) - 1
+# Every error pattern contains one of these, so chunks without any of them can't contain an error
+ERROR_PATTERN_ANCHORS = (u'erver', u'ateway', u'ID list', u'unavailable', u'Failed to ')
+ERROR_PATTERN_BYTES_ANCHORS = tuple(anchor.encode('ascii') for anchor in ERROR_PATTERN_ANCHORS)
+# Characters making up the sequence parts of GenBank and FASTA files, none of the error patterns consist only of these
+SEQUENCE_CHARS = b'ACGTNacgtn0123456789 \n'
+# API keys are secret, so they are left out of the URLs recorded in the metrics
+API_KEY_RE = re.compile(r'(api_key=)[^&]*')
+
+# Error messages caused by NCBI being overloaded rather than by a bad request
+TRANSIENT_PATTERNS = frozenset((
+    u'Error reading from remote server',
+    u'Bad gateway',
+    u'Bad Gateway',
+    u'server is temporarily unable to service your request',
+    u'Service unavailable',
+    u'Server Error',
+    u'Resource temporarily unavailable',
+))
+
+# Default number of bytes to read from the network at once
+CHUNK_SIZE = 1024 * 1024
+# Minimum number of seconds between two progress dots
+PROGRESS_INTERVAL = 1.0
+
+
+def create_session(pool_size=10):
+    """Create a HTTP session keeping connections to NCBI alive between requests."""
+    # types: int -> requests.Session
+    session = requests.Session()
+    # All requests go to the same host, so only one pool is needed, but it needs to fit all parallel downloads
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
 
 def get_url_by_format(config):
     """Get URL depending on the format."""
@@ -52,19 +100,31 @@ def get_url_by_format(config):
     return config.entrez_url
 
 
-def build_params(dl_id, config):
-    """Build the query parameters for the Entrez query."""
+def build_params(dl_id, config, history=None, seq_range=None):
+    """Build the query parameters for the Entrez query.
+
+    If a HistoryPage is given, the IDs are fetched from the Entrez history server instead.
+    A (from, to) seq_range tuple of 1-based positions overrides config.range.
+    """
     params = OrderedDict(tool='ncbi-acc-download', retmode='text')
 
-    # delete / characters and as NCBI ignores IDs after #, do the same.
-    params['id'] = dl_id
+    if history is None:
+        # delete / characters and as NCBI ignores IDs after #, do the same.
+        params['id'] = dl_id
+    else:
+        params['WebEnv'] = history.webenv
+        params['query_key'] = history.query_key
+        params['retstart'] = history.retstart
+        params['retmax'] = history.retmax
 
     params['db'] = config.molecule
 
     if config.api_key != 'none':
         params['api_key'] = config.api_key
 
-    if config.range != 'none':
+    if seq_range is not None:
+        params['from'], params['to'] = seq_range
+    elif config.range != 'none':
         rli = config.range.split(":")
         if len(rli)==1:
             rli = config.range.split("..")
@@ -90,40 +150,239 @@ def build_params(dl_id, config):
     return params
 
 
-def get_stream(url, params):
+def get_stream(url, params, config=None):
     """Get the actual streamed request from NCBI."""
+    cache = None if config is None else config.cache
+    if 'WebEnv' in params:
+        # history server sessions expire, so responses for them can never be reused
+        cache = None
+    if cache is not None:
+        cached = cache.get(url, params)
+        if cached is not None:
+            return cached
+        if config.offline:
+            raise DownloadError("Record(s) with id(s) {} not in the cache and running offline".format(params['id']))
+
+    getter = requests.get
+    metrics = None
+    if config is not None:
+        wait = config.limiter.acquire()
+        getter = config.session.get
+        metrics = config.metrics
+        if wait > 0:
+            metrics.record('throttle', seconds=wait)
+
+    start = time.perf_counter()
     try:
-        r = requests.get(url, params=params, stream=True)
+        r = getter(url, params=params, stream=True)
     except (requests.exceptions.RequestException, IncompleteRead) as e:
-        print("Failed to download {!r} from NCBI".format(params['id']), file=sys.stderr)
-        raise DownloadError(str(e))
+        print("Failed to download {!r} from NCBI".format(_describe(params)), file=sys.stderr)
+        if metrics is not None:
+            metrics.record('request', id=_describe(params), url=url, status=None, cached=False, ttfb=None,
+                           seconds=time.perf_counter() - start, bytes=0, throughput=None, error=type(e).__name__)
+        raise NetworkError(str(e)) from e
 
     if r.status_code != requests.codes.ok:
+        if metrics is not None:
+            metrics.record('request', id=_describe(params), url=url, status=r.status_code, cached=False,
+                           ttfb=time.perf_counter() - start, seconds=time.perf_counter() - start, bytes=0,
+                           throughput=None, error="HTTP {}".format(r.status_code))
         if r.status_code == 429:
             retry_after = r.headers.get("retry-after")
             print("Too many requests, please consider using --api-key parameter"
                   " (see https://www.ncbi.nlm.nih.gov/books/NBK25497/).")
             raise TooManyRequests("Blocked at NCBI Enterz API for too many requests", retry_after)
 
-        print("Failed to download file with id {} from NCBI".format(params['id']), file=sys.stderr)
-        raise InvalidIdError("Download failed with return code: {}".format(r.status_code), params["id"], r.status_code)
+        print("Failed to download file with id {} from NCBI".format(_describe(params)), file=sys.stderr)
+        raise InvalidIdError("Download failed with return code: {}".format(r.status_code), _describe(params),
+                             r.status_code)
+
+    if cache is not None:
+        return cache.wrap(r, url, params)
 
     return r
 
 
-def write_stream(request, handle, dl_id, config):
-    """Write all chunks of the request to the handle."""
-    # use a chunk size of 4k, as that's what most filesystems use these days
+def _describe(params):
+    """Describe the records requested with params for error messages."""
+    # types: dict -> string
+    if 'id' in params:
+        return params['id']
+    return "history query {} records {}-{}".format(params['query_key'], params['retstart'] + 1,
+                                                   params['retstart'] + params['retmax'])
+
+
+def find_error_pattern(chunk, previous=u''):
+    """Find an error pattern in a chunk, or spanning the end of the previous chunk and this one.
+
+    Works on both text and bytes chunks, the pattern found is always returned as text.
+    """
+    # types: string or bytes, string or bytes -> string
+    regex = ERROR_PATTERN_BYTES_RE if isinstance(chunk, bytes) else ERROR_PATTERN_RE
+    match = None
+    if _may_contain_error(chunk):
+        match = regex.search(chunk)
+    if match is None and previous:
+        boundary = previous[-ERROR_PATTERN_OVERLAP:] + chunk[:ERROR_PATTERN_OVERLAP]
+        match = regex.search(boundary)
+    if match is None:
+        return None
+    pattern = match.group(0)
+    if isinstance(pattern, bytes):
+        pattern = pattern.decode('ascii')
+    return pattern
+
+
+def _may_contain_error(chunk):
+    """Cheaply rule out chunks that can't contain an error pattern."""
+    # types: string or bytes -> bool
+    if isinstance(chunk, bytes):
+        raw = chunk
+        anchors = ERROR_PATTERN_BYTES_ANCHORS
+    else:
+        try:
+            raw = chunk.encode('ascii')
+        except UnicodeEncodeError:
+            return True
+        anchors = ERROR_PATTERN_ANCHORS
+
+    # Sequence data makes up most of large downloads, deleting all sequence characters is a single fast C-level pass
+    if not raw.translate(None, SEQUENCE_CHARS):
+        return False
+
+    for anchor in anchors:
+        if anchor in chunk:
+            return True
+    return False
+
+
+def iter_stream(request, dl_id, config, binary=False):
+    """Iterate over the chunks of the request, checking them for error messages.
+
+    Chunks are decoded to text unless binary is set, in which case the raw bytes
+    are passed on without any decoding. Once the request is done, its timings
+    and size are recorded in config.metrics.
+    """
+    previous = b'' if binary else u''
+    last_progress = None
+    start = time.perf_counter()
+    size = 0
+    error = None
     try:
-        for chunk in request.iter_content(4096, decode_unicode=True):
-            config.emit(u'.')
-            for pattern in ERROR_PATTERNS:
-                if pattern in chunk:
-                    raise BadPatternError("Failed to download record(s) with id(s) {} from NCBI: {}".format(
-                        dl_id, pattern))
-
-            handle.write(chunk)
+        for chunk in request.iter_content(config.chunk_size, decode_unicode=not binary):
+            size += len(chunk)
+            # Only print progress once in a while, printing and flushing for every chunk is slow
+            now = time.monotonic()
+            if last_progress is None or now - last_progress >= PROGRESS_INTERVAL:
+                config.emit(u'.')
+                last_progress = now
+
+            pattern = find_error_pattern(chunk, previous)
+            if pattern is not None:
+                raise BadPatternError("Failed to download record(s) with id(s) {} from NCBI: {}".format(
+                    dl_id, pattern), pattern)
+
+            if len(chunk) >= ERROR_PATTERN_OVERLAP:
+                previous = chunk
+            else:
+                previous = (previous + chunk)[-ERROR_PATTERN_OVERLAP:]
+            yield chunk
     except requests.exceptions.ChunkedEncodingError as err:
         print("Download of {!r} aborted: {}".format(dl_id, str(err)), file=sys.stderr)
-        raise DownloadError(str(err))
+        error = type(err).__name__
+        raise NetworkError(str(err)) from err
+    except BadPatternError as err:
+        error = err.pattern
+        raise
+    except GeneratorExit:
+        # the caller stopped reading, e.g. because a record failed validation
+        error = 'aborted'
+        raise
+    finally:
+        _record_request(request, dl_id, config, time.perf_counter() - start, size, error)
     config.emit(u'\n')
+
+
+def _record_request(request, dl_id, config, seconds, size, error):
+    """Record the timings and size of a finished request."""
+    # types: Response, string, Config, float, int, string -> None
+    # requests measures the time until the response headers arrived, cached responses don't have that
+    elapsed = getattr(request, 'elapsed', None)
+    ttfb = None
+    if isinstance(elapsed, timedelta):
+        ttfb = elapsed.total_seconds()
+        seconds += ttfb
+    url = API_KEY_RE.sub(r'\1...', str(request.url))
+    config.metrics.record('request', id=dl_id, url=url, status=request.status_code,
+                          cached=ttfb is None, ttfb=ttfb, seconds=seconds, bytes=size,
+                          throughput=size / seconds if seconds > 0 else None, error=error)
+
+
+def write_stream(request, handle, dl_id, config):
+    """Write all chunks of the request to the handle.
+
+    Binary handles get the raw bytes from the network, skipping decoding and re-encoding the text.
+    """
+    binary = not isinstance(handle, TextIOBase)
+    for chunk in iter_stream(request, dl_id, config, binary):
+        handle.write(chunk)
+
+
+def fetch_and_write(url, params, handle, dl_id, config, write=write_stream, retry_body=True):
+    """Download a request and write it to the handle, retrying transient failures.
+
+    Failures while starting the request are always retried according to
+    config.retry. Failures while reading the response are only retried if
+    retry_body is set and the handle is seekable, so the partial output can be
+    thrown away first.
+    """
+    # types: string, dict, file, string, Config, callable, bool -> None
+    start = None
+    if retry_body and handle.seekable():
+        start = handle.tell()
+
+    attempt = 0
+    while True:
+        started = False
+        try:
+            r = get_stream(url, params, config)
+            started = True
+            config.emit("Downloading {}\n".format(r.url))
+            write(r, handle, dl_id, config)
+            return
+        except (DownloadError, InvalidIdError) as err:
+            if started and start is None:
+                raise
+            if not config.retry.should_retry(err, attempt):
+                raise
+            delay = config.retry.delay(err, attempt)
+            config.metrics.record('retry', id=dl_id, attempt=attempt + 1, error=type(err).__name__, delay=delay,
+                                  too_many_requests=isinstance(err, TooManyRequests))
+
+        if started:
+            handle.seek(start)
+            handle.truncate()
+        attempt += 1
+        config.emit("Download of {} failed, retrying in {:.1f} seconds\n".format(dl_id, delay))
+        time.sleep(delay)
+
+
+def ordered_map(executor, func, calls, window):
+    """Submit func calls to the executor, yielding (tag, future) tuples in submission order.
+
+    calls is an iterable of (tag, args) tuples. At most window calls are pending
+    at any time, so calls is consumed lazily. Calls still pending when the
+    caller stops iterating are cancelled.
+    """
+    # types: Executor, callable, iterable of (object, tuple), int -> iterator of (object, Future)
+    pending = deque()
+    try:
+        for tag, args in calls:
+            pending.append((tag, executor.submit(func, *args)))
+            if len(pending) >= window:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        for _, future in pending:
+            future.cancel()
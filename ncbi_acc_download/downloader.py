@@ -0,0 +1,165 @@
+# Copyright 2017,2018 Kai Blin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Library interface downloading records into memory instead of files."""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+
+from ncbi_acc_download.core import (
+    Config,
+    download_ids,
+    download_to_handle,
+    generate_url,
+    iter_batches,
+    request_batch_size,
+)
+from ncbi_acc_download.download import ordered_map
+from ncbi_acc_download.history import iter_history_batches
+from ncbi_acc_download.records import (
+    get_accession,
+    iter_records,
+    SPLITTABLE_FORMATS,
+)
+from ncbi_acc_download.validate import (
+    BIOPYTHON_FORMATS,
+    HAVE_BIOPYTHON,
+)
+
+if HAVE_BIOPYTHON:
+    from Bio import SeqIO
+
+
+class Downloader(object):
+    """Download records from NCBI for use in other Python code.
+
+    Holds the HTTP session, rate limiter and cache of a Config, so all
+    downloads share them. Takes either a Config or the keyword arguments to
+    create one with.
+
+        with Downloader(format='fasta', api_key=key) as downloader:
+            for accession, record in downloader.fetch(['NC_000913', 'NC_007194']):
+                ...
+    """
+
+    __slots__ = (
+        'config',
+    )
+
+    def __init__(self, config=None, **kwargs):
+        if config is None:
+            config = Config(**kwargs)
+        elif kwargs:
+            raise ValueError("Pass either a Config or the settings to create one, not both")
+        self.config = config
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        """Close the HTTP connections, stop the validation processes and WGS threads and close the stats file."""
+        # types: -> None
+        self.config.session.close()
+        self.config.metrics.close()
+        if self.config.validation_executor is not None:
+            self.config.validation_executor.shutdown()
+        if self.config.wgs_executor is not None:
+            self.config.wgs_executor.shutdown()
+
+    def fetch(self, dl_ids):
+        """Download IDs, yielding (accession, record text) tuples in the order of the IDs.
+
+        IDs are downloaded config.batch_size at a time, up to config.jobs
+        batches at once, and are only read from dl_ids when needed. GFF3 files
+        can't be split into records, these are yielded whole, together with the
+        ID they were requested by.
+        """
+        # types: iterable of strings -> iterator of (string, string)
+        config = self.config
+        if config.history and config.format in SPLITTABLE_FORMATS:
+            batches = iter_history_batches(dl_ids, config)
+        else:
+            batches = ((None, batch, None) for _, batch in iter_batches(dl_ids, request_batch_size(config)))
+
+        if config.jobs == 1:
+            for _, batch, history in batches:
+                for entry in _fetch_batch(batch, config, history):
+                    yield entry
+            return
+
+        with ThreadPoolExecutor(max_workers=config.jobs) as executor:
+            calls = ((None, (batch, config, history)) for _, batch, history in batches)
+            for _, future in ordered_map(executor, _fetch_batch, calls, 2 * config.jobs):
+                for entry in future.result():
+                    yield entry
+
+    def fetch_records(self, dl_ids):
+        """Download IDs, yielding (accession, Biopython SeqRecord) tuples in the order of the IDs."""
+        # types: iterable of strings -> iterator of (string, SeqRecord)
+        if not HAVE_BIOPYTHON:
+            raise ValueError("Loading records requires Biopython")
+        if self.config.format not in BIOPYTHON_FORMATS:
+            raise ValueError("Can't load records in {} format".format(self.config.format))
+
+        for accession, text in self.fetch(dl_ids):
+            yield accession, SeqIO.read(StringIO(text), self.config.format)
+
+    async def afetch(self, dl_ids):
+        """Download IDs like fetch, without blocking the event loop.
+
+        The downloads run in a background thread, so dl_ids has to be a
+        regular iterable.
+        """
+        # types: iterable of strings -> async iterator of (string, string)
+        loop = asyncio.get_running_loop()
+        # a single thread, so a cancelled step is finished before the downloads get cleaned up
+        executor = ThreadPoolExecutor(max_workers=1)
+        entries = self.fetch(dl_ids)
+        done = object()
+        try:
+            while True:
+                entry = await loop.run_in_executor(executor, next, entries, done)
+                if entry is done:
+                    return
+                yield entry
+        finally:
+            executor.submit(entries.close)
+            executor.shutdown(wait=False)
+
+    def download(self, dl_ids, prefix=None, out=None):
+        """Download IDs to files, like the command line tool does."""
+        # types: iterable of strings, string, string -> None
+        download_ids(dl_ids, self.config, prefix=prefix, out=out)
+
+    def url(self, dl_id):
+        """Get the URL to download an ID with."""
+        # types: string -> string
+        return generate_url(dl_id, self.config)
+
+
+def _fetch_batch(dl_ids, config, history=None):
+    """Download a batch of IDs into memory, returning a list of (accession, record text) tuples."""
+    # types: list of strings, Config, HistoryPage -> list of (string, string)
+    dl_id = ",".join(dl_ids)
+    handle = StringIO()
+    download_to_handle(dl_id, config, handle, history=history)
+
+    if config.format not in SPLITTABLE_FORMATS:
+        return [(dl_id, handle.getvalue())]
+    handle.seek(0)
+    return [(get_accession(record, config.format), record) for record in iter_records(handle, config.format)]
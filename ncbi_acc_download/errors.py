@@ -20,6 +20,12 @@ class DownloadError(RuntimeError):
     pass
 
 
+class NetworkError(DownloadError):
+    """Error thrown when the connection to NCBI fails or breaks off."""
+
+    pass
+
+
 class InvalidIdError(RuntimeError):
     """Error thrown when Entrez responds with a 4xx error (other than 429)."""
 
@@ -40,10 +46,17 @@ class TooManyRequests(DownloadError):
 class BadPatternError(DownloadError):
     """Error thrown when download file contains an error pattern."""
 
-    pass
+    def __init__(self, message, pattern=None):
+        super().__init__(message)
+        self.pattern = pattern
 
 
 class ValidationError(DownloadError):
-    """Error thrown when download file failes extended validation."""
+    """Error thrown when download file failes extended validation.
 
-    pass
+    failures lists the records that failed as (record number, accession, message) tuples.
+    """
+
+    def __init__(self, message, failures=()):
+        super().__init__(message)
+        self.failures = list(failures)
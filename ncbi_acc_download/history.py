@@ -0,0 +1,160 @@
+# Copyright 2017,2018 Kai Blin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Upload ID lists to the Entrez history server and fetch them page by page."""
+
+from __future__ import print_function
+
+from collections import OrderedDict
+from http.client import IncompleteRead
+import requests
+import sys
+import time
+from xml.etree import ElementTree
+
+from ncbi_acc_download.errors import (
+    DownloadError,
+    InvalidIdError,
+    NetworkError,
+    TooManyRequests,
+)
+
+EPOST_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/epost.fcgi'
+
+# Number of IDs uploaded with a single epost request, efetch can't return more than this per request either
+HISTORY_POST_SIZE = 10000
+
+
+class HistoryPage(object):
+    """A slice of an ID list stored on the Entrez history server."""
+
+    __slots__ = (
+        'query_key',
+        'retmax',
+        'retstart',
+        'webenv',
+    )
+
+    def __init__(self, webenv, query_key, retstart, retmax):
+        self.webenv = webenv
+        self.query_key = query_key
+        self.retstart = retstart
+        self.retmax = retmax
+
+    def __repr__(self):
+        return "HistoryPage({!r}, {!r}, {!r}, {!r})".format(self.webenv, self.query_key, self.retstart, self.retmax)
+
+
+def iter_history_batches(dl_ids, config):
+    """Upload IDs to the history server in large chunks, yielding the pages to fetch them in.
+
+    Yields (list of ID indices, list of IDs, HistoryPage) tuples with up to
+    config.batch_size IDs each. The server drops duplicate and unknown IDs, so
+    these are left out of the pages as well to keep them in line with what the
+    server returns.
+    """
+    # types: iterable of strings, Config -> iterator of (list of ints, list of strings, HistoryPage)
+    iterator = iter(dl_ids)
+    start = 0
+    while True:
+        chunk = []
+        for dl_id in iterator:
+            chunk.append(dl_id)
+            if len(chunk) >= HISTORY_POST_SIZE:
+                break
+        if not chunk:
+            return
+
+        posted = OrderedDict()
+        for index, dl_id in enumerate(chunk, start):
+            posted.setdefault(dl_id, index)
+        start += len(chunk)
+
+        webenv, query_key, invalid = post_ids(list(posted), config)
+        for dl_id in invalid:
+            print("NCBI Entrez did not recognise id {}, skipping it".format(dl_id), file=sys.stderr)
+            posted.pop(dl_id, None)
+
+        entries = list(posted.items())
+        for retstart in range(0, len(entries), config.batch_size):
+            page_entries = entries[retstart:retstart + config.batch_size]
+            page = HistoryPage(webenv, query_key, retstart, len(page_entries))
+            yield [index for _, index in page_entries], [dl_id for dl_id, _ in page_entries], page
+
+
+def post_ids(dl_ids, config):
+    """Upload IDs to the history server, retrying transient failures.
+
+    Returns the WebEnv and query_key to fetch the IDs with, and a list of the
+    IDs the server didn't recognise.
+    """
+    # types: list of strings, Config -> (string, string, list of strings)
+    data = OrderedDict(tool='ncbi-acc-download', db=config.molecule, id=",".join(dl_ids))
+    if config.api_key != 'none':
+        data['api_key'] = config.api_key
+
+    attempt = 0
+    while True:
+        try:
+            return _post(config.epost_url, data, config)
+        except (DownloadError, InvalidIdError) as err:
+            if not config.retry.should_retry(err, attempt):
+                raise
+            delay = config.retry.delay(err, attempt)
+            config.metrics.record('retry', id='epost', attempt=attempt + 1, error=type(err).__name__, delay=delay,
+                                  too_many_requests=isinstance(err, TooManyRequests))
+
+        attempt += 1
+        config.emit("Uploading IDs to NCBI failed, retrying in {:.1f} seconds\n".format(delay))
+        time.sleep(delay)
+
+
+def _post(url, data, config):
+    """Send a single epost request and parse the result."""
+    # types: string, dict, Config -> (string, string, list of strings)
+    wait = config.limiter.acquire()
+    if wait > 0:
+        config.metrics.record('throttle', seconds=wait)
+    config.emit("Uploading {} IDs to {}\n".format(data['id'].count(',') + 1, url))
+    start = time.perf_counter()
+    try:
+        r = config.session.post(url, data=data)
+    except (requests.exceptions.RequestException, IncompleteRead) as err:
+        print("Failed to upload IDs to NCBI", file=sys.stderr)
+        raise NetworkError(str(err)) from err
+    seconds = time.perf_counter() - start
+    config.metrics.record('request', id='epost', url=url, status=r.status_code, cached=False,
+                          ttfb=r.elapsed.total_seconds(), seconds=seconds, bytes=len(r.content),
+                          throughput=len(r.content) / seconds if seconds > 0 else None,
+                          error=None if r.status_code == requests.codes.ok else "HTTP {}".format(r.status_code))
+
+    if r.status_code != requests.codes.ok:
+        if r.status_code == 429:
+            print("Too many requests, please consider using --api-key parameter"
+                  " (see https://www.ncbi.nlm.nih.gov/books/NBK25497/).")
+            raise TooManyRequests("Blocked at NCBI Enterz API for too many requests", r.headers.get("retry-after"))
+        raise InvalidIdError("Upload failed with return code: {}".format(r.status_code), data['id'], r.status_code)
+
+    try:
+        root = ElementTree.fromstring(r.content)
+    except ElementTree.ParseError as err:
+        raise NetworkError("Failed to parse epost response: {}".format(err)) from err
+
+    webenv = root.findtext('WebEnv')
+    query_key = root.findtext('QueryKey')
+    if not webenv or not query_key:
+        message = root.findtext('ERROR') or "no WebEnv in epost response"
+        raise DownloadError("Failed to upload IDs to NCBI: {}".format(message))
+
+    invalid = [element.text for element in root.iterfind('InvalidIdList/Id') if element.text]
+    return webenv, query_key, invalid
@@ -0,0 +1,176 @@
+# Copyright 2017,2018 Kai Blin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measure where the time of a download run goes."""
+
+from collections import (
+    Counter,
+    OrderedDict,
+)
+import json
+import threading
+import time
+
+# Event fields that are added up for the summary
+SUMMED_FIELDS = ('bytes', 'delay', 'parts', 'records', 'seconds', 'ttfb')
+
+
+class Metrics(object):
+    """Collect measurements of a download run and pass them on to listeners.
+
+    Every measurement is an event, a dict with the event name under 'event',
+    the wall clock time under 'time' and further fields depending on the event:
+
+    request:    id, url, status, cached, ttfb, seconds, bytes, throughput, error
+    throttle:   seconds spent waiting for the rate limiter
+    retry:      id, attempt, error, delay, too_many_requests
+    validation: id, level, records, failures, seconds
+    wgs:        id, parts, seconds
+
+    Listeners are called with every event, one at a time.
+    """
+
+    __slots__ = (
+        'listeners',
+        '_latencies',
+        '_lock',
+        '_started',
+        '_totals',
+    )
+
+    def __init__(self):
+        self.listeners = []
+        self._latencies = []
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._totals = {}
+
+    def add_listener(self, listener):
+        """Call listener with every event recorded from now on."""
+        # types: callable -> None
+        self.listeners.append(listener)
+
+    def record(self, event, **fields):
+        """Record an event."""
+        # types: string, ... -> None
+        entry = OrderedDict(event=event, time=round(time.time(), 3))
+        entry.update(fields)
+        with self._lock:
+            totals = self._totals.setdefault(event, Counter())
+            totals['count'] += 1
+            for name in SUMMED_FIELDS:
+                if fields.get(name) is not None:
+                    totals[name] += fields[name]
+            if event == 'request':
+                if fields.get('error') is not None:
+                    totals['failed'] += 1
+                elif fields.get('cached'):
+                    totals['cached'] += 1
+                else:
+                    self._latencies.append(fields.get('seconds') or 0.0)
+                    totals['network_ttfb'] += fields.get('ttfb') or 0.0
+            elif event == 'retry' and fields.get('too_many_requests'):
+                totals['too_many_requests'] += 1
+                totals['too_many_requests_delay'] += fields.get('delay') or 0.0
+
+            for listener in self.listeners:
+                listener(entry)
+
+    def totals(self, event):
+        """Get the number of events and the sums of their fields."""
+        # types: string -> Counter
+        with self._lock:
+            return Counter(self._totals.get(event, ()))
+
+    def summary(self):
+        """Summarise the run so far in a few lines of text."""
+        # types: -> string
+        elapsed = time.perf_counter() - self._started
+        requests = self.totals('request')
+        lines = ["Downloaded {} in {} requests ({} failed, {} from the cache) in {:.1f} s, {}/s".format(
+            _format_size(requests['bytes']), requests['count'], requests['failed'], requests['cached'],
+            elapsed, _format_size(requests['bytes'] / elapsed if elapsed else 0))]
+
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if latencies:
+            lines.append("Request time: mean {:.2f} s, median {:.2f} s, 95th percentile {:.2f} s, "
+                         "mean time to first byte {:.2f} s".format(
+                             sum(latencies) / len(latencies), _percentile(latencies, 50),
+                             _percentile(latencies, 95), requests['network_ttfb'] / len(latencies)))
+
+        throttle = self.totals('throttle')
+        if throttle['count']:
+            lines.append("Waited {:.1f} s for the rate limit before {} requests".format(
+                throttle['seconds'], throttle['count']))
+
+        retries = self.totals('retry')
+        if retries['count']:
+            lines.append("Retried {} times, waiting {:.1f} s, {} times for too many requests ({:.1f} s)".format(
+                retries['count'], retries['delay'], retries['too_many_requests'],
+                retries['too_many_requests_delay']))
+
+        validation = self.totals('validation')
+        if validation['count']:
+            lines.append("Validated {} records in {:.1f} s".format(validation['records'], validation['seconds']))
+
+        wgs = self.totals('wgs')
+        if wgs['count']:
+            lines.append("Expanded {} WGS records into {} parts in {:.1f} s".format(
+                wgs['count'], wgs['parts'], wgs['seconds']))
+
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        """Close all listeners that need closing, like stats files."""
+        # types: -> None
+        for listener in self.listeners:
+            close = getattr(listener, 'close', None)
+            if close is not None:
+                close()
+
+
+class StatsFile(object):
+    """Listener writing events to a JSON lines file."""
+
+    __slots__ = (
+        'handle',
+    )
+
+    def __init__(self, filename):
+        # line buffered, so the stats of an interrupted run are kept
+        self.handle = open(filename, 'w', buffering=1)
+
+    def __call__(self, event):
+        self.handle.write(json.dumps(event) + "\n")
+
+    def close(self):
+        """Close the file."""
+        # types: -> None
+        self.handle.close()
+
+
+def _percentile(values, percent):
+    """Get a percentile of a sorted list of values."""
+    # types: list of floats, int -> float
+    return values[min(len(values) - 1, len(values) * percent // 100)]
+
+
+def _format_size(size):
+    """Format a number of bytes for humans."""
+    # types: float -> string
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024
+    return "{:.1f} GiB".format(size)
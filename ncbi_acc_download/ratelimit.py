@@ -0,0 +1,69 @@
+# Copyright 2017,2018 Kai Blin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Keep requests to NCBI within the allowed request rate."""
+
+import threading
+import time
+
+# Requests per second NCBI allows, see https://www.ncbi.nlm.nih.gov/books/NBK25497/
+DEFAULT_RATE = 3
+API_KEY_RATE = 10
+
+
+class RateLimiter(object):
+    """Thread-safe token bucket limiting the number of requests per second.
+
+    Callers that find the bucket empty reserve the next token anyway and sleep
+    until it becomes available, so waiting threads are served in order and the
+    rate is never exceeded.
+    """
+
+    __slots__ = (
+        'rate',
+        'capacity',
+        '_lock',
+        '_tokens',
+        '_last',
+    )
+
+    def __init__(self, rate, capacity=1):
+        """Set up a bucket refilling at rate tokens per second."""
+        if rate <= 0:
+            raise ValueError("Rate needs to be positive")
+        self.rate = rate
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._tokens = capacity
+        self._last = time.monotonic()
+
+    def acquire(self):
+        """Take a token from the bucket, waiting until one is available."""
+        # types: -> float
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    @classmethod
+    def for_api_key(cls, api_key):
+        """Get a limiter for the request rate NCBI allows with or without an API key."""
+        if api_key != 'none':
+            return cls(API_KEY_RATE)
+        return cls(DEFAULT_RATE)
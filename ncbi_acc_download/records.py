@@ -0,0 +1,107 @@
+# Copyright 2017,2018 Kai Blin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Split downloaded sequence files into individual records."""
+
+# Formats where we know how to find the record boundaries
+SPLITTABLE_FORMATS = {'fasta', 'genbank', 'featuretable'}
+
+RECORD_STARTS = {
+    'fasta': '>',
+    'featuretable': '>Feature',
+}
+
+
+def iter_lines(chunks):
+    """Turn a stream of text chunks into a stream of lines, keeping the line endings."""
+    # types: iterable of strings -> iterator of strings
+    rest = ''
+    for chunk in chunks:
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if rest:
+        yield rest
+
+
+def iter_records(lines, file_format):
+    """Group the lines of a sequence file into records."""
+    # types: iterable of strings, string -> iterator of strings
+    if file_format not in SPLITTABLE_FORMATS:
+        raise ValueError("Can't split records in {} format".format(file_format))
+
+    record = []
+    if file_format == 'genbank':
+        # GenBank records end with a // line, NCBI adds a blank line after it that still belongs to the record
+        ended = False
+        for line in lines:
+            if ended and line.strip():
+                yield ''.join(record)
+                record = []
+                ended = False
+            record.append(line)
+            if line.startswith('//'):
+                ended = True
+    else:
+        start = RECORD_STARTS[file_format]
+        for line in lines:
+            if line.startswith(start) and record:
+                yield ''.join(record)
+                record = []
+            record.append(line)
+
+    text = ''.join(record)
+    if text.strip():
+        yield text
+
+
+def get_accession(record, file_format):
+    """Get the accession of a record, or None if it can't be found."""
+    # types: string, string -> string
+    if file_format == 'genbank':
+        accession = None
+        for line in record.splitlines():
+            if line.startswith('ACCESSION') and accession is None:
+                parts = line.split()
+                if len(parts) > 1:
+                    accession = parts[1]
+            elif line.startswith('VERSION'):
+                parts = line.split()
+                if len(parts) > 1:
+                    return parts[1]
+            elif line.startswith('FEATURES') or line.startswith('ORIGIN'):
+                break
+        return accession
+
+    header = record.lstrip().split('\n', 1)[0]
+    if file_format == 'featuretable':
+        # >Feature ref|NC_000913.3|
+        header = header[len(RECORD_STARTS['featuretable']):]
+        parts = [part for part in header.strip().split('|') if part]
+        if not parts:
+            return None
+        return parts[-1] if len(parts) > 1 else parts[0]
+
+    if not header.startswith('>'):
+        return None
+    parts = header[1:].split()
+    if not parts:
+        return None
+    return parts[0]
+
+
+def strip_version(accession):
+    """Strip the version suffix from an accession."""
+    # types: string -> string
+    return accession.split('.', 1)[0].upper()
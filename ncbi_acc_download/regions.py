@@ -0,0 +1,172 @@
+# Copyright 2017,2018 Kai Blin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Read region lists and cut regions out of larger downloaded ranges."""
+
+from collections import OrderedDict
+import re
+
+# Regions on the same accession less than this many bases apart are downloaded with a single request.
+# At 3 requests per second, a request costs about as much time as downloading tens of kilobases.
+REGION_SLACK = 10000
+# Formats regions can be downloaded in
+REGION_FORMATS = {'fasta', 'genbank'}
+# Formats regions can be cut out of locally just like NCBI does it, so nearby regions can be downloaded together.
+# NCBI trims the features of GenBank records to the range and notes it in the ACCESSION line, so those can't be.
+MERGE_FORMATS = {'fasta'}
+# NCBI's line length for FASTA sequences
+FASTA_LINE_LENGTH = 70
+# NCBI adds the downloaded range to the FASTA header like >NC_007194.1:1001-9000
+FASTA_RANGE_RE = re.compile(r':c?\d+-\d+$')
+# BED files can have header lines like these
+BED_HEADERS = ('#', 'track', 'browser')
+
+
+class Region(object):
+    """A region of an accession, with a 0-based start and an exclusive end like in BED files."""
+
+    __slots__ = (
+        'accession',
+        'end',
+        'start',
+    )
+
+    def __init__(self, accession, start, end):
+        if start < 0 or end <= start:
+            raise ValueError("Invalid region {}:{}-{}".format(accession, start, end))
+        self.accession = accession
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return "Region({!r}, {!r}, {!r})".format(self.accession, self.start, self.end)
+
+    def __str__(self):
+        # the 1-based, inclusive notation NCBI uses
+        return "{}:{}-{}".format(self.accession, self.start + 1, self.end)
+
+    def __eq__(self, other):
+        if not isinstance(other, Region):
+            return NotImplemented
+        return (self.accession, self.start, self.end) == (other.accession, other.start, other.end)
+
+    def __hash__(self):
+        return hash((self.accession, self.start, self.end))
+
+    def __len__(self):
+        return self.end - self.start
+
+
+class RegionGroup(object):
+    """Regions of an accession close enough to each other to download them with a single request."""
+
+    __slots__ = (
+        'accession',
+        'end',
+        'regions',
+        'start',
+    )
+
+    def __init__(self, accession, start, end, regions):
+        self.accession = accession
+        self.start = start
+        self.end = end
+        # (index in the region list, Region) tuples, sorted by start
+        self.regions = regions
+
+    def __repr__(self):
+        return "RegionGroup({!r}, {!r}, {!r}, {!r})".format(self.accession, self.start, self.end, self.regions)
+
+    def __str__(self):
+        return "{}:{}-{}".format(self.accession, self.start + 1, self.end)
+
+
+def read_regions(handle):
+    """Lazily read regions from a BED or tab-separated file with accession, start and end columns.
+
+    Like in BED files, starts are 0-based and ends are exclusive. Any further
+    columns are ignored, as are empty lines and header lines.
+    """
+    # types: file -> iterator of Region
+    for number, line in enumerate(handle, 1):
+        line = line.strip()
+        if not line or line.startswith(BED_HEADERS):
+            continue
+        columns = line.split('\t') if '\t' in line else line.split()
+        if len(columns) < 3:
+            raise ValueError("Line {} of the region list has less than 3 columns".format(number))
+        try:
+            region = Region(columns[0].strip(), int(columns[1]), int(columns[2]))
+        except ValueError as err:
+            raise ValueError("Line {} of the region list has an invalid region {!r}".format(number, line)) from err
+        yield region
+
+
+def merge_regions(regions, slack=REGION_SLACK):
+    """Merge overlapping regions and regions less than slack bases apart into RegionGroups.
+
+    Groups are returned per accession in the order the accessions first show
+    up in, and sorted by start within an accession. With a slack of None,
+    regions aren't merged at all and every region gets a group of its own.
+    """
+    # types: iterable of Region, int -> list of RegionGroup
+    if slack is not None and slack < 0:
+        raise ValueError("Region slack can't be negative")
+
+    by_accession = OrderedDict()
+    for index, region in enumerate(regions):
+        by_accession.setdefault(region.accession, []).append((index, region))
+
+    groups = []
+    for accession, entries in by_accession.items():
+        entries.sort(key=lambda entry: (entry[1].start, entry[1].end))
+        group = None
+        for index, region in entries:
+            if group is not None and slack is not None and region.start <= group.end + slack:
+                group.end = max(group.end, region.end)
+                group.regions.append((index, region))
+                continue
+            group = RegionGroup(accession, region.start, region.end, [(index, region)])
+            groups.append(group)
+    return groups
+
+
+def cut_region(record, group, region, file_format):
+    """Cut a region out of the record downloaded for the group it belongs to.
+
+    Only FASTA records can be cut, records in other formats have to be
+    downloaded for exactly the region and are returned unchanged.
+    """
+    # types: string, RegionGroup, Region, string -> string
+    if file_format not in REGION_FORMATS:
+        raise ValueError("Can't cut regions out of files in {} format".format(file_format))
+    if file_format == 'fasta':
+        return _cut_fasta(record, region, region.start - group.start, region.end - group.start)
+    if (region.start, region.end) != (group.start, group.end):
+        raise ValueError("Can't cut regions out of {} records, they have to be downloaded one by one".format(
+            file_format))
+    return record
+
+
+def _cut_fasta(record, region, start, end):
+    """Cut a region out of a FASTA record, updating the range in the header."""
+    # types: string, Region, int, int -> string
+    header, _, sequence = record.partition('\n')
+    name, _, description = header[1:].partition(' ')
+    name = "{}:{}-{}".format(FASTA_RANGE_RE.sub('', name), region.start + 1, region.end)
+    sequence = sequence.replace('\n', '').replace('\r', '')[start:end]
+
+    lines = [">{} {}".format(name, description).rstrip()]
+    lines.extend(sequence[i:i + FASTA_LINE_LENGTH] for i in range(0, len(sequence), FASTA_LINE_LENGTH))
+    return '\n'.join(lines) + '\n'
+
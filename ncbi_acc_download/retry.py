@@ -0,0 +1,71 @@
+# Copyright 2017,2018 Kai Blin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Decide when and how long to wait before retrying failed downloads."""
+
+import random
+
+from ncbi_acc_download.download import TRANSIENT_PATTERNS
+from ncbi_acc_download.errors import (
+    BadPatternError,
+    InvalidIdError,
+    NetworkError,
+    TooManyRequests,
+)
+
+
+class RetryPolicy(object):
+    """Retry transient failures with capped exponential backoff and full jitter."""
+
+    __slots__ = (
+        'backoff',
+        'max_backoff',
+        'retries',
+    )
+
+    def __init__(self, retries=3, backoff=1.0, max_backoff=60.0):
+        """Allow up to retries retries, waiting up to backoff * 2^attempt seconds, but no more than max_backoff."""
+        if retries < 0:
+            raise ValueError("Number of retries can't be negative")
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    @staticmethod
+    def is_transient(err):
+        """Check if an error is worth retrying."""
+        # types: Exception -> bool
+        if isinstance(err, (TooManyRequests, NetworkError)):
+            return True
+        if isinstance(err, BadPatternError):
+            return err.pattern in TRANSIENT_PATTERNS
+        if isinstance(err, InvalidIdError):
+            return err.status_code >= 500
+        return False
+
+    def should_retry(self, err, attempt):
+        """Check if a failed attempt (counting from 0) should be retried."""
+        # types: Exception, int -> bool
+        return attempt < self.retries and self.is_transient(err)
+
+    def delay(self, err, attempt):
+        """Get the number of seconds to wait before the next attempt."""
+        # types: Exception, int -> float
+        retry_after = getattr(err, 'retry_after', None)
+        if retry_after is not None:
+            try:
+                # the server knows best how long we need to wait
+                return float(retry_after)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
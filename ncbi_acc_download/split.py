@@ -0,0 +1,313 @@
+# Copyright 2017,2018 Kai Blin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Split downloads into one output per record while they are written."""
+
+import hashlib
+import io
+import os
+import re
+import uuid
+
+from ncbi_acc_download.compress import open_compressed
+from ncbi_acc_download.errors import DownloadError
+from ncbi_acc_download.records import (
+    get_accession,
+    RECORD_STARTS,
+    SPLITTABLE_FORMATS,
+)
+
+# GenBank header lines after which get_accession() won't find anything new
+GENBANK_HEADER_END = ('VERSION', 'FEATURES', 'ORIGIN', '//')
+# Characters not to use in file names
+UNSAFE_CHARS_RE = re.compile(r'[^\w.-]')
+# Each level of sharding spreads the files over 256 directories
+MAX_SHARD_DEPTH = 16
+
+
+class RecordSplitter(io.TextIOBase):
+    """Write-only text file object splitting the records written to it into separate outputs.
+
+    Records are passed on as soon as their accession is known, which for FASTA
+    and feature tables is the first line and for GenBank the VERSION line, so
+    no more than the header of a record is buffered. The outputs come from
+    sink, which needs three methods: start(accession) returns the file handle
+    to write the next record to, finish() is called once that record is
+    complete and discard() when the download is retried, throwing away the
+    current record. Sinks only used for downloads retried from the start can
+    forget anything else they want as well.
+
+    Seeking back and truncating discards the output, so fetch_and_write can
+    retry failures in the middle of a download. Besides the start, the last
+    position told between two records can be seeked back to, e.g. to retry
+    the batches of WGS parts written one after the other. Asking for the
+    position there finishes the GenBank record that ended last, as the next
+    download starts there. When leaving a with block because of an error,
+    the output is discarded as well.
+    """
+
+    def __init__(self, file_format, sink):
+        if file_format not in SPLITTABLE_FORMATS:
+            raise ValueError("Can't split records in {} format".format(file_format))
+        self.file_format = file_format
+        self.sink = sink
+        # the last position told between two records, which can be seeked back to
+        self._boundary = 0
+        # set after the // line of a GenBank record, whose trailing blank lines still belong to it
+        self._ended = False
+        self._handle = None
+        self._pending = []
+        self._position = 0
+        self._rest = ''
+        self._written = 0
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.truncate(0)
+        self.close()
+        return False
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        """Check if the current position can be seeked back to later, which is only the case between records."""
+        return not self._rest and not self._pending and (self._handle is None or self._ended)
+
+    def tell(self):
+        if self.seekable():
+            if self._ended:
+                self._finish()
+            self._boundary = self._written
+        return self._written
+
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence != io.SEEK_SET or position not in (0, self._boundary):
+            raise io.UnsupportedOperation("Can only seek back to the start or the last position told between records")
+        self._position = position
+        return position
+
+    def truncate(self, size=None):
+        """Throw away everything written after the position seeked to, or after size."""
+        if size is None:
+            size = self._position
+        if size not in (0, self._boundary):
+            raise io.UnsupportedOperation("Can only truncate at the start or the last position told between records")
+        self._boundary = size
+        self._ended = False
+        self._handle = None
+        self._pending = []
+        self._position = size
+        self._rest = ''
+        self._written = size
+        self.sink.discard()
+        return size
+
+    def write(self, text):
+        if self.closed:
+            raise ValueError("write to closed file")
+        self._written += len(text)
+        self._position = self._written
+        data = self._rest + text
+        pos = 0
+        while pos < len(data):
+            if self._ended:
+                end = data.find('\n', pos)
+                if end == -1:
+                    break
+                if data[pos:end + 1].strip():
+                    self._finish()
+                else:
+                    self._handle.write(data[pos:end + 1])
+                    pos = end + 1
+                continue
+
+            if self._handle is None:
+                end = data.find('\n', pos)
+                if end == -1:
+                    break
+                self._header_line(data[pos:end + 1])
+                pos = end + 1
+                continue
+
+            pos, complete = self._write_body(data, pos)
+            if not complete:
+                break
+        self._rest = data[pos:]
+        return len(text)
+
+    def close(self):
+        """Pass on the last record, even if it didn't end properly."""
+        if self.closed:
+            return
+        try:
+            if self._handle is not None:
+                self._handle.write(self._rest)
+                self._finish()
+            else:
+                text = ''.join(self._pending) + self._rest
+                if text.strip():
+                    self.sink.start(get_accession(text, self.file_format)).write(text)
+                    self.sink.finish()
+            self._pending = []
+            self._rest = ''
+        finally:
+            super().close()
+
+    def _header_line(self, line):
+        """Collect a line of a record whose accession isn't known yet."""
+        # types: string -> None
+        self._pending.append(line)
+        if self.file_format == 'genbank':
+            if not line.startswith(GENBANK_HEADER_END):
+                return
+        elif not line.startswith(RECORD_STARTS[self.file_format]):
+            # like iter_records, anything before the first record start belongs to that record
+            return
+
+        text = ''.join(self._pending)
+        self._pending = []
+        self._handle = self.sink.start(get_accession(text, self.file_format))
+        self._handle.write(text)
+        if self.file_format == 'genbank' and line.startswith('//'):
+            self._ended = True
+
+    def _write_body(self, data, pos):
+        """Write the data of the current record from pos on, up to where the record ends.
+
+        Returns the position to continue from, and if all data up to there is
+        dealt with. Incomplete lines that could end the record are left for the
+        next write.
+        """
+        # types: string, int -> (int, bool)
+        if self.file_format == 'genbank':
+            boundary = _find_line(data, pos, '//')
+            if boundary != -1:
+                end = data.find('\n', boundary)
+                if end == -1:
+                    self._handle.write(data[pos:boundary])
+                    return boundary, False
+                self._handle.write(data[pos:end + 1])
+                self._ended = True
+                return end + 1, True
+        else:
+            boundary = _find_line(data, pos, RECORD_STARTS[self.file_format])
+            if boundary != -1:
+                self._handle.write(data[pos:boundary])
+                self._finish()
+                return boundary, True
+
+        end = data.rfind('\n', pos) + 1
+        if end > 0:
+            self._handle.write(data[pos:end])
+            return end, False
+        return pos, False
+
+    def _finish(self):
+        """Finish the current record."""
+        self._ended = False
+        self._handle = None
+        self.sink.finish()
+
+
+class RecordFiles(object):
+    """Sink for a RecordSplitter writing every record to its own file, named after its accession.
+
+    Files are written via part files, so there are only complete records
+    under the final names. See record_path() for the directory layout.
+    """
+
+    __slots__ = (
+        'compress',
+        'directory',
+        'file_ending',
+        'shard_depth',
+        '_current',
+    )
+
+    def __init__(self, directory, file_ending, shard_depth=0, compress=None):
+        if not 0 <= shard_depth <= MAX_SHARD_DEPTH:
+            raise ValueError("Shard depth needs to be between 0 and {}".format(MAX_SHARD_DEPTH))
+        self.directory = directory
+        self.file_ending = file_ending
+        self.shard_depth = shard_depth
+        self.compress = compress
+        # (file name, part file name, handle) of the record being written
+        self._current = None
+
+    def path(self, accession):
+        """Get the file name a record is written to."""
+        # types: string -> string
+        return record_path(self.directory, accession, self.file_ending, self.shard_depth)
+
+    def start(self, accession):
+        """Open the part file of a record."""
+        # types: string -> file
+        if not accession:
+            raise DownloadError("Can't find the accession of a downloaded record to name its file after")
+        filename = self.path(accession)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # Unique part file names, so parallel downloads of the same record don't get in each other's way.
+        # Unlike tempfile.mkstemp(), creating them with open() applies the umask, like for other output files.
+        part_name = "{}.{}.part".format(filename, uuid.uuid4().hex)
+        if self.compress is not None:
+            handle = open_compressed(part_name, 'x', self.compress, False)
+        else:
+            handle = open(part_name, 'x')
+        self._current = (filename, part_name, handle)
+        return handle
+
+    def finish(self):
+        """Move the finished record to its final name."""
+        # types: -> None
+        filename, part_name, handle = self._current
+        self._current = None
+        handle.close()
+        os.replace(part_name, filename)
+
+    def discard(self):
+        """Remove the part file of an unfinished record."""
+        # types: -> None
+        if self._current is None:
+            return
+        _, part_name, handle = self._current
+        self._current = None
+        handle.close()
+        os.remove(part_name)
+
+
+def record_path(directory, accession, file_ending, shard_depth=0):
+    """Get the file name for the record of an accession.
+
+    Without sharding, the file is directly in directory. With a shard_depth,
+    it is shard_depth levels of subdirectories down, named after pairs of hex
+    digits of the MD5 hash of the file name. Each level spreads the files over
+    256 directories, so even millions of files stay manageable for file
+    systems.
+    """
+    # types: string, string, string, int -> string
+    basename = UNSAFE_CHARS_RE.sub('_', accession) + file_ending
+    digest = hashlib.md5(basename.encode('utf-8')).hexdigest()
+    shards = [digest[2 * level:2 * level + 2] for level in range(shard_depth)]
+    return os.path.join(directory, *(shards + [basename]))
+
+
+def _find_line(data, pos, prefix):
+    """Find the first line from pos on starting with prefix, with pos at the start of a line."""
+    # types: string, int, string -> int
+    if data.startswith(prefix, pos):
+        return pos
+    found = data.find('\n' + prefix, pos)
+    if found == -1:
+        return -1
+    return found + 1
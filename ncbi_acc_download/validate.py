@@ -1,55 +1,234 @@
 """Record validation logic."""
 
+from io import StringIO
 import logging
-# If Biopython is not available, all checks will return False
+import re
+import time
+
+from ncbi_acc_download.download import ordered_map
+from ncbi_acc_download.errors import ValidationError
+from ncbi_acc_download.records import get_accession
+from ncbi_acc_download.structure import check_structure
+
+# If Biopython is not available, only the built-in structural checks are available
 try:
     from Bio import SeqIO
-    from Bio.SeqFeature import BeforePosition, AfterPosition
     HAVE_BIOPYTHON = True
 except ImportError:  # pragma: no cover
     HAVE_BIOPYTHON = False
 
 
 VALIDATION_LEVELS = {'none', 'loads', 'all', 'correct'}
+# 'loads' and 'correct' only run the built-in structural checks, 'all' also loads the records with Biopython
+BIOPYTHON_LEVELS = {'all'}
+# Formats Biopython can read
+BIOPYTHON_FORMATS = {'fasta', 'genbank'}
+
+# Amount of record text sent to a validation worker process at once
+VALIDATION_CHUNK_SIZE = 1024 * 1024
+
+# The FEATURES table of a GenBank record, up to the next section like CONTIG, ORIGIN or the end of the record
+FEATURES_RE = re.compile(r'^FEATURES .*\n((?:[ \t].*\n?)*)', re.M)
+# Feature keys start in column 6, everything up to the next feature key belongs to the feature
+FEATURE_START_RE = re.compile(r'^ {5}\S', re.M)
+# Positions in a feature location, skipping the accessions of references to other records like AB012345.1:1..100
+LOCATION_POSITION_RE = re.compile(r'[A-Za-z_][\w.]*:|([<>]?)(\d+)')
 
 
 def run_extended_validation(handle, file_format, validation_level):
     """Check if the dowloaded sequence file can load."""
-    if not HAVE_BIOPYTHON:
+    if validation_level in BIOPYTHON_LEVELS and not HAVE_BIOPYTHON:
         return False
     # we wrote to the handle, so rewind it
     handle.seek(0)
     try:
-        processed_seq = False
-        records = []
-        for rec in SeqIO.parse(handle, file_format):
-            processed_seq = True
-            if validation_level == 'loads':
-                continue
-            if validation_level == 'correct':
-                ## Correct possible errors from downloaded a restricted-range genbank file
-                ## Will write over the downloaded file
-                newfeats = []
-                for f in rec.features:
-                    try:
-                        if not isinstance(f.location.start, BeforePosition) and not isinstance(f.location.end, AfterPosition):
-                            newfeats.append(f)
-                    except AttributeError:
-                        newfeats.append(f)
-                rec.features = newfeats
-                records.append(rec)
-        if not processed_seq:
-            logging.error('no seq')
-
+        text = validate_text(handle.read(), file_format, validation_level)
         if validation_level == 'correct':
             ## rewrite StringIO data
             handle.truncate(0)
             handle.seek(0)
-            SeqIO.write(records, handle, 'genbank')
-        return processed_seq
+            handle.write(text)
+        return True
     except (ValueError, AssertionError) as err:
         logging.error(err)
         return False
     except Exception as err:
         logging.error("Unhandled exception %s while parsing sequence file.", err)
         return False
+
+
+def iter_validated(records, file_format, validation_level, dl_id, executor=None, window=1, metrics=None,
+                   allow_empty=False):
+    """Validate records as they come in, yielding the text to write out for each of them.
+
+    Without an executor, records are validated one by one and the first record
+    that fails to load raises a ValidationError, so only one record needs to be
+    kept in memory at a time.
+    With an executor (usually a process pool), chunks of records are validated
+    in parallel, keeping at most window chunks in flight. All records are
+    checked and the ValidationError at the end lists every record that failed.
+    If metrics are given, the time spent validating, or waiting for the
+    validation processes, is recorded once all records are done.
+    Unless allow_empty is set, getting no records at all is an error.
+    """
+    # types: iterable of strings, string, string, string, Executor, int, Metrics, bool -> iterator of strings
+    if validation_level in BIOPYTHON_LEVELS and not HAVE_BIOPYTHON:
+        raise ValidationError("Asked for extended validation, but Biopython not available")
+
+    timings = []
+    if executor is None:
+        results = (_timed(timings, validate_chunk, [record], file_format, validation_level, i)[0]
+                   for i, record in enumerate(records))
+    else:
+        calls = ((None, (chunk, file_format, validation_level, first))
+                 for first, chunk in _iter_chunks(records, VALIDATION_CHUNK_SIZE))
+        results = (result for _, future in ordered_map(executor, validate_chunk, calls, window)
+                   for result in _timed(timings, future.result))
+
+    processed_seq = 0
+    failures = []
+    try:
+        for text, failure in results:
+            processed_seq += 1
+            if failure is None:
+                yield text
+                continue
+            failures.append(failure)
+            if executor is None:
+                break
+    finally:
+        if metrics is not None:
+            metrics.record('validation', id=dl_id, level=validation_level, records=processed_seq,
+                           failures=len(failures), seconds=sum(timings))
+
+    if failures:
+        number, accession, message = failures[0]
+        record = "Record {}".format(number)
+        if accession:
+            record += " ({})".format(accession)
+        if len(failures) > 1:
+            record = "{} records, first {},".format(len(failures), record.lower())
+        raise ValidationError("{} downloaded for {} failed to load: {}".format(record, dl_id, message), failures)
+
+    if not processed_seq and not allow_empty:
+        raise ValidationError("Sequence(s) downloaded for {} failed to load: no seq".format(dl_id))
+
+
+def _timed(timings, func, *args):
+    """Call func, adding the seconds it took to the timings list."""
+    # types: list of floats, callable, ... -> object
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        timings.append(time.perf_counter() - start)
+
+
+def validate_chunk(records, file_format, validation_level, first=0):
+    """Validate a list of records, numbered starting from first.
+
+    Returns a (text to write out, None) tuple for every valid record, and a
+    (None, (record number, accession, message)) tuple for every invalid one.
+    Runs in worker processes, so it only takes and returns simple types.
+    """
+    # types: list of strings, string, string, int -> list of (string, tuple)
+    results = []
+    for i, record in enumerate(records, first + 1):
+        try:
+            results.append((validate_text(record, file_format, validation_level), None))
+        except Exception as err:
+            results.append((None, (i, get_accession(record, file_format), str(err) or type(err).__name__)))
+    return results
+
+
+def _iter_chunks(records, chunk_size):
+    """Group records into lists of about chunk_size characters, yielding (index of the first record, list) tuples."""
+    # types: iterable of strings, int -> iterator of (int, list of strings)
+    chunk = []
+    size = 0
+    first = 0
+    for i, record in enumerate(records):
+        chunk.append(record)
+        size += len(record)
+        if size >= chunk_size:
+            yield first, chunk
+            chunk = []
+            size = 0
+            first = i + 1
+    if chunk:
+        yield first, chunk
+
+
+def validate_text(text, file_format, validation_level):
+    """Validate the records in a piece of a sequence file, returning the text to write out for them.
+
+    Raises a ValueError if the records don't load.
+    """
+    # types: string, string, string -> string
+    check_structure(text, file_format)
+    if validation_level == 'correct' and file_format == 'genbank':
+        ## Correct possible errors from downloaded a restricted-range genbank file
+        return drop_partial_features(text)
+    if validation_level != 'all' or file_format not in BIOPYTHON_FORMATS:
+        return text
+
+    processed_seq = False
+    for _ in SeqIO.parse(StringIO(text), file_format):
+        processed_seq = True
+    if not processed_seq:
+        raise ValueError('no seq')
+    return text
+
+
+def drop_partial_features(text):
+    """Remove features extending beyond the downloaded range from GenBank records.
+
+    Works on the text of the FEATURES tables, so only the partial features are
+    touched and the rest of the records is passed on unchanged.
+    """
+    # types: string -> string
+    # '<' and '>' mark partial locations, most records don't have any
+    if '<' not in text and '>' not in text:
+        return text
+
+    pieces = []
+    last = 0
+    for table in FEATURES_RE.finditer(text):
+        features = table.group(1)
+        if '<' not in features and '>' not in features:
+            continue
+        starts = [match.start() for match in FEATURE_START_RE.finditer(features)] + [len(features)]
+        kept = [features[:starts[0]]]
+        for start, end in zip(starts, starts[1:]):
+            feature = features[start:end]
+            if not _is_partial(feature):
+                kept.append(feature)
+        pieces.append(text[last:table.start(1)])
+        pieces.extend(kept)
+        last = table.end(1)
+    pieces.append(text[last:])
+    return ''.join(pieces)
+
+
+def _is_partial(feature):
+    """Check if the location of a feature table entry starts before or ends after the downloaded range."""
+    # types: string -> bool
+    # The location starts in column 22 and can be continued on the next lines, up to the first qualifier
+    location = []
+    for line in feature.split('\n'):
+        part = line[21:].strip()
+        if part.startswith('/'):
+            break
+        location.append(part)
+    location = ''.join(location)
+    if '<' not in location and '>' not in location:
+        return False
+
+    positions = [(int(match.group(2)), match.group(1)) for match in LOCATION_POSITION_RE.finditer(location)
+                 if match.group(2) is not None]
+    if not positions:
+        return False
+    # Only the outermost positions matter, like Biopython's location.start and location.end
+    first = min(number for number, _ in positions)
+    last = max(number for number, _ in positions)
+    return (first, '<') in positions or (last, '>') in positions
@@ -14,41 +14,134 @@
 """Recursively download the actual entries for WGS records."""
 
 from io import StringIO
+import re
 import time
 
 from ncbi_acc_download.download import (
     build_params,
-    get_stream,
+    fetch_and_write,
     get_url_by_format,
-    write_stream,
+    iter_stream,
+    ordered_map,
 )
+from ncbi_acc_download.records import (
+    get_accession,
+    iter_lines,
+    iter_records,
+)
+from ncbi_acc_download.validate import iter_validated
+
+# Default number of WGS parts to download with a single request
+STEP_SIZE = 10
 
-from ncbi_acc_download.errors import TooManyRequests
+# Anything but whitespace, to find out if there is a sequence after the ORIGIN line
+NON_SPACE_RE = re.compile(r'\S')
+# GenBank header lines needed to decide if a record has to be replaced by its parts, ORIGIN ends the header
+HEADER_LINE_RE = re.compile(r'^(LOCUS|ACCESSION|VERSION|WGS|WGS_SCAFLD|TSA|CONTIG|ORIGIN)(?: +(.*))?$', re.M)
 
-try:
-    from Bio import SeqIO
-    from Bio.Seq import UndefinedSequenceError
-    HAVE_BIOPYTHON = True
-except ImportError:  # pragma: no cover
-    HAVE_BIOPYTHON = False
 
-STEP_SIZE = 10
+class WgsRange(object):
+    """A range of consecutive WGS or TSA identifiers like ABCD01000001-ABCD01000022.
 
+    Behaves like a read-only sequence of identifier strings, which are only
+    formatted when they are accessed, so even huge ranges take up no memory.
+    """
+
+    __slots__ = (
+        'end',
+        'identifier',
+        'start',
+        'width',
+    )
 
-class WgsRange:
     def __init__(self, identifier, width, start, end):
         self.identifier = identifier
         self.width = width
         self.start = start
         self.end = end
 
+    def __repr__(self):
+        return "WgsRange({s.identifier!r}, {s.width}, {s.start}, {s.end})".format(s=self)
+
+    def __str__(self):
+        if len(self) == 1:
+            return self[0]
+        return "{}-{}".format(self[0], self[-1])
+
+    def __eq__(self, other):
+        if not isinstance(other, WgsRange):
+            return NotImplemented
+        return (self.identifier, self.width, self.start, self.end) == \
+            (other.identifier, other.width, other.start, other.end)
+
+    def __len__(self):
+        return max(0, self.end - self.start + 1)
+
+    def __iter__(self):
+        for i in range(self.start, self.end + 1):
+            yield self._format(i)
+
+    def __getitem__(self, index):
+        """Get a single identifier, or a WgsRange for a slice.
+
+        Slices with a step other than 1 can't be represented as a range and return a list instead.
+        """
+        numbers = range(self.start, self.end + 1)[index]
+        if isinstance(numbers, int):
+            return self._format(numbers)
+        if numbers.step != 1:
+            return [self._format(i) for i in numbers]
+        return WgsRange(self.identifier, self.width, numbers.start, numbers.stop - 1)
+
+    def __contains__(self, accession):
+        return self.number(accession) is not None
+
+    def _format(self, number):
+        # types: int -> string
+        return "{s.identifier}{i:0{s.width}}".format(i=number, s=self)
+
+    def number(self, accession):
+        """Get the number of an accession in the range, or None if it isn't part of the range.
+
+        Versions and RefSeq prefixes like NZ_ are ignored.
+        """
+        # types: string -> int
+        if not isinstance(accession, str):
+            return None
+        accession = accession.split('.', 1)[0]
+        length = len(self.identifier) + self.width
+        prefix, tail = accession[:-length], accession[-length:]
+        if len(tail) != length or (prefix and not prefix.endswith('_')):
+            return None
+        digits = tail[len(self.identifier):]
+        if not tail.startswith(self.identifier) or not digits.isdigit():
+            return None
+        number = int(digits)
+        if not self.start <= number <= self.end:
+            return None
+        return number
+
     def get_ids(self):
         """Get the list of identifier strings covered by the range."""
-        ids = []
-        for i in range(self.start, self.end+1):
-            ids.append("{s.identifier}{i:0{s.width}}".format(i=i, s=self))
-
-        return ids
+        return list(self)
+
+    def batches(self, size):
+        """Iterate over consecutive sub-ranges of up to size identifiers."""
+        # types: int -> iterator of WgsRange
+        for first in range(self.start, self.end + 1, size):
+            yield WgsRange(self.identifier, self.width, first, min(first + size - 1, self.end))
+
+    def gaps(self, accessions):
+        """Iterate over the sub-ranges not covered by any of the accessions, e.g. suppressed contigs."""
+        # types: iterable of strings -> iterator of WgsRange
+        expected = self.start
+        numbers = (self.number(accession) for accession in accessions)
+        for number in sorted(set(number for number in numbers if number is not None)):
+            if number > expected:
+                yield WgsRange(self.identifier, self.width, expected, number - 1)
+            expected = number + 1
+        if expected <= self.end:
+            yield WgsRange(self.identifier, self.width, expected, self.end)
 
     @classmethod
     def from_string(cls, range_string):
@@ -92,105 +185,193 @@ class WgsRange:
 
 def download_wgs_parts(handle, config):
     """Download all parts of all WGS records in a file handle."""
-
-    if not HAVE_BIOPYTHON:
-        return handle
-
-    updated_records = []
-
     handle.seek(0)
-    records = list(SeqIO.parse(handle, config.format))
-    for record in records:
-        # TODO: If Biopython ever provides a nice check for undefined sequences,
-        # replace the exception-based check here.
-        run_download = False
-        try:
-            bytes(record.seq)
-        except UndefinedSequenceError:
-            run_download = True
-        if run_download and ('wgs_scafld' in record.annotations or
-                             'wgs' in record.annotations or
-                             'tsa' in record.annotations):
-            updated_records.extend(download_wgs_for_record(record, config))
-        elif run_download and 'contig' in record.annotations:
-            updated_records.extend(fix_supercontigs(record, config))
-        else:
-            updated_records.append(record)
-
     outhandle = StringIO()
-    SeqIO.write(updated_records, outhandle, config.format)
+    write_wgs_parts(handle, outhandle, config)
     outhandle.seek(0)
     return outhandle
 
 
-def download_wgs_for_record(record, config):
-    """Download all WGS records in a record."""
-    if 'wgs_scafld' in record.annotations:
-        # Biopython splits on '-' for us, but doesn't actually calculate the range
-        # Also this is somehow a list of lists
-        wgs_range = WgsRange.from_string('-'.join(record.annotations['wgs_scafld'][0]))
-    elif 'wgs' in record.annotations:
-        # Biopython splits on '-' for us, but doesn't actually calculate the range
-        # Unlike WGS_SCAFLD, this is just a list
-        wgs_range = WgsRange.from_string('-'.join(record.annotations['wgs']))
-    elif 'tsa' in record.annotations:
-        # Biopython splits on '-' for us, but doesn't actually calculate the range
-        # Like WGS, this is just a list
-        wgs_range = WgsRange.from_string('-'.join(record.annotations['tsa']))
-    else:
-        return [record]
-
-    handle = StringIO()
-    id_list = wgs_range.get_ids()
-
-    i = 0
-    while i < len(id_list):
-        dl_id = ",".join(id_list[i:i + STEP_SIZE])
-        i += STEP_SIZE
-
-        url = get_url_by_format(config)
-        params = build_params(dl_id, config)
-
-        try:
-            r = get_stream(url, params)
-            config.emit("Downloading {}\n".format(r.url))
-        except TooManyRequests as err:
-            # Wait, and then retry
-            config.emit("Server requested us to slow down, waiting {} seconds\n".format(err.retry_after))
-            time.sleep(int(err.retry_after))
-            r = get_stream(url, params)
-            config.emit("Downloading {}\n".format(r.url))
-
-        write_stream(r, handle, dl_id, config)
-
-    # Rewind, so Biopython can parse this
-    handle.seek(0)
+def write_wgs_parts(lines, outhandle, config, journal=None, scope=''):
+    """Write records to the output handle, replacing WGS records by all their parts.
+
+    Records are processed one at a time as the lines come in, and the parts are
+    written as soon as they are downloaded, so no more than one record and one
+    batch of parts are kept in memory. Records that don't need to be replaced
+    are written unchanged.
+    If a journal is given, finished records and batches of parts are recorded
+    in it under keys starting with scope, and skipped if they are already done.
+    With extended validation, the records are validated as they are written,
+    so the parts are validated instead of the records they replace.
+    Returns the number of records read from lines.
+    """
+    # types: iterable of strings, file, Config, Journal, string -> int
+    # Only GenBank records carry the information needed to find the parts
+    if config.format != 'genbank':
+        outhandle.writelines(lines)
+        return 0
+
+    count = 0
+    for i, text in enumerate(iter_records(lines, config.format)):
+        count += 1
+        key = "{}record {}".format(scope, i)
+        if journal is not None and journal.is_done(key):
+            continue
+
+        header = RecordHeader.scan(text)
+        wgs_range = header.wgs_range
+        if header.undefined and wgs_range is not None:
+            start = time.perf_counter()
+            download_wgs_for_record(wgs_range, config, outhandle, journal, key)
+            config.metrics.record('wgs', id=header.accession, parts=len(wgs_range),
+                                  seconds=time.perf_counter() - start)
+        elif header.undefined and header.contig:
+            start = time.perf_counter()
+            fix_supercontigs(header.accession, config, outhandle)
+            config.metrics.record('wgs', id=header.accession, parts=1, seconds=time.perf_counter() - start)
+        else:
+            outhandle.writelines(_validated([text], config, header.accession))
 
-    return list(SeqIO.parse(handle, config.format))
+        if journal is not None:
+            journal.mark_done(key)
+    return count
 
 
-def fix_supercontigs(record, config):
-    """Fix a record containing a CONTIG entry instead of a seq."""
+class RecordHeader(object):
+    """The parts of a GenBank record header needed to expand WGS and CONTIG records."""
 
-    handle = StringIO()
+    __slots__ = (
+        'accession',
+        'contig',
+        'has_sequence',
+        'length',
+        'parts',
+    )
 
-    # Let the NCBI assemble the proper record for us by asking for the right format.
-    dl_id = record.id
+    def __init__(self):
+        self.accession = None
+        self.contig = False
+        self.has_sequence = False
+        self.length = 0
+        # WGS, WGS_SCAFLD or TSA ranges by keyword, only the first line of each is used
+        self.parts = {}
+
+    @classmethod
+    def scan(cls, text):
+        """Scan the header lines of a GenBank record without parsing the whole record."""
+        # types: string -> RecordHeader
+        header = cls()
+        for match in HEADER_LINE_RE.finditer(text):
+            keyword, value = match.group(1), (match.group(2) or '').strip()
+            if keyword == 'ORIGIN':
+                rest = NON_SPACE_RE.search(text, match.end())
+                header.has_sequence = rest is not None and not text.startswith('//', rest.start())
+                break
+            if keyword == 'LOCUS':
+                fields = value.split()
+                if len(fields) > 1 and fields[1].isdigit():
+                    header.length = int(fields[1])
+            elif keyword == 'ACCESSION':
+                if header.accession is None and value:
+                    header.accession = value.split()[0]
+            elif keyword == 'VERSION':
+                if value:
+                    header.accession = value.split()[0]
+            elif keyword == 'CONTIG':
+                header.contig = True
+            elif value:
+                header.parts.setdefault(keyword, value)
+        return header
+
+    @property
+    def undefined(self):
+        """Check if the record has a length, but no actual sequence."""
+        return self.length > 0 and not self.has_sequence
+
+    @property
+    def wgs_range(self):
+        """Get the range of parts the record consists of, or None if there aren't any."""
+        # types: -> WgsRange
+        for keyword in ('WGS_SCAFLD', 'WGS', 'TSA'):
+            if keyword in self.parts:
+                return WgsRange.from_string(self.parts[keyword].split()[0])
+        return None
+
+
+def download_wgs_for_record(wgs_range, config, outhandle, journal=None, key=''):
+    """Download all WGS records in a range and write them to the output handle."""
+    # types: WgsRange, Config, file, Journal, string -> None
+    def batches():
+        for batch in wgs_range.batches(config.wgs_batch_size):
+            batch_key = "{} {}".format(key, batch[0])
+            if journal is not None and journal.is_done(batch_key):
+                continue
+            yield batch_key, batch
+
+    if config.wgs_executor is None:
+        for batch_key, batch in batches():
+            _download_wgs_batch(batch, config, outhandle)
+            if journal is not None:
+                journal.mark_done(batch_key)
+        return
+
+    # Download batches in parallel, but write them out in the order of the range
+    calls = ((batch_key, (batch, config)) for batch_key, batch in batches())
+    for batch_key, future in ordered_map(config.wgs_executor, _download_wgs_batch, calls, 2 * config.jobs):
+        outhandle.write(future.result().getvalue())
+        if journal is not None:
+            journal.mark_done(batch_key)
+
+
+def _download_wgs_batch(batch, config, outhandle=None):
+    """Download a batch of WGS parts, writing them to outhandle or a new buffer that is returned."""
+    # types: WgsRange, Config, file -> file
+    if outhandle is None:
+        outhandle = StringIO()
+    dl_id = ",".join(batch)
     url = get_url_by_format(config)
     params = build_params(dl_id, config)
-    try:
-        r = get_stream(url, params)
-        config.emit("Downloading {}\n".format(r.url))
-    except TooManyRequests as err:
-        # Wait, and then retry
-        config.emit("Server requested us to slow down, waiting {} seconds\n".format(err.retry_after))
-        time.sleep(int(err.retry_after))
-        r = get_stream(url, params)
-        config.emit("Downloading {}\n".format(r.url))
-
-    write_stream(r, handle, dl_id, config)
-
-    # Rewind, so Biopython can parse this
-    handle.seek(0)
+    accessions = []
+
+    def write(request, outhandle, dl_id, config):
+        del accessions[:]
+        _write_records(request, outhandle, dl_id, config, accessions)
+
+    fetch_and_write(url, params, outhandle, dl_id, config, write)
+    # NCBI silently leaves out suppressed contigs
+    for gap in batch.gaps(accessions):
+        config.emit("No records returned for {}, they might have been suppressed\n".format(gap))
+    return outhandle
+
+
+def fix_supercontigs(dl_id, config, outhandle):
+    """Fix a record containing a CONTIG entry instead of a seq."""
 
-    return list(SeqIO.parse(handle, config.format))
+    # Let the NCBI assemble the proper record for us by asking for the right format.
+    url = get_url_by_format(config)
+    params = build_params(dl_id, config)
+    fetch_and_write(url, params, outhandle, dl_id, config, _write_records)
+
+
+def _write_records(request, outhandle, dl_id, config, accessions=None):
+    """Write the records of a download to the output handle as they arrive.
+
+    If a list of accessions is given, the IDs of the records written are added
+    to it. A batch of parts can come back empty, so that isn't a validation
+    error then; the gaps are reported instead.
+    """
+    lines = iter_lines(iter_stream(request, dl_id, config))
+    records = _validated(iter_records(lines, config.format), config, dl_id, allow_empty=accessions is not None)
+    for text in records:
+        outhandle.write(text)
+        if accessions is not None:
+            accessions.append(get_accession(text, config.format))
+
+
+def _validated(records, config, dl_id, allow_empty=False):
+    """Run the extended validation asked for on records as they are written."""
+    # types: iterable of strings, Config, string, bool -> iterable of strings
+    if config.extended_validation == 'none':
+        return records
+    return iter_validated(records, config.format, config.extended_validation, dl_id, config.validation_executor,
+                          2 * config.validation_jobs, config.metrics, allow_empty)
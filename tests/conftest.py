@@ -1,5 +1,11 @@
+from itertools import count
 import pytest
 import requests_mock
+from urllib.parse import parse_qs, urlsplit
+
+from ncbi_acc_download.core import ENTREZ_URL
+from ncbi_acc_download.history import EPOST_URL
+from ncbi_acc_download.ratelimit import RateLimiter
 
 
 @pytest.fixture
@@ -7,3 +13,52 @@ def req():
     """Get requests_mock into the pytest infrastructure."""
     with requests_mock.mock() as req:
         yield req
+
+
+@pytest.fixture
+def unthrottled(monkeypatch):
+    """Don't hold back requests of configs created in the test to NCBI's request rate, nothing goes to NCBI."""
+    monkeypatch.setattr(RateLimiter, 'for_api_key', classmethod(lambda cls, api_key: cls(1000)))
+
+
+class HistoryServer(object):
+    """Stand-in for the Entrez history server, serving one FASTA record per posted ID."""
+
+    def __init__(self, req, invalid=()):
+        self.invalid = set(invalid)
+        self.posts = []
+        self.fetches = []
+        self._envs = {}
+        self._counter = count(1)
+        req.post(EPOST_URL, text=self.epost)
+        req.get(ENTREZ_URL, text=self.efetch)
+
+    def epost(self, request, context):
+        ids = parse_qs(request.text)['id'][0].split(',')
+        self.posts.append(ids)
+        invalid = [dl_id for dl_id in ids if dl_id in self.invalid]
+        webenv = 'MCID_{}'.format(next(self._counter))
+        self._envs[webenv] = [dl_id for dl_id in ids if dl_id not in self.invalid]
+        invalid_list = ''
+        if invalid:
+            invalid_list = '<InvalidIdList>{}</InvalidIdList>'.format(
+                ''.join('<Id>{}</Id>'.format(dl_id) for dl_id in invalid))
+        return ('<?xml version="1.0" encoding="UTF-8" ?>\n<ePostResult>{}<QueryKey>1</QueryKey>'
+                '<WebEnv>{}</WebEnv></ePostResult>'.format(invalid_list, webenv))
+
+    def efetch(self, request, context):
+        params = parse_qs(urlsplit(request.url).query)
+        self.fetches.append(params)
+        if 'id' in params:
+            ids = params['id'][0].split(',')
+        else:
+            start = int(params['retstart'][0])
+            end = start + int(params['retmax'][0])
+            ids = self._envs[params['WebEnv'][0]][start:end]
+        return ''.join('>{}.1 record\nACGT\n'.format(dl_id) for dl_id in ids)
+
+
+@pytest.fixture
+def history_server(req):
+    """Serve epost and efetch requests from memory."""
+    return HistoryServer(req)
@@ -0,0 +1,50 @@
+"""Tests for reading accession lists."""
+
+from io import StringIO
+
+from ncbi_acc_download.accessions import (
+    guess_molecule,
+    iter_deduplicated,
+    iter_unique,
+    read_accessions,
+)
+
+
+def test_read_accessions():
+    handle = StringIO(u'NC_000913.3\n\n  AB_12345 \n# a comment\nWP_1,WP_2, WP_3\n')
+    assert list(read_accessions(handle)) == ['NC_000913.3', 'AB_12345', 'WP_1', 'WP_2', 'WP_3']
+
+
+def test_read_accessions_lazy():
+    def lines():
+        yield u'FOO\n'
+        raise AssertionError("Read too far")
+
+    accessions = read_accessions(lines())
+    assert next(accessions) == 'FOO'
+
+
+def test_iter_deduplicated():
+    ids = ['NC_000913', ' nc_000913.3', 'WP_1', 'NC_000913.3', 'wp_1 ']
+    assert list(iter_deduplicated(ids)) == [
+        (0, 'NC_000913', 'NC_000913', True),
+        (1, ' nc_000913.3', 'NC_000913.3', True),
+        (2, 'WP_1', 'WP_1', True),
+        (3, 'NC_000913.3', 'NC_000913.3', False),
+        (4, 'wp_1 ', 'WP_1', False),
+    ]
+    assert list(iter_unique(ids)) == ['NC_000913', 'NC_000913.3', 'WP_1']
+
+
+def test_iter_unique_lazy():
+    def lines():
+        yield u'FOO'
+        raise AssertionError("Read too far")
+
+    assert next(iter_unique(lines())) == 'FOO'
+
+
+def test_guess_molecule():
+    assert guess_molecule('NC_000913.3') == 'nucleotide'
+    assert guess_molecule('wp_012345') == 'protein'
+    assert guess_molecule('AB012345') is None
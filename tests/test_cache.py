@@ -0,0 +1,174 @@
+"""Tests for the response cache."""
+
+import gzip
+from io import BytesIO, StringIO
+import os
+import time
+import pytest
+
+from ncbi_acc_download.cache import ResponseCache
+from ncbi_acc_download.core import (
+    Config,
+    ENTREZ_URL,
+)
+from ncbi_acc_download import core
+from ncbi_acc_download import download
+from ncbi_acc_download.errors import (
+    BadPatternError,
+    DownloadError,
+)
+
+
+def test_key():
+    params = dict(tool='ncbi-acc-download', id='FOO', db='nucleotide', api_key='SECRET')
+    key = ResponseCache.key(ENTREZ_URL, params)
+    assert key == ResponseCache.key(ENTREZ_URL, dict(db='nucleotide', id='FOO'))
+    assert key != ResponseCache.key(ENTREZ_URL, dict(db='protein', id='FOO'))
+
+
+def test_cache_hit(req, tmpdir):
+    req.get(ENTREZ_URL, text='This works.')
+    cfg = Config(cache_dir=str(tmpdir.join('cache')))
+    params = download.build_params('FOO', cfg)
+
+    for _ in range(2):
+        handle = StringIO()
+        r = download.get_stream(ENTREZ_URL, params, cfg)
+        download.write_stream(r, handle, 'FOO', cfg)
+        assert handle.getvalue() == 'This works.'
+
+    assert req.call_count == 1
+
+
+def test_cache_refresh(req, tmpdir):
+    req.get(ENTREZ_URL, text='This works.')
+    cache_dir = str(tmpdir.join('cache'))
+    cfg = Config(cache_dir=cache_dir)
+    params = download.build_params('FOO', cfg)
+    download.write_stream(download.get_stream(ENTREZ_URL, params, cfg), StringIO(), 'FOO', cfg)
+
+    req.get(ENTREZ_URL, text='This is new.')
+    cfg = Config(cache_dir=cache_dir, refresh=True)
+    handle = StringIO()
+    download.write_stream(download.get_stream(ENTREZ_URL, params, cfg), handle, 'FOO', cfg)
+    assert handle.getvalue() == 'This is new.'
+    assert req.call_count == 2
+
+    cfg = Config(cache_dir=cache_dir)
+    handle = StringIO()
+    download.write_stream(download.get_stream(ENTREZ_URL, params, cfg), handle, 'FOO', cfg)
+    assert handle.getvalue() == 'This is new.'
+    assert req.call_count == 2
+
+
+def test_cache_ttl(req, tmpdir):
+    req.get(ENTREZ_URL, text='This works.')
+    cfg = Config(cache_dir=str(tmpdir.join('cache')), cache_ttl=60)
+    params = download.build_params('FOO', cfg)
+    download.write_stream(download.get_stream(ENTREZ_URL, params, cfg), StringIO(), 'FOO', cfg)
+
+    path = cfg.cache.path(cfg.cache.key(ENTREZ_URL, params))
+    assert cfg.cache.get(ENTREZ_URL, params) is not None
+    old = time.time() - 120
+    os.utime(path, (old, old))
+    assert cfg.cache.get(ENTREZ_URL, params) is None
+
+
+def test_cache_skips_errors(req, tmpdir):
+    req.get(ENTREZ_URL, text='ID list is empty')
+    cfg = Config(cache_dir=str(tmpdir.join('cache')))
+    params = download.build_params('FOO', cfg)
+    with pytest.raises(BadPatternError):
+        download.write_stream(download.get_stream(ENTREZ_URL, params, cfg), StringIO(), 'FOO', cfg)
+
+    assert cfg.cache.get(ENTREZ_URL, params) is None
+    assert cfg.cache.entries() == []
+
+
+def test_cache_evict(tmpdir):
+    cache = ResponseCache(str(tmpdir.join('cache')), max_size=100)
+    now = time.time()
+    for i, name in enumerate(('aa', 'bb', 'cc')):
+        path = cache.path(name * 32)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as handle:
+            handle.write(b'x' * 40)
+        os.utime(path, (now - 100 + i, now))
+
+    cache.evict()
+
+    remaining = sorted(os.path.basename(path) for path, _, _ in cache.entries())
+    assert remaining == ['{}.gz'.format('bb' * 32), '{}.gz'.format('cc' * 32)]
+
+
+def test_cache_keeps_raw_bytes(req, tmpdir):
+    """Test cache hits give the same bytes and text as the network, whatever the encoding."""
+    body = u'\u03a9 works.'.encode('utf-8')
+    req.get(ENTREZ_URL, content=body, headers={'Content-Type': 'text/plain; charset=ISO-8859-1'})
+    cfg = Config(cache_dir=str(tmpdir.join('cache')))
+    params = download.build_params('FOO', cfg)
+
+    texts = []
+    for _ in range(2):
+        handle = StringIO()
+        download.write_stream(download.get_stream(ENTREZ_URL, params, cfg), handle, 'FOO', cfg)
+        texts.append(handle.getvalue())
+    assert texts[0] == body.decode('iso-8859-1')
+    assert texts[1] == texts[0]
+
+    handle = BytesIO()
+    download.write_stream(download.get_stream(ENTREZ_URL, params, cfg), handle, 'FOO', cfg)
+    assert handle.getvalue() == body
+    assert req.call_count == 1
+
+
+@pytest.mark.parametrize('content', [
+    u'\u03a9 works.\nline 2\n'.encode('utf-8'),
+    b'#ncbi-acc-download cache entry {"encod',
+    b'',
+])
+def test_cache_broken_entry(tmpdir, content):
+    """Test entries without a valid header are cache misses."""
+    cache = ResponseCache(str(tmpdir.join('cache')))
+    params = dict(id='FOO')
+    path = cache.path(cache.key(ENTREZ_URL, params))
+    os.makedirs(os.path.dirname(path))
+    with gzip.open(path, 'wb') as handle:
+        handle.write(content)
+    assert cache.get(ENTREZ_URL, params) is None
+
+    with open(path, 'wb') as handle:
+        handle.write(b'not gzip')
+    assert cache.get(ENTREZ_URL, params) is None
+
+
+def test_cache_size_tracked(req, tmpdir, mocker):
+    """Test the cache directory isn't scanned for every stored response."""
+    req.get(ENTREZ_URL, text='This works.')
+    cfg = Config(cache_dir=str(tmpdir.join('cache')), cache_max_size=10000)
+    entries = mocker.spy(ResponseCache, 'entries')
+
+    for i in range(5):
+        params = download.build_params('FOO{}'.format(i), cfg)
+        download.write_stream(download.get_stream(ENTREZ_URL, params, cfg), StringIO(), 'FOO', cfg)
+
+    assert entries.call_count == 1
+    assert len(cfg.cache.entries()) == 5
+
+
+def test_offline(req, tmpdir):
+    req.get(ENTREZ_URL, text='This works.')
+    cache_dir = str(tmpdir.join('cache'))
+    with pytest.raises(ValueError):
+        Config(offline=True)
+
+    cfg = Config(cache_dir=cache_dir, offline=True)
+    with pytest.raises(DownloadError):
+        download.get_stream(ENTREZ_URL, download.build_params('FOO', cfg), cfg)
+    assert req.call_count == 0
+
+    outdir = tmpdir.mkdir('outdir')
+    core.download_to_file('FOO', Config(cache_dir=cache_dir), filename=str(outdir.join('online')))
+    core.download_to_file('FOO', cfg, filename=str(outdir.join('offline')))
+    assert outdir.join('offline.gbk').read() == 'This works.'
+    assert req.call_count == 1
@@ -0,0 +1,80 @@
+"""Tests for the download checkpointing."""
+
+import pytest
+
+from ncbi_acc_download.checkpoint import Journal
+
+
+def test_journal_commit(tmpdir):
+    filename = tmpdir.join('out.txt')
+    with Journal(str(filename)) as journal:
+        journal.handle.write('first\n')
+        journal.mark_done('a')
+        assert tmpdir.join('out.txt.part').check()
+        assert tmpdir.join('out.txt.journal').check()
+        assert not filename.check()
+
+    assert filename.read() == 'first\n'
+    assert tmpdir.listdir() == [filename]
+
+
+def test_journal_failure_keeps_part(tmpdir):
+    filename = tmpdir.join('out.txt')
+    with pytest.raises(RuntimeError):
+        with Journal(str(filename)) as journal:
+            journal.handle.write('first\n')
+            journal.mark_done('a')
+            raise RuntimeError("Download died")
+
+    assert not filename.check()
+    assert tmpdir.join('out.txt.part').read() == 'first\n'
+
+
+def test_journal_resume(tmpdir):
+    filename = tmpdir.join('out.txt')
+    with pytest.raises(RuntimeError):
+        with Journal(str(filename)) as journal:
+            journal.handle.write('first\n')
+            journal.mark_done('a')
+            journal.handle.write('incomplete')
+            raise RuntimeError("Download died")
+
+    # without resuming, everything starts from scratch
+    journal = Journal(str(filename), resume=True)
+    assert not journal.finished
+    with journal:
+        assert journal.is_done('a')
+        assert not journal.is_done('b')
+        journal.handle.write('second\n')
+        journal.mark_done('b')
+
+    assert filename.read() == 'first\nsecond\n'
+    assert Journal(str(filename), resume=True).finished
+    assert not Journal(str(filename)).finished
+
+
+def test_journal_no_resume(tmpdir):
+    filename = tmpdir.join('out.txt')
+    with pytest.raises(RuntimeError):
+        with Journal(str(filename)) as journal:
+            journal.handle.write('first\n')
+            journal.mark_done('a')
+            raise RuntimeError("Download died")
+
+    with Journal(str(filename)) as journal:
+        assert not journal.is_done('a')
+        journal.handle.write('new\n')
+
+    assert filename.read() == 'new\n'
+
+
+def test_journal_truncated_entry(tmpdir):
+    filename = tmpdir.join('out.txt')
+    tmpdir.join('out.txt.part').write('first\nsecond\n')
+    tmpdir.join('out.txt.journal').write('{"key": "a", "offset": 6}\n{"key": "b", "off')
+
+    with Journal(str(filename), resume=True) as journal:
+        assert journal.is_done('a')
+        assert not journal.is_done('b')
+
+    assert filename.read() == 'first\n'
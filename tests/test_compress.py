@@ -0,0 +1,123 @@
+"""Tests for the compressed output."""
+
+import gzip
+from io import BytesIO
+import struct
+import pytest
+
+from ncbi_acc_download import compress
+from ncbi_acc_download.compress import (
+    BGZF_EOF,
+    CompressedWriter,
+    open_compressed,
+)
+
+
+def test_gzip():
+    raw = BytesIO()
+    writer = CompressedWriter(raw, 'gzip')
+    writer.write(b'>foo\nATGC\n')
+    writer.end_member()
+    writer.write(b'>bar\nGGCC\n')
+    raw.close = lambda: None
+    writer.close()
+
+    assert gzip.decompress(raw.getvalue()) == b'>foo\nATGC\n>bar\nGGCC\n'
+
+
+def test_gzip_cut_at_member():
+    raw = BytesIO()
+    raw.close = lambda: None
+    writer = CompressedWriter(raw, 'gzip')
+    writer.write(b'>foo\nATGC\n')
+    writer.end_member()
+    offset = raw.tell()
+    writer.write(b'>bar\nGG')
+    writer.close()
+
+    assert gzip.decompress(raw.getvalue()[:offset]) == b'>foo\nATGC\n'
+
+
+def _bgzf_blocks(data):
+    blocks = []
+    while data:
+        assert data[:4] == b'\x1f\x8b\x08\x04'
+        xlen, = struct.unpack('<H', data[10:12])
+        assert data[12:14] == b'BC'
+        bsize, = struct.unpack('<H', data[16:18])
+        blocks.append(data[:bsize + 1])
+        data = data[bsize + 1:]
+    return blocks
+
+
+def test_bgzip():
+    raw = BytesIO()
+    raw.close = lambda: None
+    payload = b'ACGT' * 40000
+    writer = CompressedWriter(raw, 'bgzip')
+    writer.write(payload)
+    writer.close()
+
+    blocks = _bgzf_blocks(raw.getvalue())
+    assert len(blocks) == 4
+    assert blocks[-1] == BGZF_EOF
+    assert gzip.decompress(raw.getvalue()) == payload
+
+
+def test_zstd():
+    zstandard = pytest.importorskip('zstandard')
+    raw = BytesIO()
+    raw.close = lambda: None
+    writer = CompressedWriter(raw, 'zstd')
+    writer.write(b'>foo\nATGC\n')
+    writer.end_member()
+    writer.write(b'>bar\nGGCC\n')
+    writer.close()
+
+    reader = zstandard.ZstdDecompressor().stream_reader(BytesIO(raw.getvalue()), read_across_frames=True)
+    assert reader.read() == b'>foo\nATGC\n>bar\nGGCC\n'
+
+
+def test_zstd_unavailable(monkeypatch):
+    monkeypatch.setattr(compress, 'HAVE_ZSTD', False)
+    with pytest.raises(ValueError):
+        CompressedWriter(BytesIO(), 'zstd')
+
+
+def test_invalid_method():
+    with pytest.raises(ValueError):
+        CompressedWriter(BytesIO(), 'rar')
+
+
+def test_open_compressed_text(tmpdir):
+    filename = str(tmpdir.join('out.gz'))
+    with open_compressed(filename, 'w', 'gzip', binary=False) as handle:
+        handle.write(u'>foo Ωmega\nATGC\n')
+        assert handle.seekable()
+
+    with gzip.open(filename, 'rt', encoding='utf-8') as handle:
+        assert handle.read() == u'>foo Ωmega\nATGC\n'
+
+
+@pytest.mark.parametrize('method', ['gzip', 'bgzip'])
+@pytest.mark.parametrize('binary', [False, True])
+def test_open_compressed_truncate(tmpdir, method, binary):
+    """Test the output can be cut back to the last position told, like for retrying a download."""
+    filename = str(tmpdir.join('out.gz'))
+
+    def data(text):
+        return text.encode('utf-8') if binary else text
+
+    with open_compressed(filename, 'w', method, binary) as handle:
+        handle.write(data(u'>foo\nATGC\n'))
+        start = handle.tell()
+        assert start == 10
+        handle.write(data(u'>bar\nGG'))
+        with pytest.raises(OSError):
+            handle.seek(3)
+        handle.seek(start)
+        handle.truncate()
+        handle.write(data(u'>bar\nGGCC\n'))
+
+    with gzip.open(filename, 'rb') as handle:
+        assert handle.read() == b'>foo\nATGC\n>bar\nGGCC\n'
@@ -1,21 +1,33 @@
 """Tests for the core module."""
 
 from argparse import Namespace
+import gzip
 from io import StringIO
+import os
 import pytest
 import requests
+from urllib.parse import parse_qs, urlsplit
 
 from ncbi_acc_download import core
 from ncbi_acc_download.core import (
     ENTREZ_URL,
     SVIEWER_URL,
 )
+from ncbi_acc_download.download import TRANSIENT_PATTERNS
 from ncbi_acc_download.errors import (
     BadPatternError,
     DownloadError,
     InvalidIdError,
     TooManyRequests,
+    ValidationError,
 )
+from ncbi_acc_download.records import get_accession, iter_records
+from ncbi_acc_download.regions import Region
+from ncbi_acc_download.split import record_path
+
+
+def full_path(name):
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), name))
 
 
 def test_config():
@@ -40,6 +52,10 @@ def test_config_no_biopython(monkeypatch):
     with pytest.raises(ValueError):
         core.Config.from_args(args)
 
+    # the built-in checks don't need Biopython
+    args = Namespace(extended_validation='loads')
+    assert core.Config.from_args(args).extended_validation == 'loads'
+
 
 def test_config_have_biopython():
     """Test we detect Biopython."""
@@ -187,6 +203,12 @@ def test_generate_filename():
     filename = core._generate_filename(params, None)
     assert filename == 'TEST.fa'
 
+    filename = core._generate_filename(params, None, 'bgzip')
+    assert filename == 'TEST.fa.gz'
+
+    filename = core._generate_filename(params, None, 'zstd')
+    assert filename == 'TEST.fa.zst'
+
 
 def test_validate_and_write_error_pattern_raises(req):
     """Test scanning the download file for error patterns."""
@@ -273,3 +295,717 @@ def test_generate_url_with_api_key():
     config.format = 'gff3'
     expected = "{}?{}".format(SVIEWER_URL, "retmode=text&id=FAKE&db=nucleotide&api_key=FAKE&report=gff3")
     assert expected == core.generate_url("FAKE", config)
+
+
+def test_download_batch_to_files(req, tmpdir):
+    """Test downloading multiple IDs with one request and splitting them into files."""
+    req.get(ENTREZ_URL, text='>FOO.1 first\nATGC\n>BAR.2 second\nGGCC\n')
+    outdir = tmpdir.mkdir('outdir')
+    filenames = [str(outdir.join('foo')), str(outdir.join('bar'))]
+    config = core.Config(molecule='nucleotide', format='fasta', verbose=False)
+
+    core.download_batch_to_files(['BAR', 'FOO'], config, filenames)
+
+    assert req.call_count == 1
+    assert req.last_request.qs['id'] == ['bar,foo']
+    assert outdir.join('foo.fa').read() == '>BAR.2 second\nGGCC\n'
+    assert outdir.join('bar.fa').read() == '>FOO.1 first\nATGC\n'
+
+
+def test_download_batch_to_files_genbank(req, tmpdir):
+    """Test the files of a GenBank batch look like single downloads, without a blank line at the start."""
+    req.get(ENTREZ_URL, text='LOCUS       FOO\nVERSION     FOO.1\n//\n\nLOCUS       BAR\nVERSION     BAR.2\n//\n\n')
+    outdir = tmpdir.mkdir('outdir')
+    filenames = [str(outdir.join('foo')), str(outdir.join('bar'))]
+    config = core.Config(molecule='nucleotide', verbose=False)
+
+    core.download_batch_to_files(['FOO', 'BAR'], config, filenames)
+
+    assert outdir.join('foo.gbk').read() == 'LOCUS       FOO\nVERSION     FOO.1\n//\n\n'
+    assert outdir.join('bar.gbk').read() == 'LOCUS       BAR\nVERSION     BAR.2\n//\n\n'
+
+
+def test_download_batch_to_files_unmatched(req, tmpdir):
+    """Test records that can't be matched by accession are assigned in order."""
+    req.get(ENTREZ_URL, text='>gi|1 first\nATGC\n>gi|2 second\nGGCC\n')
+    outdir = tmpdir.mkdir('outdir')
+    filenames = [str(outdir.join('one')), str(outdir.join('two'))]
+    config = core.Config(molecule='protein', verbose=False)
+
+    core.download_batch_to_files(['1', '2'], config, filenames)
+
+    assert outdir.join('one.fa').read() == '>gi|1 first\nATGC\n'
+    assert outdir.join('two.fa').read() == '>gi|2 second\nGGCC\n'
+
+
+def test_download_batch_to_files_missing(req, tmpdir):
+    """Test IDs NCBI returns no record for are reported, after writing the records that were returned."""
+    req.get(ENTREZ_URL, text='>A.1 first\nATGC\n>C.1 third\nGGCC\n')
+    outdir = tmpdir.mkdir('outdir')
+    filenames = [str(outdir.join(name)) for name in ('a', 'b', 'c')]
+    config = core.Config(molecule='nucleotide', format='fasta', verbose=False)
+
+    with pytest.raises(DownloadError, match="no record for id\\(s\\) B$"):
+        core.download_batch_to_files(['A', 'B', 'C'], config, filenames)
+
+    assert req.call_count == 1
+    assert outdir.join('a.fa').read() == '>A.1 first\nATGC\n'
+    assert outdir.join('c.fa').read() == '>C.1 third\nGGCC\n'
+    assert sorted(path.basename for path in outdir.listdir()) == ['a.fa', 'c.fa']
+
+
+def test_download_batch_to_files_retry(req, tmpdir):
+    """Test records written before a download broke off are thrown away when retrying."""
+    pattern = sorted(TRANSIENT_PATTERNS)[0]
+    req.get(ENTREZ_URL, response_list=[
+        {"text": '>FOO.1 first\nATGC\n>BAR.2 sec\n{}\n'.format(pattern)},
+        {"text": '>FOO.1 first\nATGC\n>BAR.2 second\nGGCC\n'},
+    ])
+    outdir = tmpdir.mkdir('outdir')
+    filenames = [str(outdir.join('foo')), str(outdir.join('bar'))]
+    config = core.Config(molecule='nucleotide', format='fasta', verbose=False, retry_backoff=0)
+
+    core.download_batch_to_files(['FOO', 'BAR'], config, filenames)
+
+    assert req.call_count == 2
+    assert outdir.join('foo.fa').read() == '>FOO.1 first\nATGC\n'
+    assert outdir.join('bar.fa').read() == '>BAR.2 second\nGGCC\n'
+    assert sorted(path.basename for path in outdir.listdir()) == ['bar.fa', 'foo.fa']
+
+
+def test_download_batch_to_files_unsplittable(req, tmpdir):
+    """Test formats we can't split are downloaded one request per ID."""
+    req.get(SVIEWER_URL, text='##gff-version 3\n')
+    outdir = tmpdir.mkdir('outdir')
+    filenames = [str(outdir.join('foo')), str(outdir.join('bar'))]
+    config = core.Config(molecule='nucleotide', format='gff3', verbose=False)
+
+    core.download_batch_to_files(['FOO', 'BAR'], config, filenames)
+
+    assert req.call_count == 2
+    assert outdir.join('foo.gff').check()
+    assert outdir.join('bar.gff').check()
+
+
+def test_config_jobs():
+    """Test the config validates the parallel download settings."""
+    config = core.Config(jobs=4, batch_size=10)
+    assert config.jobs == 4
+    assert config.batch_size == 10
+    assert config.limiter.rate == 3
+
+    config = core.Config(api_key='FAKE')
+    assert config.limiter.rate == 10
+
+    with pytest.raises(ValueError):
+        core.Config(jobs=0)
+
+    with pytest.raises(ValueError):
+        core.Config(batch_size=0)
+
+
+def test_download_ids_parallel(req, tmpdir, unthrottled):
+    """Test downloading IDs into separate files in parallel."""
+    req.get(ENTREZ_URL, text='This works.\n')
+    outdir = tmpdir.mkdir('outdir')
+    config = core.Config(molecule='nucleotide', verbose=False, jobs=3)
+
+    core.download_ids(['FOO', 'BAR', 'BAZ'], config, prefix=str(outdir.join('seq')))
+
+    assert req.call_count == 3
+    for i in range(3):
+        assert outdir.join('seq_{}.gbk'.format(i)).check()
+
+
+def test_download_ids_parallel_out(req, tmpdir, unthrottled):
+    """Test parallel downloads into a single file keep the order of the IDs."""
+    def callback(request, context):
+        return '{}\n'.format(request.qs['id'][0])
+
+    req.get(ENTREZ_URL, text=callback)
+    outdir = tmpdir.mkdir('outdir')
+    filename = outdir.join('out.txt')
+    config = core.Config(molecule='nucleotide', verbose=False, jobs=4, out=str(filename))
+
+    core.download_ids(['A', 'B', 'C', 'D', 'E'], config, out=str(filename))
+
+    assert filename.read() == 'a\nb\nc\nd\ne\n'
+    assert outdir.listdir() == [filename]
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_download_ids_gff3_out(req, tmpdir, jobs, unthrottled):
+    """Test GFF3 downloads into a single file still use one request per ID."""
+    req.get(SVIEWER_URL, text='##gff-version 3\n')
+    filename = tmpdir.join('out.gff')
+    config = core.Config(molecule='nucleotide', verbose=False, format='gff3', batch_size=3, jobs=jobs,
+                         out=str(filename))
+
+    core.download_ids(['A', 'B', 'C'], config, out=str(filename))
+
+    assert req.call_count == 3
+    assert sorted(request.qs['id'][0] for request in req.request_history) == ['a', 'b', 'c']
+
+
+def test_request_batch_size():
+    assert core.request_batch_size(core.Config(batch_size=5)) == 5
+    assert core.request_batch_size(core.Config(batch_size=5, format='gff3')) == 1
+
+
+def test_download_ids_parallel_error(req, tmpdir, unthrottled):
+    """Test errors in a parallel download are raised."""
+    req.get(ENTREZ_URL, text='Nope!', status_code=404)
+    outdir = tmpdir.mkdir('outdir')
+    filename = outdir.join('out.txt')
+    config = core.Config(molecule='nucleotide', verbose=False, jobs=2, out=str(filename))
+
+    with pytest.raises(InvalidIdError):
+        core.download_ids(['A', 'B', 'C'], config, out=str(filename))
+
+
+def test_config_session():
+    """Test the config sets up a connection pool for all parallel downloads."""
+    config = core.Config(jobs=4)
+    assert config.session.get_adapter(ENTREZ_URL)._pool_maxsize == 4
+
+    config = core.Config(jobs=4, pool_size=8)
+    assert config.session.get_adapter(ENTREZ_URL)._pool_maxsize == 8
+
+    # WGS parts are downloaded on a shared pool, next to the records they belong to
+    config = core.Config(jobs=4, recursive=True)
+    assert config.session.get_adapter(ENTREZ_URL)._pool_maxsize == 8
+    assert config.wgs_executor._max_workers == 4
+    config.wgs_executor.shutdown()
+    assert core.Config(recursive=True).wgs_executor is None
+
+    with pytest.raises(ValueError):
+        core.Config(pool_size=0)
+
+
+def test_download_to_file_recursive(req, tmpdir, unthrottled):
+    """Test recursive downloads are written straight to the output file."""
+    with open(full_path('wgs.gbk'), 'rt') as handle:
+        master = handle.read()
+    with open(full_path('wgs_full.gbk'), 'rt') as handle:
+        full_file = handle.read()
+    req.get(ENTREZ_URL, response_list=[{"text": master}, {"text": full_file}])
+    outdir = tmpdir.mkdir('outdir')
+    config = core.Config(molecule='nucleotide', verbose=False, recursive=True)
+
+    core.download_to_file('NZ_BASQ00000000', config, filename=str(outdir.join('foo')))
+
+    assert outdir.join('foo.gbk').read() == full_file
+
+
+def test_download_to_file_recursive_validation(req, tmpdir, unthrottled):
+    """Test recursive downloads validate the parts written, not the WGS records they replace."""
+    with open(full_path('wgs.gbk'), 'rt') as handle:
+        master = handle.read()
+    with open(full_path('wgs_full.gbk'), 'rt') as handle:
+        full_file = handle.read()
+    contigs = list(iter_records(full_file.splitlines(True), 'genbank'))
+    bad_contig = contigs[1].replace('\n        1 ', '\n        1 !!!', 1)
+    assert bad_contig != contigs[1]
+
+    req.get(ENTREZ_URL, response_list=[{"text": master}, {"text": full_file}])
+    outdir = tmpdir.mkdir('outdir')
+    config = core.Config(molecule='nucleotide', verbose=False, recursive=True, extended_validation='loads')
+    core.download_to_file('NZ_BASQ00000000', config, filename=str(outdir.join('good')))
+    assert outdir.join('good.gbk').read() == full_file
+
+    req.get(ENTREZ_URL, response_list=[{"text": master}, {"text": contigs[0] + bad_contig + contigs[2]}])
+    with pytest.raises(ValidationError, match="BASQ01000002"):
+        core.download_to_file('NZ_BASQ00000000', config, filename=str(outdir.join('bad')))
+    assert not outdir.join('bad.gbk').check()
+
+
+def test_download_to_file_resume(req, tmpdir, unthrottled):
+    """Test resuming an interrupted recursive download only fetches the missing contigs."""
+    with open(full_path('wgs.gbk'), 'rt') as handle:
+        master = handle.read()
+    with open(full_path('wgs_full.gbk'), 'rt') as handle:
+        full_file = handle.read()
+    contigs = list(iter_records(full_file.splitlines(True), 'genbank'))
+
+    req.get(ENTREZ_URL, response_list=[
+        {"text": master},
+        {"text": contigs[0]},
+        {"text": contigs[1]},
+        {"text": 'Nope!', "status_code": 500},
+    ])
+    outdir = tmpdir.mkdir('outdir')
+    config = core.Config(molecule='nucleotide', verbose=False, recursive=True, retries=0, wgs_batch_size=1)
+
+    with pytest.raises(InvalidIdError):
+        core.download_to_file('NZ_BASQ00000000', config, filename=str(outdir.join('foo')))
+    assert not outdir.join('foo.gbk').check()
+
+    req.get(ENTREZ_URL, response_list=[
+        {"text": master},
+        {"text": contigs[2]},
+    ])
+    config = core.Config(molecule='nucleotide', verbose=False, recursive=True, resume=True, wgs_batch_size=1)
+    core.download_to_file('NZ_BASQ00000000', config, filename=str(outdir.join('foo')))
+
+    assert outdir.join('foo.gbk').read() == full_file
+    assert outdir.listdir() == [outdir.join('foo.gbk')]
+    assert req.call_count == 6
+
+    # A finished download isn't fetched again
+    core.download_to_file('NZ_BASQ00000000', config, filename=str(outdir.join('foo')))
+    assert req.call_count == 6
+
+
+def test_download_ids_resume_out(req, tmpdir, unthrottled):
+    """Test resuming a combined download skips the IDs that were already written."""
+    def callback(request, context):
+        if request.qs['id'][0] == 'c':
+            context.status_code = 500
+        return '{}\n'.format(request.qs['id'][0])
+
+    req.get(ENTREZ_URL, text=callback)
+    outdir = tmpdir.mkdir('outdir')
+    filename = outdir.join('out.txt')
+    config = core.Config(molecule='nucleotide', verbose=False, out=str(filename), retries=0)
+
+    with pytest.raises(InvalidIdError):
+        core.download_ids(['A', 'B', 'C', 'D'], config, out=str(filename))
+
+    req.get(ENTREZ_URL, text=lambda request, context: '{}\n'.format(request.qs['id'][0]))
+    config = core.Config(molecule='nucleotide', verbose=False, out=str(filename), resume=True)
+    core.download_ids(['A', 'B', 'C', 'D'], config, out=str(filename))
+
+    assert filename.read() == 'a\nb\nc\nd\n'
+    assert req.call_count == 5
+
+
+def test_download_to_file_raw_bytes(req, tmpdir):
+    """Test downloads without validation are written byte for byte."""
+    content = u'>foo Ωmega\nATGC\n'.encode('utf-8')
+    req.get(ENTREZ_URL, content=content, headers={"Content-Type": "text/plain; charset=ISO-8859-1"})
+    outdir = tmpdir.mkdir('outdir')
+    config = core.Config(molecule='protein', verbose=False)
+
+    core.download_to_file('FOO', config, filename=str(outdir.join('foo')))
+
+    assert outdir.join('foo.fa').read_binary() == content
+
+
+def test_download_to_file_compressed(req, tmpdir):
+    """Test downloads are compressed on the fly."""
+    req.get(ENTREZ_URL, text='This works.\n')
+    outdir = tmpdir.mkdir('outdir')
+    config = core.Config(molecule='nucleotide', verbose=False, compress='gzip')
+
+    core.download_to_file('FOO', config, filename=str(outdir.join('foo')))
+
+    with gzip.open(str(outdir.join('foo.gbk.gz')), 'rb') as handle:
+        assert handle.read() == b'This works.\n'
+
+
+def test_download_to_file_compressed_retry(req, tmpdir):
+    """Test compressed downloads failing halfway are retried, throwing away the partial output."""
+    pattern = sorted(TRANSIENT_PATTERNS)[0]
+    req.get(ENTREZ_URL, response_list=[
+        {"text": '>FOO.1 first\nATGC\n{}\n'.format(pattern)},
+        {"text": '>FOO.1 first\nATGC\n'},
+    ])
+    outdir = tmpdir.mkdir('outdir')
+    config = core.Config(molecule='nucleotide', format='fasta', verbose=False, compress='bgzip', chunk_size=8,
+                         retry_backoff=0)
+
+    core.download_to_file('FOO', config, filename=str(outdir.join('foo')))
+
+    assert req.call_count == 2
+    with gzip.open(str(outdir.join('foo.fa.gz')), 'rb') as handle:
+        assert handle.read() == b'>FOO.1 first\nATGC\n'
+
+
+def test_download_to_file_resume_compressed(req, tmpdir, unthrottled):
+    """Test resuming an interrupted compressed recursive download."""
+    with open(full_path('wgs.gbk'), 'rt') as handle:
+        master = handle.read()
+    with open(full_path('wgs_full.gbk'), 'rt') as handle:
+        full_file = handle.read()
+    contigs = list(iter_records(full_file.splitlines(True), 'genbank'))
+
+    req.get(ENTREZ_URL, response_list=[
+        {"text": master},
+        {"text": contigs[0]},
+        {"text": 'Nope!', "status_code": 500},
+    ])
+    outdir = tmpdir.mkdir('outdir')
+    config = core.Config(molecule='nucleotide', verbose=False, recursive=True, retries=0, compress='bgzip',
+                         wgs_batch_size=1)
+    with pytest.raises(InvalidIdError):
+        core.download_to_file('NZ_BASQ00000000', config, filename=str(outdir.join('foo')))
+
+    req.get(ENTREZ_URL, response_list=[
+        {"text": master},
+        {"text": contigs[1]},
+        {"text": contigs[2]},
+    ])
+    config = core.Config(molecule='nucleotide', verbose=False, recursive=True, resume=True, compress='bgzip',
+                         wgs_batch_size=1)
+    core.download_to_file('NZ_BASQ00000000', config, filename=str(outdir.join('foo')))
+
+    with gzip.open(str(outdir.join('foo.gbk.gz')), 'rt') as handle:
+        assert handle.read() == full_file
+
+
+def test_config_compress(monkeypatch):
+    """Test the config checks the compression method."""
+    with pytest.raises(ValueError):
+        core.Config(compress='rar')
+
+    monkeypatch.setattr(core, 'HAVE_ZSTD', False)
+    with pytest.raises(ValueError):
+        core.Config(compress='zstd')
+
+
+def test_iter_batches():
+    """Test grouping IDs into batches."""
+    assert list(core.iter_batches(iter(['A', 'B', 'C', 'D', 'E']), 2)) == [
+        (0, ['A', 'B']), (2, ['C', 'D']), (4, ['E'])]
+    assert list(core.iter_batches([], 2)) == []
+
+
+def test_download_ids_lazy(req, tmpdir, unthrottled):
+    """Test IDs are read lazily while downloading."""
+    req.get(ENTREZ_URL, text='This works.\n')
+    outdir = tmpdir.mkdir('outdir')
+    config = core.Config(molecule='nucleotide', verbose=False, jobs=2)
+    consumed = []
+
+    def dl_ids():
+        for i in range(20):
+            consumed.append(i)
+            # never more than a few batches ahead of the finished downloads
+            assert len(consumed) - req.call_count <= 2 * config.jobs + 1
+            yield 'ID{}'.format(i)
+
+    core.download_ids(dl_ids(), config, prefix=str(outdir.join('seq')))
+
+    assert req.call_count == 20
+    assert len(outdir.listdir()) == 20
+
+
+def test_download_ids_dedupe(req, tmpdir, unthrottled):
+    """Test every record is only downloaded once, but written for every request."""
+    def callback(request, context):
+        ids = parse_qs(urlsplit(request.url).query)['id'][0].split(',')
+        return ''.join('>{}\nACGT\n'.format(dl_id) for dl_id in ids)
+
+    req.get(ENTREZ_URL, text=callback)
+    outdir = tmpdir.mkdir('outdir')
+    config = core.Config(molecule='nucleotide', verbose=False, format='fasta', batch_size=2, dedupe=True)
+
+    core.download_ids(['NC_1.1', 'nc_1.1 ', 'NC_2.1', 'NC_1', 'NC_2.1 '], config, prefix=str(outdir.join('seq')))
+
+    assert req.call_count == 2
+    assert parse_qs(urlsplit(req.request_history[0].url).query)['id'] == ['NC_1.1,NC_2.1']
+    assert parse_qs(urlsplit(req.request_history[1].url).query)['id'] == ['NC_1']
+    for i, accession in enumerate(['NC_1.1', 'NC_1.1', 'NC_2.1', 'NC_1', 'NC_2.1']):
+        assert outdir.join('seq_{}.fa'.format(i)).read() == '>{}\nACGT\n'.format(accession)
+
+
+def test_download_ids_dedupe_lazy(req, tmpdir, unthrottled):
+    """Test duplicates are dropped while the IDs are read, without reading the whole list first."""
+    req.get(ENTREZ_URL, text='This works.\n')
+    outdir = tmpdir.mkdir('outdir')
+    config = core.Config(molecule='nucleotide', verbose=False, dedupe=True)
+    consumed = []
+
+    def dl_ids():
+        for i in range(20):
+            consumed.append(i)
+            assert len(consumed) - 2 * req.call_count <= 2
+            yield 'ID{}'.format(i // 2)
+
+    core.download_ids(dl_ids(), config, prefix=str(outdir.join('seq')))
+
+    assert req.call_count == 10
+    assert len(outdir.listdir()) == 20
+
+
+def test_download_ids_dedupe_names(req, tmpdir, unthrottled):
+    """Test deduplicated downloads without a prefix are named after the requested IDs."""
+    req.get(ENTREZ_URL, text='This works.\n')
+    config = core.Config(molecule='nucleotide', verbose=False, jobs=2, dedupe=True)
+
+    with tmpdir.as_cwd():
+        core.download_ids(['FOO', 'foo', 'BAR.1', 'BAR'], config)
+
+    # without a version, BAR gets the current version, which might not be BAR.1
+    assert req.call_count == 3
+    assert sorted(path.basename for path in tmpdir.listdir()) == ['BAR.1.gbk', 'BAR.gbk', 'FOO.gbk', 'foo.gbk']
+
+
+def test_download_ids_dedupe_out(req, tmpdir, unthrottled):
+    """Test combined output only contains every record once."""
+    def callback(request, context):
+        return '{}\n'.format(parse_qs(urlsplit(request.url).query)['id'][0])
+
+    req.get(ENTREZ_URL, text=callback)
+    filename = tmpdir.join('out.txt')
+    config = core.Config(molecule='nucleotide', verbose=False, out=str(filename), dedupe=True)
+
+    core.download_ids(['A', 'B', 'a', 'C', 'B'], config, out=str(filename))
+
+    assert filename.read() == 'A\nB\nC\n'
+
+
+def test_download_ids_dedupe_molecule_warning(req, tmpdir, capsys, unthrottled):
+    """Test a warning is printed for accessions of the other database."""
+    req.get(ENTREZ_URL, text='This works.\n')
+    config = core.Config(molecule='nucleotide', verbose=False, dedupe=True)
+
+    core.download_ids(['WP_000001.1', 'NC_000001.1'], config, prefix=str(tmpdir.join('seq')))
+
+    err = capsys.readouterr().err
+    assert "WP_000001.1 looks like a protein accession" in err
+    assert "NC_000001.1" not in err
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_download_split_records(req, tmpdir, jobs, unthrottled):
+    """Test every record is written to its own file, named after its accession."""
+    def callback(request, context):
+        ids = parse_qs(urlsplit(request.url).query)['id'][0].split(',')
+        return ''.join('>{}.1 record\nACGT\n'.format(dl_id) for dl_id in ids)
+
+    req.get(ENTREZ_URL, text=callback)
+    directory = str(tmpdir.join('records'))
+    config = core.Config(molecule='nucleotide', verbose=False, format='fasta', batch_size=2, jobs=jobs)
+
+    core.download_split_records(['A', 'B', 'C'], config, directory, shard_depth=1)
+
+    assert req.call_count == 2
+    for accession in ('A.1', 'B.1', 'C.1'):
+        filename = record_path(directory, accession, '.fa', 1)
+        with open(filename, 'r') as handle:
+            assert handle.read() == '>{} record\nACGT\n'.format(accession)
+    assert len(os.listdir(directory)) <= 3
+
+
+def test_download_split_records_recursive_retry(req, tmpdir, unthrottled):
+    """Test batches of WGS parts failing halfway are retried when splitting records."""
+    with open(full_path('wgs.gbk'), 'rt') as handle:
+        master = handle.read()
+    with open(full_path('wgs_full.gbk'), 'rt') as handle:
+        contigs = list(iter_records(handle, 'genbank'))
+    pattern = sorted(TRANSIENT_PATTERNS)[0]
+    req.get(ENTREZ_URL, response_list=[
+        {"text": master},
+        {"text": contigs[0]},
+        {"text": contigs[1][:200] + pattern},
+        {"text": contigs[1]},
+        {"text": contigs[2]},
+    ])
+    directory = str(tmpdir.join('records'))
+    config = core.Config(molecule='nucleotide', verbose=False, recursive=True, wgs_batch_size=1, chunk_size=64,
+                         retry_backoff=0)
+
+    core.download_split_records(['NZ_BASQ00000000'], config, directory)
+
+    assert req.call_count == 5
+    accessions = [get_accession(contig, 'genbank') for contig in contigs]
+    assert sorted(os.listdir(directory)) == sorted('{}.gbk'.format(accession) for accession in accessions)
+    for accession, contig in zip(accessions, contigs):
+        with open(record_path(directory, accession, '.gbk'), 'r') as handle:
+            assert handle.read() == contig
+
+
+def test_download_split_records_resume(req, tmpdir, unthrottled):
+    """Test IDs with a version whose file exists are skipped when resuming."""
+    req.get(ENTREZ_URL, text='>B.1 record\nACGT\n')
+    tmpdir.join('A.1.fa').write('>A.1 record\nACGT\n')
+    config = core.Config(molecule='nucleotide', verbose=False, format='fasta', resume=True)
+
+    core.download_split_records(['A.1', 'B.1'], config, str(tmpdir))
+
+    assert req.call_count == 1
+    assert req.last_request.qs['id'] == ['b.1']
+    assert tmpdir.join('B.1.fa').read() == '>B.1 record\nACGT\n'
+
+
+def test_download_split_records_invalid(tmpdir):
+    config = core.Config(molecule='nucleotide', verbose=False, format='gff3')
+    with pytest.raises(ValueError):
+        core.download_split_records(['A'], config, str(tmpdir))
+
+    config = core.Config(molecule='nucleotide', verbose=False, format='fasta')
+    with pytest.raises(ValueError):
+        core.download_split_records(['A'], config, str(tmpdir), shard_depth=-1)
+
+
+def test_config_history():
+    """Test the config rejects settings the history server can't handle."""
+    assert core.Config(history=True).history
+
+    with pytest.raises(ValueError):
+        core.Config(history=True, format='gff3')
+
+    with pytest.raises(ValueError):
+        core.Config(history=True, batch_size=10001)
+
+
+def test_download_ids_history(history_server, tmpdir, unthrottled):
+    """Test downloading IDs from the history server into separate files."""
+    outdir = tmpdir.mkdir('outdir')
+    config = core.Config(molecule='nucleotide', format='fasta', batch_size=2, history=True)
+
+    core.download_ids(['FOO', 'BAR', 'BAZ'], config, prefix=str(outdir.join('seq')))
+
+    assert history_server.posts == [['FOO', 'BAR', 'BAZ']]
+    # the last page only has a single ID, which is fetched directly
+    assert [sorted(fetch) for fetch in history_server.fetches] == [
+        ['WebEnv', 'db', 'query_key', 'retmax', 'retmode', 'retstart', 'rettype', 'tool'],
+        ['db', 'id', 'retmode', 'rettype', 'tool']]
+    assert outdir.join('seq_0.fa').read() == '>FOO.1 record\nACGT\n'
+    assert outdir.join('seq_1.fa').read() == '>BAR.1 record\nACGT\n'
+    assert outdir.join('seq_2.fa').read() == '>BAZ.1 record\nACGT\n'
+
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_download_ids_history_out(history_server, tmpdir, jobs, unthrottled):
+    """Test downloading IDs from the history server into a single file."""
+    outdir = tmpdir.mkdir('outdir')
+    filename = outdir.join('out.fa')
+    config = core.Config(molecule='protein', batch_size=2, history=True, jobs=jobs, out=str(filename))
+
+    core.download_ids(['A', 'B', 'C', 'D', 'E'], config, out=str(filename))
+
+    assert len(history_server.posts) == 1
+    assert sorted(fetch['retstart'] for fetch in history_server.fetches) == [['0'], ['2'], ['4']]
+    assert filename.read() == ''.join('>{}.1 record\nACGT\n'.format(dl_id) for dl_id in 'ABCDE')
+
+
+def test_validate_and_write_streams_records(req):
+    """Test extended validation writes valid records before the download finished."""
+    handle = StringIO()
+    req.get('http://fake/', text=u'>foo\nMAGIC\n>bar\nMAGIC\n')
+    r = requests.get('http://fake/')
+    config = core.Config(extended_validation='loads', molecule='protein', chunk_size=4)
+    core._validate_and_write(r, handle, 'FAKE', config)
+
+    assert handle.getvalue() == u'>foo\nMAGIC\n>bar\nMAGIC\n'
+
+
+def test_validate_and_write_invalid_record(req):
+    """Test extended validation fails on the first invalid record."""
+    handle = StringIO()
+    req.get('http://fake/', text=u'LOCUS broken\n//\n')
+    r = requests.get('http://fake/')
+    config = core.Config(extended_validation='all')
+
+    with pytest.raises(ValidationError, match='Record 1'):
+        core._validate_and_write(r, handle, 'FAKE', config)
+    assert handle.getvalue() == u''
+
+
+def test_config_validation_jobs():
+    """Test the config sets up a process pool for parallel validation."""
+    assert core.Config().validation_executor is None
+
+    config = core.Config(extended_validation='loads', validation_jobs=2)
+    assert config.validation_executor is not None
+    config.validation_executor.shutdown()
+
+    with pytest.raises(ValueError):
+        core.Config(validation_jobs=0)
+
+
+def test_validate_and_write_parallel_validation(req):
+    """Test validating a download in worker processes."""
+    handle = StringIO()
+    text = u''.join(u'>seq{}\nMAGIC\n'.format(i) for i in range(10))
+    req.get('http://fake/', text=text)
+    r = requests.get('http://fake/')
+    config = core.Config(extended_validation='loads', molecule='protein', validation_jobs=2)
+    try:
+        core._validate_and_write(r, handle, 'FAKE', config)
+    finally:
+        config.validation_executor.shutdown()
+
+    assert handle.getvalue() == text
+
+
+def _serve_ranges(req, sequence):
+    """Serve the requested range of a sequence as FASTA, like efetch does."""
+    def callback(request, context):
+        params = parse_qs(urlsplit(request.url).query)
+        start, end = int(params['from'][0]), int(params['to'][0])
+        return '>{}:{}-{} test\n{}\n'.format(params['id'][0], start, end, sequence[start - 1:end])
+
+    req.get(ENTREZ_URL, text=callback)
+
+
+def test_download_regions(req, tmpdir, unthrottled):
+    """Test nearby regions are downloaded with a single request and cut apart locally."""
+    sequence = 'ACGTTGCA' * 100
+    _serve_ranges(req, sequence)
+    config = core.Config(format='fasta', region_slack=50)
+    regions = [Region('NC_1.1', 10, 20), Region('NC_1.1', 500, 600), Region('NC_1.1', 40, 60)]
+
+    core.download_regions(regions, config, prefix=str(tmpdir.join('region')))
+
+    assert req.call_count == 2
+    assert tmpdir.join('region_0.fa').read() == '>NC_1.1:11-20 test\n{}\n'.format(sequence[10:20])
+    assert tmpdir.join('region_1.fa').read() == '>NC_1.1:501-600 test\n{}\n{}\n'.format(
+        sequence[500:570], sequence[570:600])
+    assert tmpdir.join('region_2.fa').read() == '>NC_1.1:41-60 test\n{}\n'.format(sequence[40:60])
+
+
+def test_download_regions_genbank(req, tmpdir, unthrottled):
+    """Test GenBank regions are downloaded one by one, even when they are close to each other."""
+    def callback(request, context):
+        params = parse_qs(urlsplit(request.url).query)
+        return 'LOCUS       {}\nACCESSION   {} REGION: {}..{}\n//\n'.format(
+            params['id'][0], params['id'][0], params['from'][0], params['to'][0])
+
+    req.get(ENTREZ_URL, text=callback)
+    filename = tmpdir.join('out.gbk')
+    config = core.Config(region_slack=50)
+    regions = [Region('NC_1.1', 10, 20), Region('NC_1.1', 15, 60)]
+
+    core.download_regions(regions, config, out=str(filename))
+
+    assert req.call_count == 2
+    assert filename.read() == ('LOCUS       NC_1.1\nACCESSION   NC_1.1 REGION: 11..20\n//\n'
+                               'LOCUS       NC_1.1\nACCESSION   NC_1.1 REGION: 16..60\n//\n')
+    assert core.region_slack(config) is None
+    assert core.region_slack(core.Config(format='fasta', region_slack=50)) == 50
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_download_regions_out(req, tmpdir, jobs, unthrottled):
+    """Test downloading regions into a single file."""
+    sequence = 'ACGTTGCA' * 100
+    _serve_ranges(req, sequence)
+    filename = tmpdir.join('out.fa')
+    config = core.Config(format='fasta', region_slack=0, out=str(filename), jobs=jobs)
+    regions = [Region('NC_2.1', 0, 5), Region('NC_1.1', 10, 20), Region('NC_1.1', 15, 25)]
+
+    core.download_regions(regions, config, out=str(filename))
+
+    assert req.call_count == 2
+    assert sorted(request.qs['from'][0] for request in req.request_history) == ['1', '11']
+    assert filename.read() == '>NC_2.1:1-5 test\n{}\n>NC_1.1:11-20 test\n{}\n>NC_1.1:16-25 test\n{}\n'.format(
+        sequence[:5], sequence[10:20], sequence[15:25])
+
+
+def test_download_regions_invalid_config():
+    """Test regions can only be downloaded in formats they can be cut out of."""
+    with pytest.raises(ValueError):
+        core.download_regions([Region('NC_1.1', 0, 10)], core.Config(format='gff3'))
+    with pytest.raises(ValueError):
+        core.download_regions([Region('NC_1.1', 0, 10)], core.Config(range='1:100'))
+    with pytest.raises(ValueError):
+        core.Config(region_slack=-1)
+
+
+def test_generate_url_seq_range():
+    """Test generating the URL for a range of a record."""
+    url = core.generate_url('NC_1.1', core.Config(format='fasta'), (11, 20))
+    assert '&from=11&to=20&' in url
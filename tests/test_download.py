@@ -1,9 +1,13 @@
-from io import StringIO
+from io import BytesIO, StringIO
 import pytest
 import requests
 
 from ncbi_acc_download.core import Config
-from ncbi_acc_download.errors import DownloadError
+from ncbi_acc_download.errors import (
+    BadPatternError,
+    DownloadError,
+    InvalidIdError,
+)
 from ncbi_acc_download import download
 
 
@@ -15,3 +19,177 @@ def test_write_stream(mocker):
 
     with pytest.raises(DownloadError):
         download.write_stream(req, handle, "FAKE", cfg)
+
+
+def test_create_session():
+    session = download.create_session(4)
+    adapter = session.get_adapter('https://eutils.ncbi.nlm.nih.gov/')
+    assert adapter._pool_maxsize == 4
+
+
+def test_get_stream_reuses_session(mocker):
+    cfg = Config()
+    response = mocker.Mock(status_code=requests.codes.ok)
+    cfg.session = mocker.Mock()
+    cfg.session.get.return_value = response
+
+    assert download.get_stream('http://fake/', dict(id='FOO'), cfg) is response
+    assert download.get_stream('http://fake/', dict(id='BAR'), cfg) is response
+    assert cfg.session.get.call_count == 2
+
+
+@pytest.fixture
+def cfg(unthrottled):
+    return Config(retry_backoff=0)
+
+
+def test_fetch_and_write_retries_server_errors(req, cfg):
+    req.get('http://fake/', response_list=[
+        {"text": 'Oops', "status_code": 502},
+        {"exc": requests.exceptions.ConnectionError},
+        {"text": 'This works.'},
+    ])
+    handle = StringIO()
+    download.fetch_and_write('http://fake/', dict(id='FAKE'), handle, 'FAKE', cfg)
+    assert handle.getvalue() == 'This works.'
+    assert req.call_count == 3
+
+
+def test_fetch_and_write_retries_error_patterns(req, cfg):
+    req.get('http://fake/', response_list=[
+        {"text": 'Half a record. Service unavailable'},
+        {"text": 'This works.'},
+    ])
+    handle = StringIO()
+    handle.write('Earlier record.\n')
+    download.fetch_and_write('http://fake/', dict(id='FAKE'), handle, 'FAKE', cfg)
+    assert handle.getvalue() == 'Earlier record.\nThis works.'
+
+
+def test_fetch_and_write_gives_up(req, cfg):
+    req.get('http://fake/', text='Oops', status_code=503)
+    with pytest.raises(InvalidIdError):
+        download.fetch_and_write('http://fake/', dict(id='FAKE'), StringIO(), 'FAKE', cfg)
+    assert req.call_count == cfg.retry.retries + 1
+
+
+def test_fetch_and_write_permanent_errors(req, cfg):
+    req.get('http://fake/', text='ID list is empty')
+    with pytest.raises(BadPatternError):
+        download.fetch_and_write('http://fake/', dict(id='FAKE'), StringIO(), 'FAKE', cfg)
+    assert req.call_count == 1
+
+
+def test_fetch_and_write_unseekable(req, cfg, mocker):
+    req.get('http://fake/', text='Service unavailable')
+    handle = mocker.Mock()
+    handle.seekable.return_value = False
+    with pytest.raises(BadPatternError):
+        download.fetch_and_write('http://fake/', dict(id='FAKE'), handle, 'FAKE', cfg)
+    assert req.call_count == 1
+
+
+def test_find_error_pattern():
+    assert download.find_error_pattern(u'LOCUS  FOO\nORIGIN\n') is None
+    assert download.find_error_pattern(u'Error: ID list is empty!') == u'ID list is empty'
+    for pattern in download.ERROR_PATTERNS:
+        assert download.find_error_pattern(u'xx{}xx'.format(pattern)) == pattern
+
+
+def test_find_error_pattern_boundary():
+    assert download.find_error_pattern(u'st is empty\n', u'>foo\nID li') == u'ID list is empty'
+    assert download.find_error_pattern(u'ATGC\n', u'>foo\nID li') is None
+
+
+def test_iter_stream_boundary(mocker):
+    req = mocker.Mock()
+    req.iter_content.return_value = iter([u'>foo\nATGC\nService ', u'unavai', u'lable\n'])
+    with pytest.raises(BadPatternError, match="Service unavailable"):
+        list(download.iter_stream(req, "FAKE", Config()))
+
+
+def test_error_pattern_anchors():
+    for pattern in download.ERROR_PATTERNS:
+        assert any(anchor in pattern for anchor in download.ERROR_PATTERN_ANCHORS)
+        assert pattern.encode('ascii').translate(None, download.SEQUENCE_CHARS)
+
+
+def test_find_error_pattern_sequence():
+    assert download.find_error_pattern(u'       61 ctcgcggctg tgtggtgtgc\n') is None
+    assert download.find_error_pattern(u'ATGC\nBad gatewayé\n') == u'Bad gateway'
+
+
+def test_write_stream_binary(req, cfg):
+    req.get('http://fake/', content=u'>foo Ωmega\nATGC\n'.encode('utf-8'))
+    r = requests.get('http://fake/', stream=True)
+    handle = BytesIO()
+    download.write_stream(r, handle, 'FAKE', cfg)
+    assert handle.getvalue() == u'>foo Ωmega\nATGC\n'.encode('utf-8')
+
+
+def test_write_stream_binary_error_pattern(req, cfg):
+    req.get('http://fake/', content=b'>foo\nATGC\nID list is empty\n')
+    r = requests.get('http://fake/', stream=True)
+    with pytest.raises(BadPatternError, match="ID list is empty"):
+        download.write_stream(r, BytesIO(), 'FAKE', cfg)
+
+
+def test_iter_stream_chunk_size(mocker):
+    req = mocker.Mock()
+    req.iter_content.return_value = iter([b'ATGC'])
+    cfg = Config(chunk_size=123)
+    assert list(download.iter_stream(req, 'FAKE', cfg, binary=True)) == [b'ATGC']
+    req.iter_content.assert_called_once_with(123, decode_unicode=False)
+
+
+def test_iter_stream_progress(mocker, monkeypatch):
+    req = mocker.Mock()
+    req.iter_content.return_value = iter([u'A'] * 10)
+    output = StringIO()
+    cfg = Config()
+    cfg.emit = output.write
+    times = iter([0.0, 0.1, 0.5, 1.0, 1.2, 1.9, 2.0, 2.1, 5.0, 5.5])
+    monkeypatch.setattr(download.time, 'monotonic', lambda: next(times))
+    list(download.iter_stream(req, 'FAKE', cfg))
+    assert output.getvalue() == u'....\n'
+
+
+def test_fetch_and_write_metrics(req, cfg):
+    req.get('http://fake/', response_list=[
+        {"text": 'Oops', "status_code": 502},
+        {"text": 'This works.'},
+    ])
+    events = []
+    cfg.metrics.add_listener(events.append)
+    download.fetch_and_write('http://fake/', dict(id='FAKE'), StringIO(), 'FAKE', cfg)
+
+    assert [event['event'] for event in events] == ['request', 'retry', 'request']
+    assert events[0]['status'] == 502
+    assert events[0]['error'] == 'HTTP 502'
+    assert events[1]['error'] == 'InvalidIdError'
+    assert events[1]['attempt'] == 1
+    assert events[2]['error'] is None
+    assert events[2]['bytes'] == len('This works.')
+    assert events[2]['cached'] is False
+    assert events[2]['ttfb'] is not None
+
+
+def test_iter_stream_metrics_error_pattern(mocker, cfg):
+    req = mocker.Mock(status_code=200, url='http://fake/')
+    req.iter_content.return_value = iter([u'>foo\nATGC\n', u'ID list is empty\n'])
+    events = []
+    cfg.metrics.add_listener(events.append)
+    with pytest.raises(BadPatternError):
+        list(download.iter_stream(req, 'FAKE', cfg))
+    event, = events
+    assert event['error'] == 'ID list is empty'
+    assert event['cached'] is True
+
+
+def test_iter_stream_metrics_api_key(mocker, cfg):
+    req = mocker.Mock(status_code=200, url='http://fake/?id=FAKE&api_key=secret&db=nucleotide')
+    req.iter_content.return_value = iter([u'>foo\nATGC\n'])
+    events = []
+    cfg.metrics.add_listener(events.append)
+    list(download.iter_stream(req, 'FAKE', cfg))
+    assert events[0]['url'] == 'http://fake/?id=FAKE&api_key=...&db=nucleotide'
@@ -0,0 +1,100 @@
+"""Tests for the library interface."""
+
+import asyncio
+import pytest
+
+from ncbi_acc_download import Downloader
+from ncbi_acc_download.core import (
+    Config,
+    ENTREZ_URL,
+    SVIEWER_URL,
+)
+
+pytestmark = pytest.mark.usefixtures('unthrottled')
+
+
+def _serve_records(req):
+    """Serve a FASTA record for every requested ID."""
+    def callback(request, context):
+        ids = request.qs['id'][0].upper().split(',')
+        return ''.join('>{}.1 record\nACGT\n'.format(dl_id) for dl_id in ids)
+
+    req.get(ENTREZ_URL, text=callback)
+
+
+def _downloader(**kwargs):
+    return Downloader(format='fasta', **kwargs)
+
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_fetch(req, jobs):
+    """Test fetching records in batches keeps the order of the IDs."""
+    _serve_records(req)
+    ids = ['ID{}'.format(i) for i in range(7)]
+    with _downloader(batch_size=2, jobs=jobs) as downloader:
+        entries = list(downloader.fetch(iter(ids)))
+
+    assert req.call_count == 4
+    assert entries == [('{}.1'.format(dl_id), '>{}.1 record\nACGT\n'.format(dl_id)) for dl_id in ids]
+
+
+def test_fetch_lazy(req):
+    """Test only the batches needed are downloaded."""
+    _serve_records(req)
+    downloader = _downloader()
+    entries = downloader.fetch(['A', 'B', 'C'])
+    assert next(entries)[0] == 'A.1'
+    assert req.call_count == 1
+
+
+def test_fetch_unsplittable(req):
+    """Test GFF3 files are returned whole, together with the requested ID."""
+    req.get(SVIEWER_URL, text='##gff-version 3\n')
+    downloader = Downloader(format='gff3')
+    assert list(downloader.fetch(['A', 'B'])) == [('A', '##gff-version 3\n'), ('B', '##gff-version 3\n')]
+
+
+def test_fetch_history(history_server):
+    """Test fetching records from the Entrez history server."""
+    with _downloader(batch_size=2, history=True) as downloader:
+        accessions = [accession for accession, _ in downloader.fetch(['A', 'B', 'C'])]
+    assert accessions == ['A.1', 'B.1', 'C.1']
+    assert len(history_server.posts) == 1
+
+
+def test_fetch_records(req):
+    """Test fetching records as Biopython SeqRecords."""
+    _serve_records(req)
+    downloader = _downloader()
+    (accession, record), = downloader.fetch_records(['A'])
+    assert accession == 'A.1'
+    assert str(record.seq) == 'ACGT'
+
+    downloader = Downloader(format='featuretable')
+    with pytest.raises(ValueError):
+        next(downloader.fetch_records(['A']))
+
+
+def test_afetch(req):
+    """Test fetching records from async code."""
+    _serve_records(req)
+    downloader = _downloader(batch_size=2)
+
+    async def collect():
+        return [accession async for accession, _ in downloader.afetch(['A', 'B', 'C'])]
+
+    assert asyncio.run(collect()) == ['A.1', 'B.1', 'C.1']
+
+
+def test_downloader_config():
+    """Test a downloader takes either a config or the settings for one."""
+    config = Config(format='fasta')
+    assert Downloader(config).config is config
+    assert Downloader(molecule='protein').config.molecule == 'protein'
+    with pytest.raises(ValueError):
+        Downloader(config, format='genbank')
+
+
+def test_url():
+    """Test getting the download URL."""
+    assert Downloader(format='fasta').url('A').startswith(ENTREZ_URL + '?retmode=text&id=A&')
@@ -0,0 +1,81 @@
+"""Tests for the Entrez history server support."""
+
+import pytest
+
+from ncbi_acc_download import history
+from ncbi_acc_download.core import Config
+from ncbi_acc_download.download import build_params
+from ncbi_acc_download.errors import DownloadError
+from ncbi_acc_download.history import (
+    EPOST_URL,
+    HistoryPage,
+    iter_history_batches,
+    post_ids,
+)
+
+from conftest import HistoryServer
+
+
+@pytest.fixture
+def cfg(unthrottled):
+    return Config(retry_backoff=0, history=True, batch_size=2, format='fasta')
+
+
+def test_post_ids(history_server, cfg):
+    webenv, query_key, invalid = post_ids(['A', 'B'], cfg)
+    assert webenv == 'MCID_1'
+    assert query_key == '1'
+    assert invalid == []
+    assert history_server.posts == [['A', 'B']]
+
+
+def test_post_ids_invalid(req, cfg):
+    HistoryServer(req, invalid=['B'])
+    _, _, invalid = post_ids(['A', 'B'], cfg)
+    assert invalid == ['B']
+
+
+def test_post_ids_error(req, cfg):
+    req.post(EPOST_URL, text='<ePostResult><ERROR>Empty ID list</ERROR></ePostResult>')
+    with pytest.raises(DownloadError, match='Empty ID list'):
+        post_ids([''], cfg)
+
+
+def test_post_ids_retries(req, cfg):
+    req.post(EPOST_URL, response_list=[
+        {"text": 'Oops', "status_code": 502},
+        {"text": '<ePostResult><QueryKey>1</QueryKey><WebEnv>MCID_1</WebEnv></ePostResult>'},
+    ])
+    assert post_ids(['A'], cfg) == ('MCID_1', '1', [])
+    assert req.call_count == 2
+
+
+def test_iter_history_batches(req, cfg):
+    server = HistoryServer(req, invalid=['C'])
+    batches = list(iter_history_batches(['A', 'B', 'A', 'C', 'D', 'E'], cfg))
+
+    # duplicates and invalid IDs are left out, so pages line up with the server
+    assert server.posts == [['A', 'B', 'C', 'D', 'E']]
+    assert [(indices, ids) for indices, ids, _ in batches] == [([0, 1], ['A', 'B']), ([4, 5], ['D', 'E'])]
+    assert [(page.retstart, page.retmax) for _, _, page in batches] == [(0, 2), (2, 2)]
+
+
+def test_iter_history_batches_chunks(history_server, cfg, monkeypatch):
+    monkeypatch.setattr(history, 'HISTORY_POST_SIZE', 3)
+    batches = iter_history_batches(iter(['A', 'B', 'C', 'D']), cfg)
+
+    assert next(batches)[1] == ['A', 'B']
+    # the IDs are uploaded lazily, one chunk at a time
+    assert history_server.posts == [['A', 'B', 'C']]
+    assert [ids for _, ids, _ in batches] == [['C'], ['D']]
+    assert history_server.posts == [['A', 'B', 'C'], ['D']]
+
+
+def test_build_params_history(cfg):
+    params = build_params('A,B', cfg, HistoryPage('MCID_1', '1', 500, 500))
+    assert 'id' not in params
+    assert params['WebEnv'] == 'MCID_1'
+    assert params['query_key'] == '1'
+    assert params['retstart'] == 500
+    assert params['retmax'] == 500
+    assert params['rettype'] == 'fasta'
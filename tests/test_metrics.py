@@ -0,0 +1,69 @@
+"""Tests for the download metrics."""
+
+import json
+
+from ncbi_acc_download.metrics import (
+    Metrics,
+    StatsFile,
+)
+
+
+def test_record():
+    """Test events are added up and passed on to listeners."""
+    metrics = Metrics()
+    events = []
+    metrics.add_listener(events.append)
+
+    metrics.record('request', id='A', seconds=1.0, ttfb=0.5, bytes=100, cached=False, error=None)
+    metrics.record('request', id='B', seconds=3.0, ttfb=0.5, bytes=300, cached=False, error=None)
+    metrics.record('request', id='C', seconds=0.1, ttfb=None, bytes=50, cached=True, error=None)
+    metrics.record('request', id='D', seconds=0.2, ttfb=0.2, bytes=0, cached=False, error='HTTP 500')
+
+    assert [event['id'] for event in events] == ['A', 'B', 'C', 'D']
+    assert events[0]['event'] == 'request'
+    assert 'time' in events[0]
+
+    totals = metrics.totals('request')
+    assert totals['count'] == 4
+    assert totals['bytes'] == 450
+    assert totals['cached'] == 1
+    assert totals['failed'] == 1
+    assert metrics.totals('retry')['count'] == 0
+
+
+def test_summary():
+    """Test the end of run summary only mentions what happened."""
+    metrics = Metrics()
+    summary = metrics.summary()
+    assert summary.startswith("Downloaded 0.0 B in 0 requests")
+    assert "Retried" not in summary
+
+    metrics.record('request', id='A', seconds=1.0, ttfb=0.5, bytes=2048, cached=False, error=None)
+    metrics.record('request', id='B', seconds=3.0, ttfb=0.25, bytes=0, cached=False, error=None)
+    metrics.record('retry', id='A', attempt=1, error='TooManyRequests', delay=2.0, too_many_requests=True)
+    metrics.record('retry', id='A', attempt=2, error='NetworkError', delay=1.0, too_many_requests=False)
+    metrics.record('throttle', seconds=0.5)
+    metrics.record('validation', id='A', records=10, seconds=0.25)
+    metrics.record('wgs', id='A', parts=30, seconds=5.0)
+
+    summary = metrics.summary()
+    assert "Downloaded 2.0 KiB in 2 requests (0 failed, 0 from the cache)" in summary
+    assert "mean 2.00 s, median 3.00 s, 95th percentile 3.00 s, mean time to first byte 0.38 s" in summary
+    assert "Retried 2 times, waiting 3.0 s, 1 times for too many requests (2.0 s)" in summary
+    assert "Waited 0.5 s for the rate limit before 1 requests" in summary
+    assert "Validated 10 records in 0.2 s" in summary
+    assert "Expanded 1 WGS records into 30 parts in 5.0 s" in summary
+
+
+def test_stats_file(tmpdir):
+    """Test events are written to a JSON lines file."""
+    filename = tmpdir.join('stats.jsonl')
+    metrics = Metrics()
+    metrics.add_listener(StatsFile(str(filename)))
+    metrics.record('throttle', seconds=0.5)
+    metrics.record('wgs', id='A', parts=3, seconds=1.0)
+    metrics.close()
+
+    events = [json.loads(line) for line in filename.readlines()]
+    assert [event['event'] for event in events] == ['throttle', 'wgs']
+    assert events[1]['parts'] == 3
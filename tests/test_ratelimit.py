@@ -0,0 +1,58 @@
+"""Tests for the request rate limiter."""
+
+import pytest
+
+from ncbi_acc_download import ratelimit
+from ncbi_acc_download.ratelimit import RateLimiter
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(ratelimit.time, 'monotonic', fake.monotonic)
+    monkeypatch.setattr(ratelimit.time, 'sleep', fake.sleep)
+    return fake
+
+
+def test_init():
+    with pytest.raises(ValueError):
+        RateLimiter(0)
+
+
+def test_for_api_key():
+    assert RateLimiter.for_api_key('none').rate == ratelimit.DEFAULT_RATE
+    assert RateLimiter.for_api_key('FAKE').rate == ratelimit.API_KEY_RATE
+
+
+def test_acquire_spaces_requests(clock):
+    limiter = RateLimiter(4)
+    # first request goes straight through, the rest is spaced out evenly
+    assert limiter.acquire() == 0
+    for _ in range(8):
+        limiter.acquire()
+    assert clock.sleeps == [pytest.approx(0.25)] * 8
+    assert clock.now == pytest.approx(2.0)
+
+
+def test_acquire_refills(clock):
+    limiter = RateLimiter(2, capacity=2)
+    limiter.acquire()
+    limiter.acquire()
+    clock.now += 10
+    # bucket never holds more than its capacity
+    assert limiter.acquire() == 0
+    assert limiter.acquire() == 0
+    assert limiter.acquire() == pytest.approx(0.5)
@@ -0,0 +1,61 @@
+"""Tests for the record splitting functions."""
+
+from io import StringIO
+import os
+import pytest
+
+from ncbi_acc_download import records
+
+
+def full_path(name):
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), name))
+
+
+def test_iter_records_fasta():
+    handle = StringIO(u'>foo\nATGC\nATGC\n>bar\nATGTGA\n')
+    assert list(records.iter_records(handle, 'fasta')) == ['>foo\nATGC\nATGC\n', '>bar\nATGTGA\n']
+
+
+def test_iter_records_genbank():
+    with open(full_path('wgs_full.gbk'), 'rt') as handle:
+        recs = list(records.iter_records(handle, 'genbank'))
+    assert len(recs) == 3
+    assert all(rec.startswith('LOCUS') for rec in recs)
+    assert all(rec.endswith('//\n') for rec in recs)
+    assert [records.get_accession(rec, 'genbank') for rec in recs] == [
+        'NZ_BASQ01000001.1', 'NZ_BASQ01000002.1', 'NZ_BASQ01000003.1']
+
+
+def test_iter_records_genbank_blank_lines():
+    """Test the blank line NCBI sends after // stays with the record that ended."""
+    text = u'LOCUS       A\n//\n\nLOCUS       B\n//\n\n'
+    assert list(records.iter_records(StringIO(text), 'genbank')) == [u'LOCUS       A\n//\n\n',
+                                                                     u'LOCUS       B\n//\n\n']
+
+
+def test_iter_records_featuretable():
+    handle = StringIO(u'>Feature ref|NC_1.1|\n1\t10\tgene\n>Feature ref|NC_2.1|\n1\t5\tgene\n')
+    recs = list(records.iter_records(handle, 'featuretable'))
+    assert len(recs) == 2
+    assert [records.get_accession(rec, 'featuretable') for rec in recs] == ['NC_1.1', 'NC_2.1']
+
+
+def test_iter_records_unsupported():
+    with pytest.raises(ValueError):
+        list(records.iter_records(StringIO(u''), 'gff3'))
+
+
+def test_get_accession_fasta():
+    assert records.get_accession('>WP_1.1 hypothetical protein\nMAGIC\n', 'fasta') == 'WP_1.1'
+    assert records.get_accession('MAGIC\n', 'fasta') is None
+
+
+def test_strip_version():
+    assert records.strip_version('nc_000913.3') == 'NC_000913'
+    assert records.strip_version('NC_000913') == 'NC_000913'
+
+
+def test_iter_lines():
+    chunks = ['>foo\nAT', 'GC\n', '>bar\n', 'ATG']
+    assert list(records.iter_lines(chunks)) == ['>foo\n', 'ATGC\n', '>bar\n', 'ATG']
+    assert list(records.iter_lines([])) == []
@@ -0,0 +1,99 @@
+"""Tests for the region list functions."""
+
+from io import StringIO
+import os
+import pytest
+
+from ncbi_acc_download import regions
+from ncbi_acc_download.regions import Region
+
+
+def full_path(name):
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), name))
+
+
+def test_region():
+    """Test regions use BED coordinates and print like NCBI ranges."""
+    region = Region('NC_007194.1', 1000, 9000)
+    assert len(region) == 8000
+    assert str(region) == 'NC_007194.1:1001-9000'
+    assert region == Region('NC_007194.1', 1000, 9000)
+
+    with pytest.raises(ValueError):
+        Region('NC_007194.1', 9000, 1000)
+    with pytest.raises(ValueError):
+        Region('NC_007194.1', -1, 1000)
+
+
+def test_read_regions():
+    """Test reading BED and whitespace-separated region lists."""
+    handle = StringIO(u'track name=loci\n# comment\n\nNC_1\t10\t20\tname\t0\t+\nNC_2 5 15\n')
+    assert list(regions.read_regions(handle)) == [Region('NC_1', 10, 20), Region('NC_2', 5, 15)]
+
+
+def test_read_regions_invalid():
+    """Test broken region lines are reported with their line number."""
+    with pytest.raises(ValueError, match='Line 2 .* less than 3 columns'):
+        list(regions.read_regions(StringIO(u'NC_1\t10\t20\nNC_1\t10\n')))
+    with pytest.raises(ValueError, match='Line 1 .* invalid region'):
+        list(regions.read_regions(StringIO(u'NC_1\tten\t20\n')))
+
+
+def test_merge_regions():
+    """Test overlapping and nearby regions of an accession are merged."""
+    region_list = [
+        Region('NC_1', 500, 600),
+        Region('NC_2', 0, 10),
+        Region('NC_1', 0, 100),
+        Region('NC_1', 50, 150),
+        Region('NC_1', 200, 300),
+    ]
+
+    groups = regions.merge_regions(region_list, slack=0)
+    assert [str(group) for group in groups] == ['NC_1:1-150', 'NC_1:201-300', 'NC_1:501-600', 'NC_2:1-10']
+    assert [index for index, _ in groups[0].regions] == [2, 3]
+
+    groups = regions.merge_regions(region_list, slack=100)
+    assert [str(group) for group in groups] == ['NC_1:1-300', 'NC_1:501-600', 'NC_2:1-10']
+
+    groups = regions.merge_regions(region_list, slack=200)
+    assert [str(group) for group in groups] == ['NC_1:1-600', 'NC_2:1-10']
+    assert [index for index, _ in groups[0].regions] == [2, 3, 4, 0]
+
+    groups = regions.merge_regions(region_list, slack=None)
+    assert [str(group) for group in groups] == ['NC_1:1-100', 'NC_1:51-150', 'NC_1:201-300', 'NC_1:501-600',
+                                                'NC_2:1-10']
+
+    with pytest.raises(ValueError):
+        regions.merge_regions(region_list, slack=-1)
+
+
+def test_cut_region_fasta():
+    """Test cutting a region out of a FASTA record downloaded for a larger range."""
+    sequence = 'ACGTACGTAC' * 20
+    record = '>NC_1.1:101-300 Some organism\n' + '\n'.join(sequence[i:i + 60] for i in range(0, 200, 60)) + '\n'
+    group, = regions.merge_regions([Region('NC_1.1', 100, 300)])
+
+    cut = regions.cut_region(record, group, Region('NC_1.1', 110, 195), 'fasta')
+    header, cut_sequence = cut.split('\n', 1)
+    assert header == '>NC_1.1:111-195 Some organism'
+    assert cut_sequence.replace('\n', '') == sequence[10:95]
+    assert max(len(line) for line in cut_sequence.splitlines()) == regions.FASTA_LINE_LENGTH
+
+
+def test_cut_region_genbank():
+    """Test GenBank records downloaded for exactly one region are passed on unchanged, but can't be cut."""
+    with open(full_path('partialcontig.gbk'), 'rt') as handle:
+        text = handle.read()
+    group, = regions.merge_regions([Region('NC_007194', 59, 600)], slack=None)
+
+    assert regions.cut_region(text, group, Region('NC_007194', 59, 600), 'genbank') == text
+    with pytest.raises(ValueError):
+        regions.cut_region(text, group, Region('NC_007194', 59, 400), 'genbank')
+
+
+def test_cut_region_unsupported():
+    """Test cutting regions only works for FASTA and GenBank records."""
+    group, = regions.merge_regions([Region('NC_1', 0, 10)])
+    with pytest.raises(ValueError):
+        regions.cut_region(u'', group, group.regions[0][1], 'gff3')
@@ -0,0 +1,53 @@
+"""Tests for the retry policy."""
+
+import pytest
+
+from ncbi_acc_download.errors import (
+    BadPatternError,
+    DownloadError,
+    InvalidIdError,
+    NetworkError,
+    TooManyRequests,
+    ValidationError,
+)
+from ncbi_acc_download.retry import RetryPolicy
+
+
+def test_init():
+    policy = RetryPolicy()
+    assert policy.retries == 3
+
+    with pytest.raises(ValueError):
+        RetryPolicy(-1)
+
+
+def test_is_transient():
+    assert RetryPolicy.is_transient(TooManyRequests("Slow down", "1"))
+    assert RetryPolicy.is_transient(NetworkError("Connection reset"))
+    assert RetryPolicy.is_transient(BadPatternError("Failed", "Bad gateway"))
+    assert RetryPolicy.is_transient(InvalidIdError("Failed", "FAKE", 503))
+
+    assert not RetryPolicy.is_transient(BadPatternError("Failed", "ID list is empty"))
+    assert not RetryPolicy.is_transient(InvalidIdError("Failed", "FAKE", 400))
+    assert not RetryPolicy.is_transient(ValidationError("Failed"))
+    assert not RetryPolicy.is_transient(DownloadError("Not in cache"))
+
+
+def test_should_retry():
+    policy = RetryPolicy(2)
+    err = NetworkError("Connection reset")
+    assert policy.should_retry(err, 0)
+    assert policy.should_retry(err, 1)
+    assert not policy.should_retry(err, 2)
+    assert not policy.should_retry(ValidationError("Failed"), 0)
+
+
+def test_delay():
+    policy = RetryPolicy(10, backoff=1.0, max_backoff=5.0)
+    err = NetworkError("Connection reset")
+    for attempt in range(10):
+        delay = policy.delay(err, attempt)
+        assert 0 <= delay <= min(5.0, 2 ** attempt)
+
+    assert policy.delay(TooManyRequests("Slow down", "7"), 0) == 7.0
+    assert 0 <= policy.delay(TooManyRequests("Slow down", None), 0) <= 1.0
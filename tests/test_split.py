@@ -0,0 +1,215 @@
+"""Tests for splitting downloads into records while writing."""
+
+import gzip
+import io
+import os
+import pytest
+
+from ncbi_acc_download import split
+from ncbi_acc_download.errors import DownloadError
+from ncbi_acc_download.records import iter_records
+
+
+class ListSink(object):
+    """Collect records in a list."""
+
+    def __init__(self):
+        self.records = []
+        self.current = None
+        self.discarded = 0
+
+    def start(self, accession):
+        self.current = io.StringIO()
+        self.records.append((accession, self.current))
+        return self.current
+
+    def finish(self):
+        self.current = None
+
+    def discard(self):
+        self.discarded += 1
+        self.records = []
+
+    def texts(self):
+        return [(accession, handle.getvalue()) for accession, handle in self.records]
+
+
+FASTA = u'>NC_1.1 first\nACGT\nACGT\n>NC_2.1 second\nGGCC\n'
+FEATURES = u'>Feature ref|NC_1.1|\n1\t10\tgene\n>Feature ref|NC_2.1|\n1\t5\tgene\n'
+GENBANK = (u'LOCUS       NC_1\nACCESSION   NC_1\nVERSION     NC_1.1\nFEATURES             Location/Qualifiers\n'
+           u'ORIGIN\n        1 acgt\n//\n\nLOCUS       NC_2\nACCESSION   NC_2\nVERSION     NC_2.3\nORIGIN\n'
+           u'        1 ggcc\n//\n')
+
+
+@pytest.mark.parametrize('file_format,text,accessions', [
+    ('fasta', FASTA, ['NC_1.1', 'NC_2.1']),
+    ('featuretable', FEATURES, ['NC_1.1', 'NC_2.1']),
+    ('genbank', GENBANK, ['NC_1.1', 'NC_2.3']),
+])
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 1000])
+def test_record_splitter(file_format, text, accessions, chunk_size):
+    sink = ListSink()
+    with split.RecordSplitter(file_format, sink) as splitter:
+        for start in range(0, len(text), chunk_size):
+            splitter.write(text[start:start + chunk_size])
+
+    assert sink.texts() == list(zip(accessions, iter_records(io.StringIO(text), file_format)))
+    assert sink.current is None
+
+
+def test_record_splitter_streams():
+    """Test records are passed on as soon as their accession is known, not when they are complete."""
+    sink = ListSink()
+    splitter = split.RecordSplitter('genbank', sink)
+    splitter.write(u'LOCUS       NC_1\nACCESSION   NC_1\n')
+    assert sink.records == []
+    splitter.write(u'VERSION     NC_1.1\nORIGIN\n        1 ac')
+    assert sink.texts() == [('NC_1.1', u'LOCUS       NC_1\nACCESSION   NC_1\nVERSION     NC_1.1\nORIGIN\n')]
+    splitter.write(u'gt\n/')
+    assert sink.current is not None
+    splitter.write(u'/\n\n')
+    # blank lines after // still belong to the record
+    assert sink.current is not None
+    splitter.write(u'LOCUS       NC_2\n')
+    assert sink.current is None
+    assert sink.texts()[0][1].endswith(u'//\n\n')
+    splitter.close()
+    assert len(sink.records) == 2
+
+
+def test_record_splitter_unterminated():
+    """Test the last record is passed on even without its end marker, but trailing whitespace isn't."""
+    sink = ListSink()
+    with split.RecordSplitter('genbank', sink) as splitter:
+        splitter.write(GENBANK + u'\nLOCUS       NC_3\nACCESSION   NC_3')
+    assert [accession for accession, _ in sink.texts()] == ['NC_1.1', 'NC_2.3', 'NC_3']
+
+    sink = ListSink()
+    with split.RecordSplitter('fasta', sink) as splitter:
+        splitter.write(FASTA + u'\n  \n')
+    assert [text for _, text in sink.texts()] == [u'>NC_1.1 first\nACGT\nACGT\n', u'>NC_2.1 second\nGGCC\n\n  \n']
+
+
+def test_record_splitter_restart():
+    """Test seeking back to the start discards the output, so downloads can be retried."""
+    sink = ListSink()
+    with split.RecordSplitter('fasta', sink) as splitter:
+        assert splitter.seekable()
+        start = splitter.tell()
+        splitter.write(u'>NC_1.1 first\nAC')
+        assert splitter.tell() == 16
+        splitter.seek(start)
+        splitter.truncate()
+        assert splitter.tell() == 0
+        splitter.write(FASTA)
+    assert sink.discarded == 1
+    assert [accession for accession, _ in sink.texts()] == ['NC_1.1', 'NC_2.1']
+
+    with pytest.raises(io.UnsupportedOperation):
+        split.RecordSplitter('fasta', sink).seek(5)
+
+
+def test_record_splitter_restart_boundary():
+    """Test seeking back to the position told between two records only discards what came after it."""
+    sink = ListSink()
+    with split.RecordSplitter('genbank', sink) as splitter:
+        splitter.write(GENBANK[:GENBANK.index(u'LOCUS       NC_2')])
+        assert splitter.seekable()
+        boundary = splitter.tell()
+        assert sink.current is None
+        splitter.write(u'LOCUS       NC_2\nACCESSION   NC_2\nVERSION     NC_2.3\nORIGIN\n  1 gg')
+        assert not splitter.seekable()
+        with pytest.raises(io.UnsupportedOperation):
+            splitter.seek(5)
+        assert splitter.seek(boundary) == boundary
+        assert splitter.truncate() == boundary
+        assert splitter.tell() == boundary
+        splitter.write(GENBANK[boundary:])
+
+    assert sink.discarded == 1
+    assert sink.texts() == [('NC_2.3', list(iter_records(io.StringIO(GENBANK), 'genbank'))[1])]
+
+
+def test_record_splitter_error():
+    """Test an error discards the unfinished output."""
+    sink = ListSink()
+    with pytest.raises(DownloadError):
+        with split.RecordSplitter('fasta', sink) as splitter:
+            splitter.write(FASTA)
+            raise DownloadError("Connection lost")
+    assert sink.discarded == 1
+    assert sink.records == []
+
+
+def test_record_splitter_invalid_format():
+    with pytest.raises(ValueError):
+        split.RecordSplitter('gff3', ListSink())
+
+
+def test_record_path():
+    assert split.record_path('out', 'NC_000913.3', '.gbk') == os.path.join('out', 'NC_000913.3.gbk')
+    assert split.record_path('out', 'pdb|1ABC|A', '.fa') == os.path.join('out', 'pdb_1ABC_A.fa')
+
+    sharded = split.record_path('out', 'NC_000913.3', '.gbk', 2)
+    parts = sharded.split(os.sep)
+    assert parts[0] == 'out'
+    assert parts[-1] == 'NC_000913.3.gbk'
+    assert len(parts) == 4
+    assert all(len(part) == 2 for part in parts[1:3])
+    assert split.record_path('out', 'NC_000913.3', '.gbk', 2) == sharded
+
+
+def test_record_files(tmpdir):
+    directory = str(tmpdir.join('records'))
+    files = split.RecordFiles(directory, '.fa', shard_depth=1)
+    with split.RecordSplitter('fasta', files) as splitter:
+        splitter.write(FASTA)
+
+    with open(files.path('NC_1.1'), 'r') as handle:
+        assert handle.read() == u'>NC_1.1 first\nACGT\nACGT\n'
+    with open(files.path('NC_2.1'), 'r') as handle:
+        assert handle.read() == u'>NC_2.1 second\nGGCC\n'
+    names = [name for _, _, filenames in os.walk(directory) for name in filenames]
+    assert sorted(names) == ['NC_1.1.fa', 'NC_2.1.fa']
+
+
+def test_record_files_mode(tmpdir):
+    """Test record files get the same permissions as other output files."""
+    umask = os.umask(0o022)
+    try:
+        files = split.RecordFiles(str(tmpdir), '.fa')
+        with split.RecordSplitter('fasta', files) as splitter:
+            splitter.write(FASTA)
+    finally:
+        os.umask(umask)
+
+    assert os.stat(files.path('NC_1.1')).st_mode & 0o777 == 0o644
+
+
+def test_record_files_compressed(tmpdir):
+    files = split.RecordFiles(str(tmpdir), '.fa.gz', compress='gzip')
+    with split.RecordSplitter('fasta', files) as splitter:
+        splitter.write(FASTA)
+
+    with gzip.open(files.path('NC_1.1'), 'rt') as handle:
+        assert handle.read() == u'>NC_1.1 first\nACGT\nACGT\n'
+
+
+def test_record_files_discard(tmpdir):
+    """Test unfinished records leave no files behind."""
+    files = split.RecordFiles(str(tmpdir), '.fa')
+    with pytest.raises(DownloadError):
+        with split.RecordSplitter('fasta', files) as splitter:
+            splitter.write(u'>NC_1.1 first\nACGT\n>NC_2.1 sec')
+            raise DownloadError("Connection lost")
+
+    assert sorted(path.basename for path in tmpdir.listdir()) == ['NC_1.1.fa']
+
+
+def test_record_files_invalid():
+    with pytest.raises(ValueError):
+        split.RecordFiles('out', '.fa', shard_depth=-1)
+    with pytest.raises(ValueError):
+        split.RecordFiles('out', '.fa', shard_depth=split.MAX_SHARD_DEPTH + 1)
+    with pytest.raises(DownloadError):
+        split.RecordFiles('out', '.fa').start(None)
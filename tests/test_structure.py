@@ -0,0 +1,123 @@
+"""Tests for the structural checks of sequence files."""
+
+import os
+import pytest
+
+from ncbi_acc_download import structure
+
+
+def full_path(name):
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), name))
+
+
+GENBANK = u'''LOCUS       FAKE_1                    15 bp    DNA     linear   BCT 01-JAN-2020
+ACCESSION   FAKE_1
+VERSION     FAKE_1.1
+FEATURES             Location/Qualifiers
+     source          1..15
+ORIGIN
+        1 acgtacgtac gtacg
+//
+'''
+
+
+@pytest.mark.parametrize('filename', ['wgs.gbk', 'wgs_full.gbk', 'tsa_full.gbk', 'supercontig.gbk',
+                                      'supercontig_full.gbk', 'partialcontig.gbk'])
+def test_check_structure_genbank_files(filename):
+    with open(full_path(filename), 'rt') as handle:
+        structure.check_structure(handle.read(), 'genbank')
+
+
+def test_check_genbank():
+    structure.check_genbank(GENBANK)
+
+    with pytest.raises(ValueError, match="LOCUS"):
+        structure.check_genbank(GENBANK[1:])
+    with pytest.raises(ValueError, match="//"):
+        structure.check_genbank(GENBANK[:-3])
+    with pytest.raises(ValueError, match="Invalid character '!'"):
+        structure.check_genbank(GENBANK.replace('gtacg\n', 'gtac!\n'))
+    with pytest.raises(ValueError, match="doesn't match length 15"):
+        structure.check_genbank(GENBANK.replace('gtacg\n', 'gtac\n'))
+    with pytest.raises(ValueError, match="line numbers"):
+        structure.check_genbank(GENBANK.replace('        1 acgt', '       11 acgt'))
+
+
+def test_check_genbank_multiple_lines():
+    sequence = u'        1 acgtacgtac gtacgtacgt acgtacgtac gtacgtacgt acgtacgtac gtacgtacgt\n' \
+               u'       61 acgt\n'
+    text = GENBANK.replace('15 bp', '64 bp').replace('        1 acgtacgtac gtacg\n', sequence)
+    structure.check_genbank(text)
+
+    with pytest.raises(ValueError, match="line numbers"):
+        structure.check_genbank(text.replace('       61 acgt', '       71 acgt'))
+
+
+def test_check_genbank_blank_line_between_records():
+    """Test records separated by a blank line, like NCBI sends them, are fine."""
+    text = GENBANK + u'\n' + GENBANK.replace('FAKE_1', 'FAKE_2')
+    structure.check_structure(text, 'genbank')
+    structure.check_genbank(u'\n' + GENBANK)
+
+
+def test_check_fasta():
+    structure.check_fasta(u'>foo bar\nATGC\nNNNN\n')
+    structure.check_fasta(u'>foo\nMAGIC*\n')
+
+    with pytest.raises(ValueError, match="header"):
+        structure.check_fasta(u'ATGC\n')
+    with pytest.raises(ValueError, match="header"):
+        structure.check_fasta(u'>\nATGC\n')
+    with pytest.raises(ValueError, match="Invalid character '1' in sequence of foo"):
+        structure.check_fasta(u'>foo\nAT1GC\n')
+    with pytest.raises(ValueError, match="Non-ASCII"):
+        structure.check_fasta(u'>foo\nATGé\n')
+    with pytest.raises(ValueError, match="More than one"):
+        structure.check_fasta(u'>foo\nATGC\n>bar\nATGC\n')
+
+
+def test_check_featuretable():
+    structure.check_featuretable(u'>Feature ref|NC_000913.3|\n'
+                                 u'<1\t>255\tgene\n'
+                                 u'\t\t\tgene\tthrL\n'
+                                 u'337\t2799\tCDS\n'
+                                 u'3000\t3100\n'
+                                 u'\t\t\tproduct\tfused aspartokinase\n')
+
+    with pytest.raises(ValueError, match=">Feature"):
+        structure.check_featuretable(u'1\t255\tgene\n')
+    with pytest.raises(ValueError, match="location"):
+        structure.check_featuretable(u'>Feature ref|NC_000913.3|\nfoo\t255\tgene\n')
+    with pytest.raises(ValueError, match="qualifier"):
+        structure.check_featuretable(u'>Feature ref|NC_000913.3|\n\tgene\tthrL\n')
+
+
+def test_check_gff3():
+    structure.check_gff3(u'##gff-version 3\n'
+                         u'#!processor NCBI annotwriter\n'
+                         u'NC_000913.3\tRefSeq\tgene\t190\t255\t.\t+\t.\tID=gene-b0001\n'
+                         u'###\n'
+                         u'##FASTA\n'
+                         u'>NC_000913.3\nACGT\n')
+
+    with pytest.raises(ValueError, match="gff-version"):
+        structure.check_gff3(u'NC_000913.3\tRefSeq\tgene\t190\t255\t.\t+\t.\tID=gene-b0001\n')
+    with pytest.raises(ValueError, match="columns"):
+        structure.check_gff3(u'##gff-version 3\nNC_000913.3\tRefSeq\tgene\n')
+    with pytest.raises(ValueError, match="location"):
+        structure.check_gff3(u'##gff-version 3\nNC_000913.3\tRefSeq\tgene\t255\t190\t.\t+\t.\tID=gene-b0001\n')
+    with pytest.raises(ValueError, match="strand"):
+        structure.check_gff3(u'##gff-version 3\nNC_000913.3\tRefSeq\tgene\t190\t255\t.\tx\t.\tID=gene-b0001\n')
+    with pytest.raises(ValueError, match="phase"):
+        structure.check_gff3(u'##gff-version 3\nNC_000913.3\tRefSeq\tgene\t190\t255\t.\t+\t3\tID=gene-b0001\n')
+
+
+def test_check_structure():
+    structure.check_structure(u'>foo\nATGC\n>bar\nATGTGA\n', 'fasta')
+
+    with pytest.raises(ValueError, match="no seq"):
+        structure.check_structure(u'\n', 'fasta')
+    with pytest.raises(ValueError, match="Can't check"):
+        structure.check_structure(u'>foo\nATGC\n', 'embl')
+    with pytest.raises(ValueError, match="Invalid character"):
+        structure.check_structure(u'>foo\nATGC\n>bar\nAT GTGA\n', 'fasta')
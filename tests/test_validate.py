@@ -1,8 +1,19 @@
 """Tests for the validation functions."""
 
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
 from io import StringIO
+import os
+import pytest
 
 from ncbi_acc_download import validate
+from ncbi_acc_download.errors import ValidationError
+
+
+def full_path(name):
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), name))
 
 
 def test_run_extended_validation_no_biopython(monkeypatch):
@@ -14,6 +25,7 @@ def test_run_extended_validation_no_biopython(monkeypatch):
 
 def test_run_extended_validation_raises(monkeypatch, mocker):
     """Test the "seqence loads" validator catches exceptions in SeqIO.parse()."""
+    pytest.importorskip('Bio')
     seqio_mock = mocker.MagicMock()
     seqio_mock.parse = mocker.MagicMock(side_effect=ValueError)
     monkeypatch.setattr(validate, 'SeqIO', seqio_mock)
@@ -30,3 +42,135 @@ def test_run_extended_validation_loads():
 
     handle = StringIO(u'')
     assert validate.run_extended_validation(handle, 'fasta', 'loads') is False
+
+
+def test_iter_validated():
+    """Test records are validated one by one as they come in."""
+    records = [u'>foo\nATGC\n', u'>bar\nATGTGA\n']
+    assert list(validate.iter_validated(iter(records), 'fasta', 'loads', 'FAKE')) == records
+
+
+def test_iter_validated_fails_fast():
+    """Test validation stops at the first bad record without reading any further."""
+    seen = []
+
+    def records():
+        for record in (u'>foo\nATGC\n', u'not a record\n', u'>bar\nATGTGA\n'):
+            seen.append(record)
+            yield record
+
+    validated = validate.iter_validated(records(), 'fasta', 'loads', 'FAKE')
+    assert next(validated) == u'>foo\nATGC\n'
+    with pytest.raises(ValidationError, match='Record 2 downloaded for FAKE'):
+        next(validated)
+    assert len(seen) == 2
+
+
+def test_iter_validated_empty():
+    """Test an empty download fails validation."""
+    with pytest.raises(ValidationError, match='no seq'):
+        list(validate.iter_validated(iter([]), 'fasta', 'loads', 'FAKE'))
+
+
+def test_iter_validated_correct():
+    """Test the correct level drops partial features record by record."""
+    SeqIO = pytest.importorskip('Bio.SeqIO')
+    with open(full_path('partialcontig.gbk'), 'rt') as handle:
+        text = handle.read()
+
+    corrected, = validate.iter_validated(iter([text]), 'genbank', 'correct', 'FAKE')
+    record = SeqIO.read(StringIO(corrected), 'genbank')
+    assert len(record.features) == 1
+
+
+def test_validate_chunk():
+    """Test validating a chunk reports each failed record."""
+    results = validate.validate_chunk([u'>foo\nATGC\n', u'junk\n', u'>bar\nATGTGA\n'], 'fasta', 'loads', 10)
+    assert results[0] == (u'>foo\nATGC\n', None)
+    assert results[1][0] is None
+    assert results[1][1][:2] == (12, None)
+    assert results[2] == (u'>bar\nATGTGA\n', None)
+
+
+def test_iter_validated_parallel(monkeypatch):
+    """Test validating chunks of records in parallel keeps their order and reports all failures."""
+    monkeypatch.setattr(validate, 'VALIDATION_CHUNK_SIZE', 20)
+    records = [u'>seq{}\nATGC\n'.format(i) for i in range(20)]
+    records[3] = records[17] = u'junk\n'
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        validated = validate.iter_validated(iter(records), 'fasta', 'loads', 'FAKE', executor, 4)
+        written = []
+        with pytest.raises(ValidationError, match='2 records, first record 4,') as excinfo:
+            for text in validated:
+                written.append(text)
+
+    assert written == [record for record in records if record != u'junk\n']
+    assert [failure[0] for failure in excinfo.value.failures] == [4, 18]
+
+
+def test_iter_validated_parallel_ok():
+    """Test parallel validation passes valid records through."""
+    records = [u'>seq{}\nATGC\n'.format(i) for i in range(5)]
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert list(validate.iter_validated(iter(records), 'fasta', 'loads', 'FAKE', executor, 4)) == records
+
+
+def test_run_extended_validation_loads_no_biopython(monkeypatch):
+    """Test the built-in structural checks work without Biopython."""
+    monkeypatch.setattr(validate, 'HAVE_BIOPYTHON', False)
+    handle = StringIO(u'>foo\nATGC\n>bar\nATGTGA\n')
+    assert validate.run_extended_validation(handle, 'fasta', 'loads')
+
+    handle = StringIO(u'>foo\nATGC\n>bar\nAT?GTGA\n')
+    assert validate.run_extended_validation(handle, 'fasta', 'loads') is False
+
+
+def test_run_extended_validation_gff3():
+    """Test GFF3 files can be validated with the built-in checks."""
+    handle = StringIO(u'##gff-version 3\nNC_000913.3\tRefSeq\tgene\t190\t255\t.\t+\t.\tID=gene-b0001\n')
+    assert validate.run_extended_validation(handle, 'gff3', 'loads')
+    if validate.HAVE_BIOPYTHON:
+        assert validate.run_extended_validation(handle, 'gff3', 'all')
+
+
+def test_drop_partial_features():
+    """Test only partial features are removed and the rest of the record is kept as is."""
+    with open(full_path('partialcontig.gbk'), 'rt') as handle:
+        text = handle.read()
+
+    corrected = validate.drop_partial_features(text)
+    assert '<157..>541' not in corrected
+    kept = [line for line in text.splitlines(True) if line not in corrected]
+    assert all(line.startswith(' ' * 5) for line in kept)
+    assert corrected.startswith(text[:text.index('FEATURES')])
+    assert corrected.endswith(text[text.index('ORIGIN'):])
+
+
+def test_drop_partial_features_locations():
+    """Test partial locations are found in joins, on continuation lines and in references to other records."""
+    features = (
+        u'     gene            join(1..10,<20..>30,\n'
+        u'                     40..100)\n'
+        u'                     /gene="inner"\n'
+        u'     mRNA            complement(join(<5..10,20..300))\n'
+        u'                     /gene="start"\n'
+        u'     CDS             join(AB012345.1:<1..100,157..200)\n'
+        u'                     /note="1..>2000"\n'
+        u'     misc_feature    250..>300\n'
+    )
+    text = u'LOCUS       FAKE 300 bp    DNA\nFEATURES             Location/Qualifiers\n' + features + u'//\n'
+    corrected = validate.drop_partial_features(text)
+    assert '/gene="inner"' in corrected
+    assert 'mRNA' not in corrected
+    assert 'CDS' not in corrected
+    assert 'misc_feature' not in corrected
+
+
+def test_validate_text_correct_no_biopython(monkeypatch):
+    """Test the correct level doesn't need Biopython."""
+    monkeypatch.setattr(validate, 'HAVE_BIOPYTHON', False)
+    with open(full_path('partialcontig.gbk'), 'rt') as handle:
+        handle = StringIO(handle.read())
+    assert validate.run_extended_validation(handle, 'genbank', 'correct')
+    assert '<157..>541' not in handle.getvalue()
@@ -3,10 +3,14 @@
 from io import StringIO
 import os
 import pytest
+import sys
+import threading
+import time
 
 from ncbi_acc_download.core import Config
 from ncbi_acc_download.core import ENTREZ_URL
 from ncbi_acc_download import wgs
+from ncbi_acc_download.records import get_accession, iter_records, strip_version
 from ncbi_acc_download.wgs import WgsRange
 
 
@@ -68,17 +72,82 @@ def test_from_string():
         _ = WgsRange.from_string("ABCD234-ABCD123")
 
 
-def test_download_wgs_parts_no_biopython():
-    old_have_biopython = wgs.HAVE_BIOPYTHON
-    wgs.HAVE_BIOPYTHON = False
+def test_sequence():
+    wgs_range = WgsRange("ABCD", 5, 1, 3)
+    assert len(wgs_range) == 3
+    assert list(wgs_range) == ["ABCD00001", "ABCD00002", "ABCD00003"]
+    assert wgs_range[0] == "ABCD00001"
+    assert wgs_range[-1] == "ABCD00003"
+    with pytest.raises(IndexError):
+        _ = wgs_range[3]
+
+    assert wgs_range[1:] == WgsRange("ABCD", 5, 2, 3)
+    assert len(wgs_range[3:]) == 0
+    assert wgs_range[::2] == ["ABCD00001", "ABCD00003"]
+    assert str(wgs_range) == "ABCD00001-ABCD00003"
+    assert str(wgs_range[:1]) == "ABCD00001"
 
-    cfg = Config(format="genbank")
 
-    handle = StringIO()
+def test_sequence_huge():
+    wgs_range = WgsRange("ABCD", 8, 1, 99999999)
+    assert len(wgs_range) == 99999999
+    assert wgs_range[-1] == "ABCD99999999"
+    assert wgs_range[1000:1002].get_ids() == ["ABCD00001001", "ABCD00001002"]
+    assert "ABCD12345678" in wgs_range
+
+
+def test_contains():
+    wgs_range = WgsRange("ABCD", 5, 1, 3)
+    assert "ABCD00002" in wgs_range
+    assert "ABCD00002.1" in wgs_range
+    assert "NZ_ABCD00002.1" in wgs_range
+    assert "ABCD00004" not in wgs_range
+    assert "ABCD0002" not in wgs_range
+    assert "XABCD00002" not in wgs_range
+    assert "EFGH00002" not in wgs_range
+    assert 2 not in wgs_range
+
+
+def test_batches():
+    wgs_range = WgsRange("ABCD", 5, 1, 5)
+    assert [batch.get_ids() for batch in wgs_range.batches(2)] == [
+        ["ABCD00001", "ABCD00002"], ["ABCD00003", "ABCD00004"], ["ABCD00005"]]
+    assert list(wgs_range.batches(10)) == [wgs_range]
+
+
+def test_gaps():
+    wgs_range = WgsRange("ABCD", 5, 1, 6)
+    assert list(wgs_range.gaps(["ABCD00002.1", "NZ_ABCD00005.1", "ABCD00003"])) == [
+        WgsRange("ABCD", 5, 1, 1), WgsRange("ABCD", 5, 4, 4), WgsRange("ABCD", 5, 6, 6)]
+    assert list(wgs_range.gaps(wgs_range)) == []
+    assert list(wgs_range.gaps([])) == [wgs_range]
+
+
+def test_download_wgs_parts_reports_gaps(req):
+    cfg = Config(format="genbank", verbose=True)
+    messages = []
+    cfg.emit = messages.append
+    with open(full_path('wgs_full.gbk'), 'rt') as handle:
+        contigs = list(iter_records(handle, 'genbank'))
+    req.get(ENTREZ_URL, text=contigs[0] + contigs[2])
+
+    outhandle = StringIO()
+    with open(full_path('wgs.gbk'), 'rt') as handle:
+        wgs.write_wgs_parts(handle, outhandle, cfg)
+    assert outhandle.getvalue() == contigs[0] + contigs[2]
+    assert "No records returned for BASQ01000002, they might have been suppressed\n" in messages
+
+
+def test_download_wgs_parts_no_biopython(req, monkeypatch):
+    """Test WGS records are expanded without Biopython installed."""
+    monkeypatch.setitem(sys.modules, 'Bio', None)
+    cfg = Config(format="genbank")
+    req.get(ENTREZ_URL, **_build_request_params('wgs_full.gbk'))
 
-    new_handle = wgs.download_wgs_parts(handle, cfg)
-    wgs.HAVE_BIOPYTHON = old_have_biopython
-    assert handle == new_handle
+    with open(full_path('wgs.gbk'), 'rt') as handle:
+        outhandle = wgs.download_wgs_parts(handle, cfg)
+    with open(full_path('wgs_full.gbk'), 'rt') as handle:
+        assert outhandle.getvalue() == handle.read()
 
 
 def _build_request_params(filename):
@@ -166,14 +235,121 @@ def test_download_wgs_no_parts(req):
     supercontig.close()
 
 
-@pytest.mark.xfail
 def test_download_wgs_parts_tsa(req):
     cfg = Config(format="genbank")
     wgs_contig = open(full_path('tsa.gbk'), 'rt')
-    req.get(ENTREZ_URL, body=open(full_path('tsa_full.gbk'), 'rt'))
+    req.get(ENTREZ_URL, **_build_request_params('tsa_full.gbk'))
 
     outhandle = wgs.download_wgs_parts(wgs_contig, cfg)
     wgs_full = open(full_path('tsa_full.gbk'), 'rt')
     assert outhandle.getvalue() == wgs_full.read()
     wgs_full.close()
     wgs_contig.close()
+
+
+def test_write_wgs_parts_streams(req):
+    cfg = Config(format="genbank")
+    with open(full_path('wgs_full.gbk'), 'rt') as handle:
+        full_file = handle.read()
+    req.get(ENTREZ_URL, text=full_file)
+
+    outhandle = StringIO()
+    with open(full_path('wgs.gbk'), 'rt') as handle:
+        wgs.write_wgs_parts(handle, outhandle, cfg)
+    assert outhandle.getvalue() == full_file
+
+
+def test_write_wgs_parts_other_format():
+    cfg = Config(format="fasta")
+    outhandle = StringIO()
+    wgs.write_wgs_parts(['>foo\n', 'ATGC\n'], outhandle, cfg)
+    assert outhandle.getvalue() == '>foo\nATGC\n'
+
+
+def test_download_wgs_parts_parallel(req, mocker, unthrottled):
+    cfg = Config(format="genbank", jobs=3, wgs_batch_size=1)
+    submit = mocker.spy(cfg.wgs_executor, 'submit')
+    with open(full_path('wgs_full.gbk'), 'rt') as handle:
+        full_file = handle.read()
+    contigs = {strip_version(get_accession(record, 'genbank')): record
+               for record in iter_records(full_file.splitlines(True), 'genbank')}
+    threads = set()
+
+    def callback(request, context):
+        dl_id = request.qs['id'][0].upper()
+        threads.add(threading.current_thread().name)
+        if dl_id == 'BASQ01000001':
+            # the first batch is slow, it still has to come first in the output.
+            # requests_mock handles one request at a time, so the others can't wait for it to start.
+            time.sleep(0.1)
+        return contigs['NZ_' + dl_id]
+
+    req.get(ENTREZ_URL, text=callback)
+
+    outhandle = StringIO()
+    with open(full_path('wgs.gbk'), 'rt') as handle:
+        wgs.write_wgs_parts(handle, outhandle, cfg)
+    assert outhandle.getvalue() == full_file
+    assert req.call_count == 3
+    assert len(threads) > 1
+    assert submit.call_count == 3
+    cfg.wgs_executor.shutdown()
+
+
+def test_download_wgs_parts_batch_size(req):
+    cfg = Config(format="genbank", wgs_batch_size=2)
+    with open(full_path('wgs_full.gbk'), 'rt') as handle:
+        contigs = list(iter_records(handle, 'genbank'))
+    req.get(ENTREZ_URL, response_list=[
+        {"text": contigs[0] + contigs[1]},
+        {"text": contigs[2]},
+    ])
+
+    outhandle = StringIO()
+    with open(full_path('wgs.gbk'), 'rt') as handle:
+        wgs.write_wgs_parts(handle, outhandle, cfg)
+    assert outhandle.getvalue() == ''.join(contigs)
+    assert [request.qs['id'] for request in req.request_history] == [
+        ['basq01000001,basq01000002'], ['basq01000003']]
+
+
+def test_record_header_scan():
+    with open(full_path('wgs_scafld.gbk'), 'rt') as handle:
+        header = wgs.RecordHeader.scan(handle.read())
+    assert header.accession == 'NZ_BASQ00000000.1'
+    assert header.length == 3396165
+    assert header.undefined
+    assert not header.contig
+    assert header.wgs_range == WgsRange('NZ_BASQ', 8, 1000001, 1000003)
+
+    with open(full_path('supercontig.gbk'), 'rt') as handle:
+        header = wgs.RecordHeader.scan(handle.read())
+    assert header.accession == 'NC_007194.1'
+    assert header.undefined
+    assert header.contig
+    assert header.wgs_range is None
+
+    with open(full_path('tsa.gbk'), 'rt') as handle:
+        header = wgs.RecordHeader.scan(handle.read())
+    assert header.wgs_range == WgsRange('GHGH', 8, 1000001, 1000003)
+
+    with open(full_path('wgs_full.gbk'), 'rt') as handle:
+        first = next(iter_records(handle, 'genbank'))
+    header = wgs.RecordHeader.scan(first)
+    assert header.has_sequence
+    assert not header.undefined
+
+    header = wgs.RecordHeader.scan(u'LOCUS       NC_1  10 bp\nORIGIN      \n  \n//\n')
+    assert not header.has_sequence
+    assert header.undefined
+
+
+def test_write_wgs_parts_passes_records_through():
+    cfg = Config(format="genbank")
+    # Biopython would reformat this record, e.g. reorder the structured comment
+    with open(full_path('tsa_full.gbk'), 'rt') as handle:
+        full_file = handle.read()
+
+    outhandle = StringIO()
+    wgs.write_wgs_parts(full_file.splitlines(True), outhandle, cfg)
+    assert outhandle.getvalue() == full_file